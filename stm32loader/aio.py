@@ -0,0 +1,500 @@
+# GitHub repository: https://github.com/florisla/stm32loader
+#
+# This file is part of stm32loader.
+#
+# stm32loader is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# stm32loader is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with stm32loader; see the file LICENSE.  If not see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Talk to the STM32 native bootloader from an asyncio event loop.
+
+A single event loop can drive many boards at once, e.g.:
+
+    async def flash(port, data):
+        connection = AsyncSerialConnection(SerialConnection(port))
+        await connection.connect()
+        stm32 = AsyncStm32Bootloader(connection)
+        await stm32.reset_from_system_memory()
+        await stm32.erase_memory()
+        await stm32.write_memory_data(0x08000000, data)
+        await stm32.reset_from_flash()
+        connection.close()
+
+    await asyncio.gather(*(flash(port, data) for port in ports))
+
+Requires Python 3.5 or newer.
+"""
+
+import asyncio
+import math
+import struct
+import sys
+from functools import reduce
+
+from .bootloader import CommandError, DataLengthError, PageIndexError, Stm32Bootloader
+
+
+class AsyncSerialConnection:
+    """
+    Asynchronous reads from a SerialConnection, for AsyncStm32Bootloader.
+
+    Received bytes are collected by an event loop reader callback, so
+    waiting for a reply does not block a thread.  Writes go straight to
+    the serial port: bootloader frames fit in its transmit buffer.
+
+    Needs an event loop that can watch serial ports (add_reader()),
+    which excludes Windows.
+    """
+
+    def __init__(self, connection):
+        """
+        Construct an AsyncSerialConnection (not yet connected).
+
+        :param connection: stm32loader.uart.SerialConnection, maybe connected.
+        """
+        self.connection = connection
+        self.timeout = 5
+        self._buffer = bytearray()
+        self._data_received = None
+        self._loop = None
+
+    @property
+    def can_toggle_reset(self):
+        """Tell if the reset line can be toggled."""
+        return self.connection.can_toggle_reset
+
+    @property
+    def can_toggle_boot0(self):
+        """Tell if the boot0 line can be toggled."""
+        return self.connection.can_toggle_boot0
+
+    @property
+    def baud_rate(self):
+        """Get baud rate."""
+        return self.connection.baud_rate
+
+    async def connect(self):
+        """Connect to the serial port and start collecting received bytes."""
+        if self.connection.serial_connection is None:
+            self.connection.connect()
+        serial_connection = self.connection.serial_connection
+        # the reader callback must never block
+        serial_connection.timeout = 0
+        self._loop = asyncio.get_event_loop()
+        self._data_received = asyncio.Event()
+        self._loop.add_reader(serial_connection.fileno(), self._on_readable)
+
+    def close(self):
+        """Stop collecting received bytes and close the serial port."""
+        serial_connection = self.connection.serial_connection
+        self._loop.remove_reader(serial_connection.fileno())
+        serial_connection.close()
+
+    async def read(self, size=1):
+        """
+        Return size received bytes, or fewer if timeout passes first.
+
+        Like pyserial, return what was received so far on timeout
+        instead of raising an exception.
+        """
+        deadline = self._loop.time() + self.timeout
+        while len(self._buffer) < size:
+            self._data_received.clear()
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._data_received.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def write(self, data):
+        """Write the given data to the serial port."""
+        return self.connection.serial_connection.write(data)
+
+    def clear_input_buffer(self):
+        """Discard all received bytes."""
+        self.connection.clear_input_buffer()
+        del self._buffer[:]
+
+    def enable_reset(self, enable=True):
+        """Enable or disable the reset IO line."""
+        self.connection.enable_reset(enable)
+
+    def enable_boot0(self, enable=True):
+        """Enable or disable the boot0 IO line."""
+        self.connection.enable_boot0(enable)
+
+    def _on_readable(self):
+        serial_connection = self.connection.serial_connection
+        data = serial_connection.read(serial_connection.in_waiting or 1)
+        if data:
+            self._buffer.extend(data)
+            self._data_received.set()
+
+
+class AsyncStm32Bootloader:
+    """
+    Asynchronous variant of Stm32Bootloader.
+
+    Offers the same commands as coroutines.  Frame encoding and the
+    protocol constants are shared with Stm32Bootloader.
+    """
+
+    # frame encoding is borrowed from Stm32Bootloader
+    # pylint: disable=protected-access
+
+    Command = Stm32Bootloader.Command
+    Reply = Stm32Bootloader.Reply
+
+    DATA_TRANSFER_SIZE = Stm32Bootloader.DATA_TRANSFER_SIZE
+    ERASED_CHUNK = Stm32Bootloader.ERASED_CHUNK
+    ERASE_TIMEOUT = Stm32Bootloader.ERASE_TIMEOUT
+    RESET_HOLD_TIME = Stm32Bootloader.RESET_HOLD_TIME
+    SYNC_PROBE_INTERVAL = Stm32Bootloader.SYNC_PROBE_INTERVAL
+    SYNC_PROBE_INTERVAL_MAX = Stm32Bootloader.SYNC_PROBE_INTERVAL_MAX
+    SYNC_TIMEOUT = Stm32Bootloader.SYNC_TIMEOUT
+
+    def __init__(self, connection, verbosity=5):
+        """
+        Construct the AsyncStm32Bootloader object.
+
+        :param connection: Object with a read() coroutine, a write()
+          method and a timeout attribute, such as AsyncSerialConnection.
+          Reset and boot0 are toggled if it advertises can_toggle_reset
+          and can_toggle_boot0.
+        :param int verbosity: Verbosity level. 0 is quiet, 10 is verbose.
+        """
+        self.connection = connection
+        self._toggle_reset = getattr(connection, "can_toggle_reset", False)
+        self._toggle_boot0 = getattr(connection, "can_toggle_boot0", False)
+        self.verbosity = verbosity
+        self.extended_erase = False
+        # command codes reported by get()
+        self.available_commands = bytearray()
+        self.reset_hold_time = self.RESET_HOLD_TIME
+        # encodes frames and keeps the page layout and the erased ranges,
+        # never talks to the connection
+        self._encoder = Stm32Bootloader(connection=None)
+
+    @property
+    def device(self):
+        """DeviceDescriptor of the chip, see Stm32Bootloader.device."""
+        return self._encoder.device
+
+    @device.setter
+    def device(self, device):
+        self._encoder.device = device
+
+    @property
+    def device_family(self):
+        """Device family such as "F4", see Stm32Bootloader.device_family."""
+        return self._encoder.device_family
+
+    @device_family.setter
+    def device_family(self, family):
+        self._encoder.device_family = family
+
+    @property
+    def erased_ranges(self):
+        """Address ranges erased in this session, see Stm32Bootloader."""
+        return self._encoder.erased_ranges
+
+    def debug(self, level, message):
+        """Print the given message if its level is low enough."""
+        if self.verbosity >= level:
+            print(message, file=sys.stderr)
+
+    def write(self, *data):
+        """Write the given data to the MCU, in a single write call."""
+        message = bytearray()
+        for data_bytes in data:
+            if isinstance(data_bytes, int):
+                message.append(data_bytes)
+            else:
+                message.extend(data_bytes)
+        self.connection.write(message)
+
+    async def write_and_ack(self, message, *data):
+        """Write data to the MCU and wait until it replies with ACK."""
+        self.write(*data)
+        return await self._wait_for_ack(message)
+
+    async def reset_from_system_memory(self):
+        """Reset the MCU with boot0 enabled to enter the bootloader."""
+        self._enable_boot0(True)
+        await self._reset()
+        self.connection.clear_input_buffer()
+        return await self._synchronize()
+
+    async def reset_from_flash(self):
+        """Reset the MCU with boot0 disabled."""
+        self._enable_boot0(False)
+        await self._reset()
+
+    async def command(self, command, description):
+        """
+        Send the given command to the MCU.
+
+        Raise CommandError if there's no ACK replied.
+        """
+        self.debug(10, "*** Command: %s" % description)
+        ack_received = await self.write_and_ack("Command", command, command ^ 0xFF)
+        if not ack_received:
+            raise CommandError("%s (%s) failed: no ack" % (description, command))
+
+    async def get(self):
+        """Return the bootloader version and remember supported commands."""
+        await self.command(self.Command.GET, "Get")
+        length, version = await self._read_exactly(2)
+        self.debug(10, "    Bootloader version: " + hex(version))
+        data = await self._read_exactly(length)
+        self.available_commands = data
+        if self.Command.EXTENDED_ERASE in data:
+            self.extended_erase = True
+        await self._wait_for_ack("0x00 end")
+        return version
+
+    async def get_version(self):
+        """Return the bootloader version."""
+        await self.command(self.Command.GET_VERSION, "Get version")
+        version, _option_byte1, _option_byte2 = await self._read_exactly(3)
+        await self._wait_for_ack("0x01 end")
+        return version
+
+    async def get_id(self):
+        """Send the 'Get ID' command and return the device (model) ID."""
+        await self.command(self.Command.GET_ID, "Get ID")
+        length = (await self._read_exactly(1))[0]
+        id_data = await self._read_exactly(length + 1)
+        await self._wait_for_ack("0x02 end")
+        return reduce(lambda x, y: x * 0x100 + y, id_data)
+
+    async def read_memory(self, address, length):
+        """
+        Return the memory contents of flash at the given address.
+
+        Supports maximum 256 bytes.
+        """
+        if length > self.DATA_TRANSFER_SIZE:
+            raise DataLengthError("Can not read more than 256 bytes at once.")
+        await self.command(self.Command.READ_MEMORY, "Read memory")
+        await self.write_and_ack("0x11 address failed", Stm32Bootloader._encode_address(address))
+        nr_of_bytes = (length - 1) & 0xFF
+        await self.write_and_ack("0x11 length failed", nr_of_bytes, nr_of_bytes ^ 0xFF)
+        return await self._read_exactly(length)
+
+    async def go(self, address):
+        """Send the 'Go' command to start execution of firmware."""
+        # pylint: disable=invalid-name
+        await self.command(self.Command.GO, "Go")
+        await self.write_and_ack("0x21 go failed", Stm32Bootloader._encode_address(address))
+
+    async def write_memory(self, address, data, frame=None):
+        """
+        Write the given data to flash at the given address.
+
+        Supports maximum 256 bytes.
+
+        :param frame: The data frame, if it was encoded in advance with
+          Stm32Bootloader.encode_data_frames().
+        """
+        if not data:
+            return
+        if len(data) > self.DATA_TRANSFER_SIZE:
+            raise DataLengthError("Can not write more than 256 bytes at once.")
+        await self.command(self.Command.WRITE_MEMORY, "Write memory")
+        await self.write_and_ack("0x31 address failed", Stm32Bootloader._encode_address(address))
+        if frame is None:
+            frame = self._encoder._encode_data_frame(data)
+        await self.write_and_ack("0x31 programming failed", frame)
+
+    async def erase_memory(self, pages=None):
+        """
+        Erase flash memory at the given pages.
+
+        :param iterable pages: Iterable of integer page addresses, zero-based.
+          Set to None to trigger global mass erase.
+        """
+        if self.extended_erase:
+            await self.extended_erase_memory(pages)
+            return
+
+        # see Stm32Bootloader.erase_memory(): check before the command
+        if pages and (len(pages) > 255 or max(pages) > 255):
+            raise PageIndexError("Can not erase more than 255 pages at once, or pages above 255.")
+        await self.command(self.Command.ERASE, "Erase memory")
+        if pages:
+            page_count = (len(pages) - 1) & 0xFF
+            self.write(
+                self._encoder._encode_frame(struct.pack("B", page_count), bytearray(pages))
+            )
+        else:
+            # global erase: n=255 (page count)
+            self.write(255, 0)
+        await self._wait_for_erase("0x43 erase failed", pages)
+
+    async def extended_erase_memory(self, pages=None):
+        """
+        Erase flash memory using two-byte addressing at the given pages.
+
+        :param iterable pages: Iterable of integer page addresses, zero-based.
+          Set to None to trigger global mass erase.
+        """
+        if pages and len(pages) > 65535:
+            raise PageIndexError("Can not erase more than 65535 pages at once.")
+        await self.command(self.Command.EXTENDED_ERASE, "Extended erase memory")
+        if pages:
+            page_bytes = struct.pack(">%dH" % len(pages), *pages)
+            self.write(self._encoder._encode_frame(struct.pack(">H", len(pages) - 1), page_bytes))
+        else:
+            # global mass erase: n=0xffff (page count) + checksum
+            self.write(b"\xff\xff\x00")
+        await self._wait_for_erase("0x44 erasing failed", pages)
+
+    async def read_memory_data(self, address, length):
+        """
+        Return flash content from the given address and byte count.
+
+        Length may be more than 256 bytes.
+        """
+        data = bytearray(length)
+        chunk_count = int(math.ceil(length / float(self.DATA_TRANSFER_SIZE)))
+        self.debug(5, "Read %d chunks at address 0x%X..." % (chunk_count, address))
+        for offset in range(0, length, self.DATA_TRANSFER_SIZE):
+            read_length = min(length - offset, self.DATA_TRANSFER_SIZE)
+            chunk = await self.read_memory(address + offset, read_length)
+            data[offset : offset + read_length] = chunk
+        return data
+
+    async def write_memory_data(
+        self, address, data, skip_blank=None, progress_callback=None, frames=None
+    ):
+        """
+        Write the given data to flash; length may be more than 256 bytes.
+
+        See Stm32Bootloader.write_memory_data().
+
+        :return int: Number of skipped chunks.
+        """
+        length = len(data)
+        trimmed_length = len(bytearray(data).rstrip(b"\xff"))
+        trailing_range = (address + trimmed_length, length - trimmed_length)
+        if skip_blank or (skip_blank is None and self._encoder.is_erased(*trailing_range)):
+            length = trimmed_length
+        skipped_count = 0
+        # there's no start offset: each chunk starts at a multiple of 256 in
+        # data, so frames are indexed by chunk even after skipped chunks
+        for offset in range(0, length, self.DATA_TRANSFER_SIZE):
+            chunk = data[offset : min(offset + self.DATA_TRANSFER_SIZE, length)]
+            erased = skip_blank
+            if skip_blank is None:
+                erased = self._encoder.is_erased(address + offset, len(chunk))
+            if erased and chunk == self.ERASED_CHUNK[: len(chunk)]:
+                skipped_count += 1
+            else:
+                frame = frames[offset // self.DATA_TRANSFER_SIZE] if frames else None
+                await self.write_memory(address + offset, chunk, frame)
+            if progress_callback:
+                progress_callback(offset + len(chunk))
+        return skipped_count
+
+    async def _reset(self):
+        """Enable or disable the reset IO line (if possible)."""
+        if not self._toggle_reset:
+            return
+        self.connection.enable_reset(True)
+        await asyncio.sleep(self.reset_hold_time)
+        self.connection.enable_reset(False)
+
+    async def _synchronize(self):
+        """
+        Send the synchronization byte until the bootloader replies.
+
+        See Stm32Bootloader._synchronize().
+        """
+        previous_timeout_value = self.connection.timeout
+        clock = asyncio.get_event_loop().time
+        deadline = clock() + self.SYNC_TIMEOUT
+        interval = self.SYNC_PROBE_INTERVAL
+        sent_count = 0
+        try:
+            while True:
+                self.connection.timeout = min(interval, max(deadline - clock(), 0))
+                self.write(self.Command.SYNCHRONIZE)
+                sent_count += 1
+                reply = await self.connection.read()
+                if reply and reply[0] in (self.Reply.ACK, self.Reply.NACK):
+                    break
+                if clock() >= deadline:
+                    raise CommandError("Can't read port or timeout")
+                interval = min(interval * 2, self.SYNC_PROBE_INTERVAL_MAX)
+            if sent_count > 1:
+                # absorb the late replies to the other synchronization bytes
+                self.connection.timeout = interval
+                await self.connection.read(sent_count)
+                self.connection.clear_input_buffer()
+                await self._pair_synchronization_bytes()
+        finally:
+            self.connection.timeout = previous_timeout_value
+        return 1
+
+    async def _pair_synchronization_bytes(self):
+        """Send synchronization bytes until one completes a code (NACK)."""
+        for _attempt in range(2):
+            self.write(self.Command.SYNCHRONIZE)
+            if await self.connection.read():
+                return
+        raise CommandError("Can't read port or timeout")
+
+    def _enable_boot0(self, enable=True):
+        """Enable or disable the boot0 IO line (if possible)."""
+        if self._toggle_boot0:
+            self.connection.enable_boot0(enable)
+
+    async def _read_exactly(self, size):
+        """Return size bytes from the connection or raise CommandError."""
+        data = bytearray(await self.connection.read(size))
+        if len(data) != size:
+            raise CommandError("Can't read port or timeout")
+        return data
+
+    async def _wait_for_erase(self, info, pages):
+        """
+        Wait for the ACK of an erase, which takes much longer than other
+        replies, and record the erased pages.
+        """
+        previous_timeout_value = self.connection.timeout
+        self.connection.timeout = self.ERASE_TIMEOUT
+        try:
+            await self._wait_for_ack(info)
+        finally:
+            self.connection.timeout = previous_timeout_value
+        self._encoder._mark_erased(pages)
+
+    async def _wait_for_ack(self, info=""):
+        """Read a byte and raise CommandError if it's not ACK."""
+        reply = (await self._read_exactly(1))[0]
+        self.debug(10, "*** Read data: 0x%02X" % reply)
+        if reply == self.Reply.NACK:
+            raise CommandError("NACK " + info)
+        if reply != self.Reply.ACK:
+            # try to read additional byte in case it was just a input noise
+            read_data = await self.connection.read()
+            if not read_data or read_data[0] != self.Reply.ACK:
+                raise CommandError("Unknown response. " + info)
+        return 1
@@ -0,0 +1,111 @@
+# GitHub repository: https://github.com/florisla/stm32loader
+#
+# This file is part of stm32loader.
+#
+# stm32loader is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# stm32loader is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with stm32loader; see the file LICENSE.  If not see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Connection backends by name: the classes that connect to the MCU.
+
+Besides the built-in backends, installed packages can offer backends as
+entry points in the "stm32loader.backends" group, e.g.:
+
+    entry_points={"stm32loader.backends": ["ftdi = mypackage:FtdiConnection"]}
+
+A backend is constructed with the serial port, baud rate and parity and
+behaves like stm32loader.uart.SerialConnection.  Its module is imported
+only when the backend is selected, so that e.g. --help does not import
+pyserial.
+"""
+
+import importlib
+
+ENTRY_POINT_GROUP = "stm32loader.backends"
+
+DEFAULT_BACKEND = "serial"
+
+# backend name: (module name, class name)
+BUILTIN_BACKENDS = {
+    "serial": ("stm32loader.uart", "SerialConnection"),
+    "rpi": ("stm32loader.uart_gpios", "SerialConnectionRpi"),
+    "tinker": ("stm32loader.uart_gpios", "SerialConnectionRpi"),
+    "upboard": ("stm32loader.uart_gpios", "SerialConnectionUpboard"),
+    "gpiochip": ("stm32loader.uart_gpios", "SerialConnectionGpiochip"),
+}
+
+
+class BackendError(Exception):
+    """
+    Exception: a connection backend is unknown or can not be used.
+
+    Not a Stm32LoaderError, so that selecting a backend does not import
+    the bootloader protocol module.
+    """
+
+
+def backend_names():
+    """Return the names of the built-in and installed backends."""
+    return sorted(set(BUILTIN_BACKENDS) | set(_entry_points()))
+
+
+def get_backend(name):
+    """
+    Import and return the connection class of the backend.
+
+    :raise BackendError: If the backend is unknown or its module (or a
+      module that it needs) can not be imported.
+    """
+    try:
+        if name in BUILTIN_BACKENDS:
+            module_name, class_name = BUILTIN_BACKENDS[name]
+            return getattr(importlib.import_module(module_name), class_name)
+        entry_point = _entry_points().get(name)
+        if entry_point is None:
+            raise BackendError(
+                "Unknown connection backend '%s'; choose from: %s"
+                % (name, ", ".join(backend_names()))
+            )
+        return entry_point.load()
+    except ImportError as e:
+        raise BackendError("Can not use connection backend '%s': %s" % (name, e))
+
+
+def create_connection(name, serial_port, baud_rate, parity):
+    """Return a new connection (not yet connected) of the backend."""
+    return get_backend(name)(serial_port, baud_rate, parity)
+
+
+def _entry_points():
+    """Return the entry points in ENTRY_POINT_GROUP by name."""
+    try:
+        from importlib import metadata
+    except ImportError:
+        # Python < 3.8
+        try:
+            import pkg_resources
+        except ImportError:
+            return {}
+        return dict(
+            (entry_point.name, entry_point)
+            for entry_point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)
+        )
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        group = entry_points.select(group=ENTRY_POINT_GROUP)
+    else:
+        # Python < 3.10
+        group = entry_points.get(ENTRY_POINT_GROUP, [])
+    return dict((entry_point.name, entry_point) for entry_point in group)
@@ -0,0 +1,219 @@
+# GitHub repository: https://github.com/florisla/stm32loader
+#
+# This file is part of stm32loader.
+#
+# stm32loader is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# stm32loader is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with stm32loader; see the file LICENSE.  If not see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Measure the throughput of bootloader operations on a simulated link.
+
+Each operation runs against a BootloaderSimulator.  The time on the
+link (transfers, bootloader latency, programming and erasing) comes
+from the simulator's clock; the host overhead is the CPU time spent in
+stm32loader itself.  Their sum is what a real session would take.
+
+    $ python -m stm32loader.benchmark --baud 115200 --output results.json
+
+Requires Python 3.
+"""
+
+import contextlib
+import getopt
+import json
+import os
+import platform
+import sys
+import time
+
+from . import __version__
+from .bootloader import Stm32Bootloader
+from .simulator import BootloaderSimulator, SimulatedConnection
+
+SIZES = [16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 2048 * 1024]
+OPERATIONS = ["erase", "write", "read", "verify", "session"]
+
+FLASH = Stm32Bootloader.FLASH_START_ADDRESS
+
+
+class _MeteredConnection(SimulatedConnection):
+    """SimulatedConnection that counts frames and the simulator's CPU time."""
+
+    def __init__(self, simulator):
+        SimulatedConnection.__init__(self, simulator)
+        self.frames = 0
+        self.simulator_time = 0.0
+
+    def write(self, data):
+        self.frames += 1
+        start_time = time.process_time()
+        SimulatedConnection.write(self, data)
+        self.simulator_time += time.process_time() - start_time
+
+
+def image(size):
+    """Return size bytes of test data without blank (all 0xFF) chunks."""
+    pattern = bytes(bytearray((index * 7 + index // 256) & 0xFF for index in range(65536)))
+    return bytearray((pattern * (size // len(pattern) + 1))[:size])
+
+
+def run_benchmark(operation, size, baud_rate=115200, latency=0.0001, checksum=False):
+    """
+    Run one operation on size bytes and return its measurements.
+
+    :param str operation: One of OPERATIONS; 'session' is -e -w -v.
+    :param int size: Image size in bytes.
+    :param int baud_rate: Simulated baud rate.
+    :param float latency: Reply latency of the bootloader, in seconds.
+    :param bool checksum: Offer Get Checksum, so verify needs no read back.
+    :return dict: Measurements; times in seconds.
+    """
+    simulator = BootloaderSimulator(
+        family=None,
+        flash_size=max(size, 64 * 1024),
+        baud_rate=baud_rate,
+        extended_erase=True,
+        get_checksum=checksum,
+    )
+    simulator.response_time = latency
+    connection = _MeteredConnection(simulator)
+    stm32 = Stm32Bootloader(connection, verbosity=0)
+    stm32.reset_from_system_memory()
+    stm32.get()
+    data = image(size)
+    if operation in ("read", "verify"):
+        simulator.flash[:size] = data
+    pages = [index for index, (offset, _size) in enumerate(simulator.pages) if offset < size]
+
+    connection.frames = 0
+    connection.simulator_time = 0.0
+    start_clock = simulator.clock
+    start_time = time.process_time()
+    # the bootloader reports progress on stdout
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if operation == "erase":
+            stm32.erase_pages(pages)
+        elif operation == "write":
+            stm32.write_memory_data(FLASH, data)
+        elif operation == "read":
+            stm32.read_memory_data(FLASH, size)
+        elif operation == "verify":
+            stm32.verify_memory_data(FLASH, data)
+        elif operation == "session":
+            stm32.reset_from_system_memory()
+            stm32.get()
+            stm32.get_id()
+            stm32.erase_pages(pages)
+            stm32.write_memory_data(FLASH, data)
+            stm32.verify_memory_data(FLASH, data)
+        else:
+            raise ValueError("Unknown operation: %s" % operation)
+    host_time = time.process_time() - start_time - connection.simulator_time
+    link_time = simulator.clock - start_clock
+
+    total_time = link_time + host_time
+    # the image itself crosses the link once per write, read or verify
+    wire_time = size * Stm32Bootloader.BITS_PER_BYTE / float(baud_rate)
+    if operation == "session":
+        wire_time *= 1 if checksum else 2
+    elif operation == "erase" or (operation == "verify" and checksum):
+        wire_time = None
+    return {
+        "operation": operation,
+        "size": size,
+        "frames": connection.frames,
+        "link_time": link_time,
+        "host_time": host_time,
+        "total_time": total_time,
+        "bytes_per_second": size / total_time,
+        "frames_per_second": connection.frames / total_time,
+        "host_time_per_frame": host_time / connection.frames,
+        "wire_speed_percent": 100 * wire_time / total_time if wire_time else None,
+    }
+
+
+def run_suite(sizes=None, operations=None, baud_rate=115200, latency=0.0001, checksum=False):
+    """Run all operations for all sizes; return the results with the setup."""
+    results = [
+        run_benchmark(operation, size, baud_rate, latency, checksum)
+        for size in sizes or SIZES
+        for operation in operations or OPERATIONS
+    ]
+    return {
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "baud_rate": baud_rate,
+        "latency": latency,
+        "checksum": checksum,
+        "results": results,
+    }
+
+
+def format_table(suite):
+    """Return the results as a readable table."""
+    lines = [
+        "%-8s %8s %7s %9s %9s %10s %9s %10s %6s"
+        % ("op", "KiB", "frames", "link s", "host s", "B/s", "frames/s", "us/frame", "wire%")
+    ]
+    for result in suite["results"]:
+        wire_speed = result["wire_speed_percent"]
+        lines.append(
+            "%-8s %8d %7d %9.3f %9.3f %10.0f %9.0f %10.1f %6s"
+            % (
+                result["operation"],
+                result["size"] // 1024,
+                result["frames"],
+                result["link_time"],
+                result["host_time"],
+                result["bytes_per_second"],
+                result["frames_per_second"],
+                result["host_time_per_frame"] * 1e6,
+                "-" if wire_speed is None else "%.1f" % wire_speed,
+            )
+        )
+    return "\n".join(lines)
+
+
+def main(*args):
+    """Run the benchmarks, print a table and optionally save JSON."""
+    options, _arguments = getopt.getopt(
+        args, "", ["baud=", "latency=", "sizes=", "operations=", "checksum", "output="]
+    )
+    settings = {}
+    output = None
+    for option, value in options:
+        if option == "--baud":
+            settings["baud_rate"] = int(value)
+        elif option == "--latency":
+            # in milliseconds
+            settings["latency"] = float(value) / 1000
+        elif option == "--sizes":
+            # in KiB
+            settings["sizes"] = [int(size) * 1024 for size in value.split(",")]
+        elif option == "--operations":
+            settings["operations"] = value.split(",")
+        elif option == "--checksum":
+            settings["checksum"] = True
+        elif option == "--output":
+            output = value
+    suite = run_suite(**settings)
+    print(format_table(suite))
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(suite, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -22,6 +22,7 @@
 
 from __future__ import print_function
 
+import binascii
 import math
 import operator
 import struct
@@ -29,6 +30,9 @@ import sys
 import time
 from functools import reduce
 
+# monotonic clock for latency measurements; not available in Python 2
+_clock = getattr(time, "monotonic", time.time)
+
 CHIP_IDS = {
     # see ST AN2606 Table 116 Bootloader device-dependent parameters
     # 16 to 32 KiB
@@ -60,6 +64,35 @@ CHIP_IDS = {
     0x801: "Wiznet W7500",
 }
 
+
+def _reverse_bits(value, width):
+    """Return the value with its lowest width bits in reverse order."""
+    return int("{:0{width}b}".format(value, width=width)[::-1], 2)
+
+
+_BIT_REVERSE_TABLE = bytes(bytearray(_reverse_bits(byte, 8) for byte in range(256)))
+# maps each nonzero byte to 1
+_NONZERO_TABLE = bytes(bytearray([0] + [1] * 255))
+# numpy module, False if it is not installed, None if not tried yet
+_numpy = None
+
+
+def _xor(data, other):
+    """Return the bytewise XOR of two byte strings of equal length."""
+    global _numpy  # pylint: disable=global-statement
+    if _numpy is None:
+        try:
+            import numpy as _numpy  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            _numpy = False
+    if _numpy:
+        return (
+            _numpy.frombuffer(data, _numpy.uint8) ^ _numpy.frombuffer(other, _numpy.uint8)
+        ).tobytes()
+    value = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(other), 16)
+    return binascii.unhexlify("%0*x" % (2 * len(data), value))
+
+
 class Stm32LoaderError(Exception):
     """Generic exception type for errors occurring in stm32loader."""
 
@@ -79,6 +112,65 @@ class DataLengthError(Stm32LoaderError, ValueError):
 class DataMismatchError(Stm32LoaderError):
     """Exception: data comparison failed."""
 
+    def __init__(self, message, mismatches=None):
+        """
+        Construct a DataMismatchError.
+
+        :param str message: Error message.
+        :param list mismatches: MismatchRanges of the differing data;
+          empty if the data lengths differ.
+        """
+        super(DataMismatchError, self).__init__(message)
+        self.mismatches = mismatches or []
+
+
+class MismatchRange(object):
+    """Range of data that differs from its reference."""
+
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ["offset", "length", "count"]
+
+    def __init__(self, offset, length, count):
+        """
+        Construct a MismatchRange.
+
+        :param int offset: Offset (or address) of the first differing byte.
+        :param int length: Byte count from the first to the last
+          differing byte.
+        :param int count: Number of differing bytes in the range.
+        """
+        self.offset = offset
+        self.length = length
+        self.count = count
+
+    def __repr__(self):
+        return "MismatchRange(0x%X, %d, %d)" % (self.offset, self.length, self.count)
+
+    def __eq__(self, other):
+        return isinstance(other, MismatchRange) and (
+            (self.offset, self.length, self.count) == (other.offset, other.length, other.count)
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def format_mismatches(mismatches, limit=8):
+    """Summarize the MismatchRanges, with a line per range up to limit."""
+    differing = sum(mismatch.count for mismatch in mismatches)
+    lines = ["%d bytes differ in %d ranges" % (differing, len(mismatches))]
+    for mismatch in mismatches[:limit]:
+        end = mismatch.offset + mismatch.length - 1
+        lines.append(
+            "  0x%08X-0x%08X: %d of %d bytes"
+            % (mismatch.offset, end, mismatch.count, mismatch.length)
+        )
+    if len(mismatches) > limit:
+        lines.append("  ... and %d more ranges" % (len(mismatches) - limit))
+    return "\n".join(lines)
+
+
 class Stm32Bootloader:
     """Talk to the STM32 native bootloader."""
 
@@ -104,6 +196,8 @@ class Stm32Bootloader:
         EXTENDED_ERASE = 0x44
         WRITE_PROTECT = 0x63
         WRITE_UNPROTECT = 0x73
+        # bootloader v3.x and up only
+        GET_CHECKSUM = 0xA1
 
         # not used so far
         READOUT_PROTECT = 0x82
@@ -157,9 +251,65 @@ class Stm32Bootloader:
         "F7": 0x1FF0F442,
     }
 
+    FLASH_START_ADDRESS = 0x08000000
     DATA_TRANSFER_SIZE = 256  # bytes
     FLASH_PAGE_SIZE = 1024  # bytes
 
+    FLASH_SECTOR_SIZES = {
+        # families with non-uniform flash sectors instead of pages (KiB)
+        # ST RM0033 section 2.3.3 Embedded flash memory
+        "F2": [16] * 4 + [64] + [128] * 7,
+        # ST RM0090 section 3.3 Embedded flash memory organization
+        # second bank of the 2 MiB parts included
+        "F4": ([16] * 4 + [64] + [128] * 7) * 2,
+        # ST RM0410 section 3.3.1 Flash memory organization (single bank)
+        "F7": [32] * 4 + [128] + [256] * 7,
+    }
+
+    # page count N+1 is sent as N; N=0xFF is global erase
+    MAX_ERASE_PAGES = 0xFF
+    # N=0xFFF0 up to 0xFFFF are special erase commands
+    MAX_EXTENDED_ERASE_PAGES = 0xFFF0
+
+    # adaptive timeouts: a few ms plus a multiple of the measured ACK latency,
+    # plus the transfer time of the data at the current baud rate
+    ACK_TIMEOUT_MARGIN = 0.01  # seconds
+    ACK_LATENCY_FACTOR = 4
+    LATENCY_SAMPLE_COUNT = 8
+    BITS_PER_BYTE = 11  # start bit, 8 data bits, parity bit, stop bit
+    # worst-case time to program one chunk of DATA_TRANSFER_SIZE bytes
+    WRITE_CHUNK_TIME = 0.05  # seconds
+    # worst-case rate of the on-chip checksum calculation
+    CHECKSUM_BYTES_PER_SECOND = 1000000
+    # timeout for erase, mass erase and option byte programming
+    ERASE_TIMEOUT = 30  # seconds
+
+    # time to keep the MCU in reset
+    RESET_HOLD_TIME = 0.1  # seconds
+    # after reset, the synchronization byte is sent until the bootloader
+    # replies; the wait for a reply starts at SYNC_PROBE_INTERVAL and
+    # doubles up to SYNC_PROBE_INTERVAL_MAX, for SYNC_TIMEOUT in total
+    SYNC_PROBE_INTERVAL = 0.02  # seconds
+    SYNC_PROBE_INTERVAL_MAX = 0.32  # seconds
+    SYNC_TIMEOUT = 1  # seconds
+    # time to wait for each reply when probing for an active bootloader
+    PROBE_TIMEOUT = 0.05  # seconds
+    # chunks read back by check_memory_data() without Get Checksum
+    CHECK_SAMPLE_COUNT = 4
+    # find_mismatches() compares chunks of this size, and joins
+    # differences that are less than MISMATCH_GAP bytes apart
+    MISMATCH_CHUNK_SIZE = 4096  # bytes
+    MISMATCH_GAP = 16  # bytes
+
+    # STM32 CRC peripheral defaults, used by the Get Checksum command
+    CRC_POLYNOMIAL = 0x04C11DB7
+    CRC_INITIAL_VALUE = 0xFFFFFFFF
+
+    # flash memory value after erase
+    ERASED_CHUNK = b"\xff" * DATA_TRANSFER_SIZE
+    # erased range of a global erase: the whole 32-bit address space
+    GLOBAL_ERASE_RANGE = (0, 1 << 32)
+
     def __init__(self, connection, verbosity=5, show_progress=False):
         """
         Construct the Stm32Bootloader object.
@@ -184,13 +334,57 @@ class Stm32Bootloader:
         self.verbosity = verbosity
         self.show_progress = show_progress
         self.extended_erase = False
+        # bootloader version reported by get(), or set by set_capabilities()
+        self.bootloader_version = None
+        # reused by _encode_frame() for every frame sent
+        self._frame_buffer = bytearray(self.DATA_TRANSFER_SIZE + 2)
+        # command codes reported by get()
+        self.available_commands = bytearray()
+        # device family such as "F4"; selects the flash sector layout
+        self.device_family = None
+        # stm32loader.devices.DeviceDescriptor of the chip, if known; its
+        # flash layout and registers take precedence over device_family
+        self.device = None
+        # sorted (start, end) address ranges that were erased in this
+        # session; write_memory_data() skips blank chunks inside them
+        self.erased_ranges = []
+        # retry a failed data chunk this many times; link_recovery, if set,
+        # is called with the error before each retry to restore the link
+        self.chunk_retries = 0
+        self.link_recovery = None
+        # number of data chunks transferred, including retries
+        self.chunk_transfers = 0
+        # derive per-command timeouts from the measured ACK latency
+        self.adaptive_timeouts = False
+        self._latency_samples = []
+        self._timeout = None
+        # connection timeout before the first adaptive one; replies that
+        # miss the adaptive timeout are waited for this long
+        self._default_timeout = None
+        # number of replies that came after the adaptive timeout
+        self.late_replies = 0
+        self.reset_hold_time = self.RESET_HOLD_TIME
+        # called instead of drawing the progress bar, if set
+        self.progress_reporter = None
+        # called instead of printing status messages, if set
+        self.message_reporter = None
+        # stm32loader.trace.CommandTrace that records command timing, if set
+        self.trace = None
 
     def write(self, *data):
-        """Write the given data to the MCU."""
+        """Write the given data to the MCU, in a single write call."""
+        if len(data) == 1 and not isinstance(data[0], int):
+            self.connection.write(data[0])
+            return
+        if not data:
+            return
+        message = bytearray()
         for data_bytes in data:
             if isinstance(data_bytes, int):
-                data_bytes = struct.pack("B", data_bytes)
-            self.connection.write(data_bytes)
+                message.append(data_bytes)
+            else:
+                message.extend(data_bytes)
+        self.connection.write(message)
 
     def write_and_ack(self, message, *data):
         """Write data to the MCU and wait until it replies with ACK."""
@@ -204,19 +398,47 @@ class Stm32Bootloader:
         if self.verbosity >= level:
             print(message, file=sys.stderr)
 
+    def report(self, message):
+        """Print a status message, or pass it to message_reporter if set."""
+        if self.message_reporter:
+            self.message_reporter(message)
+            return
+        print(message)
+
     def reset_from_system_memory(self):
         """Reset the MCU with boot0 enabled to enter the bootloader."""
-        self._enable_boot0(True)
-        # time.sleep(0.05)
-        self._reset()
+        self._reset(boot0=True)
+        self.connection.clear_input_buffer()
+        return self._synchronize()
+
+    def probe(self):
+        """
+        Return True if an already synchronized bootloader answers.
+
+        Send a Get command with a short timeout.  Anything but a complete
+        reply (silence, a NACK or output of the application) means that
+        the MCU needs to be reset into the bootloader.
+        """
+        previous_timeout_value = self.connection.timeout
+        adaptive_timeouts = self.adaptive_timeouts
+        # a failed probe is not an ACK latency sample
+        self.adaptive_timeouts = False
+        self.connection.timeout = self.PROBE_TIMEOUT
         self.connection.clear_input_buffer()
-        return self.write_and_ack("Synchro", self.Command.SYNCHRONIZE)
+        try:
+            self.get()
+        except (CommandError, IndexError):
+            self.connection.clear_input_buffer()
+            return False
+        finally:
+            self.connection.timeout = previous_timeout_value
+            self.adaptive_timeouts = adaptive_timeouts
+        self.debug(10, "*** Bootloader is active")
+        return True
 
     def reset_from_flash(self):
         """Reset the MCU with boot0 disabled."""
-        self._enable_boot0(False)
-        time.sleep(0.05)
-        self._reset()
+        self._reset(boot0=False)
 
     def command(self, command, description):
         """
@@ -225,23 +447,42 @@ class Stm32Bootloader:
         Raise CommandError if there's no ACK replied.
         """
         self.debug(10, "*** Command: %s" % description)
-        ack_received = self.write_and_ack("Command", command, command ^ 0xFF)
+        if self.trace is not None:
+            self.trace.begin(command, description)
+        if not self.adaptive_timeouts:
+            ack_received = self.write_and_ack("Command", command, command ^ 0xFF)
+        else:
+            self._set_timeout(self._ack_timeout())
+            start_time = _clock()
+            ack_received = self.write_and_ack("Command", command, command ^ 0xFF)
+            if len(self._latency_samples) < self.LATENCY_SAMPLE_COUNT:
+                self._latency_samples.append(_clock() - start_time)
         if not ack_received:
             raise CommandError("%s (%s) failed: no ack" % (description, command))
 
     def get(self):
         """Return the bootloader version and remember supported commands."""
         self.command(self.Command.GET, "Get")
-        length = bytearray(self.connection.read())[0]
-        version = bytearray(self.connection.read())[0]
+        length = self._read()[0]
+        version = self._read()[0]
         self.debug(10, "    Bootloader version: " + hex(version))
-        data = bytearray(self.connection.read(length))
-        if self.Command.EXTENDED_ERASE in data:
-            self.extended_erase = True
+        data = self._read(length)
         self.debug(10, "    Available commands: " + ", ".join(hex(b) for b in data))
         self._wait_for_ack("0x00 end")
+        self.set_capabilities(version, data)
         return version
 
+    def set_capabilities(self, version, commands):
+        """
+        Take the bootloader version and commands as if get() returned them.
+
+        Use this to skip the Get command when they are known already,
+        e.g. from an earlier session with the same type of chip.
+        """
+        self.bootloader_version = version
+        self.available_commands = bytearray(commands)
+        self.extended_erase = self.Command.EXTENDED_ERASE in self.available_commands
+
     def get_version(self):
         """
         Return the bootloader version.
@@ -249,7 +490,7 @@ class Stm32Bootloader:
         Read protection status readout is not yet implemented.
         """
         self.command(self.Command.GET_VERSION, "Get version")
-        data = bytearray(self.connection.read(3))
+        data = self._read(3)
         version = data[0]
         option_byte1 = data[1]
         option_byte2 = data[2]
@@ -262,28 +503,57 @@ class Stm32Bootloader:
     def get_id(self):
         """Send the 'Get ID' command and return the device (model) ID."""
         self.command(self.Command.GET_ID, "Get ID")
-        length = bytearray(self.connection.read())[0]
-        id_data = bytearray(self.connection.read(length + 1))
+        length = self._read()[0]
+        id_data = self._read(length + 1)
         self._wait_for_ack("0x02 end")
         _device_id = reduce(lambda x, y: x * 0x100 + y, id_data)
         return _device_id
 
     def get_flash_size(self, device_family):
-        """Return the MCU's flash size in bytes."""
-        flash_size_address = self.FLASH_SIZE_ADDRESS[device_family]
-        flash_size_bytes = self.read_memory(flash_size_address, 2)
-        flash_size = flash_size_bytes[0] + (flash_size_bytes[1]<<8)
-        return flash_size
-    
+        """Return the MCU's flash size in KiB."""
+        return self._read_flash_size(self.FLASH_SIZE_ADDRESS[device_family])
+
+    def _read_flash_size(self, address):
+        """Return the flash size (KiB) from the 16-bit register at address."""
+        flash_size_bytes = self.read_memory(address, 2)
+        return flash_size_bytes[0] + (flash_size_bytes[1] << 8)
+
     def get_flash_size_and_uid_f4(self):
-        data_start_addr = 0x1FFF7A00
-        flash_size_lsb_addr = 0x22
-        uid_lsb_addr = 0x10
-        data = self.read_memory(data_start_addr, self.DATA_TRANSFER_SIZE)
-        device_uid = data[uid_lsb_addr:uid_lsb_addr+12] 
-        flash_size = data[flash_size_lsb_addr] + data[flash_size_lsb_addr+1]<<8
-        return device_uid, flash_size
-        
+        """Return the UID and flash size (KiB) of an F4 device."""
+        return self.get_device_info("F4")
+
+    def get_device_info(self, device_family):
+        """
+        Return the device UID and flash size, read at once where possible.
+
+        If the UID and flash size registers of the family lie within
+        DATA_TRANSFER_SIZE bytes, a single Read Memory command covers both.
+
+        :param str device_family: Device family name such as "F1".
+        :return tuple: UID as returned by get_uid(), and flash size in KiB
+          or None if its address is unknown.
+        """
+        uid_address = self.UID_ADDRESS.get(device_family, self.UID_ADDRESS_UNKNOWN)
+        flash_size_address = self.FLASH_SIZE_ADDRESS.get(device_family)
+        if self.device is not None and self.device.family == device_family:
+            uid_address = self.device.uid_address or uid_address
+            flash_size_address = self.device.flash_size_address
+        if uid_address in (None, self.UID_ADDRESS_UNKNOWN) or flash_size_address is None:
+            flash_size = None
+            if flash_size_address is not None:
+                flash_size = self._read_flash_size(flash_size_address)
+            return self.get_uid(device_family), flash_size
+
+        start = min(uid_address, flash_size_address)
+        end = max(uid_address + 12, flash_size_address + 2)
+        if end - start > self.DATA_TRANSFER_SIZE:
+            return self.read_memory(uid_address, 12), self._read_flash_size(flash_size_address)
+        data = self.read_memory(start, end - start)
+        uid = data[uid_address - start : uid_address - start + 12]
+        flash_size_offset = flash_size_address - start
+        flash_size = data[flash_size_offset] + (data[flash_size_offset + 1] << 8)
+        return uid, flash_size
+
     def get_uid(self, device_id):
         """
         Send the 'Get UID' command and return the device UID.
@@ -319,32 +589,179 @@ class Stm32Bootloader:
         uid_string = "-".join("".join(format(b, "02X") for b in part) for part in swapped_data)
         return uid_string
 
+    def flash_pages(self, address, length):
+        """
+        Return the flash pages that overlap the given memory range.
+
+        With a device descriptor (see stm32loader.devices), its layout is
+        used.  Otherwise, families listed in FLASH_SECTOR_SIZES use their
+        sector layout.  Page sizes of other families differ per device, so
+        their layout is unknown without a descriptor.
+
+        :param int address: Start address of the range.
+        :param int length: Byte count of the range.
+        :return list: (page index, page address, page size) tuples.
+        :raise PageIndexError: If the range is not in flash or the page
+          layout is unknown, see page_layout_known.
+        """
+        if address < self.FLASH_START_ADDRESS:
+            raise PageIndexError("Address 0x%X is not in flash memory." % address)
+        if length <= 0:
+            return []
+        if self.device is not None:
+            try:
+                return self.device.flash_pages(address, length)
+            except ValueError as e:
+                raise PageIndexError(str(e))
+        end = address + length
+        sector_sizes = self.FLASH_SECTOR_SIZES.get(self.device_family)
+        if sector_sizes:
+            pages = []
+            page_address = self.FLASH_START_ADDRESS
+            for index, size_kib in enumerate(sector_sizes):
+                page_size = size_kib * 1024
+                if page_address + page_size > address and page_address < end:
+                    pages.append((index, page_address, page_size))
+                page_address += page_size
+            if page_address < end:
+                raise PageIndexError("Address 0x%X is beyond the last sector." % (end - 1))
+            return pages
+        raise PageIndexError(
+            "Flash page layout of family %s is unknown." % (self.device_family or "(none)")
+        )
+
+    @property
+    def page_layout_known(self):
+        """True if flash_pages() knows the page layout of the device."""
+        return self.device is not None or self.device_family in self.FLASH_SECTOR_SIZES
+
+    def is_erased(self, address, length):
+        """Return True if the memory range was erased in this session."""
+        end = address + length
+        return any(start <= address and end <= stop for start, stop in self.erased_ranges)
+
+    def _mark_erased(self, pages=None):
+        """
+        Add the address ranges of the erased pages to erased_ranges.
+
+        Set pages to None after a global erase.  Pages of an unknown page
+        layout are not recorded.
+        """
+        if not pages:
+            ranges = [self.GLOBAL_ERASE_RANGE]
+        elif self.page_layout_known:
+            if self.device is not None:
+                flash_size = self.device.flash_size
+            else:
+                flash_size = sum(self.FLASH_SECTOR_SIZES[self.device_family]) * 1024
+            pages = set(pages)
+            ranges = [
+                (page_address, page_address + page_size)
+                for index, page_address, page_size in self.flash_pages(
+                    self.FLASH_START_ADDRESS, flash_size
+                )
+                if index in pages
+            ]
+        else:
+            ranges = []
+        merged = []
+        for start, stop in sorted(self.erased_ranges + ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+            else:
+                merged.append((start, stop))
+        self.erased_ranges = merged
+
     def read_memory(self, address, length):
         """
         Return the memory contents of flash at the given address.
 
         Supports maximum 256 bytes.
         """
+        if length > self.DATA_TRANSFER_SIZE:
+            raise DataLengthError("Can not read more than 256 bytes at once.")
+        data = bytearray(length)
+        self.read_memory_into(address, data)
+        return data
+
+    def read_memory_into(self, address, buffer):
+        """
+        Read the memory contents of flash at the given address into buffer.
+
+        Reads len(buffer) bytes; supports maximum 256 bytes.
+
+        :param int address: Memory address to read from.
+        :param buffer: Writable buffer such as a bytearray or memoryview.
+        """
+        length = len(buffer)
         if length > self.DATA_TRANSFER_SIZE:
             raise DataLengthError("Can not read more than 256 bytes at once.")
         self.command(self.Command.READ_MEMORY, "Read memory")
+        if self.trace is not None:
+            self.trace.annotate(address, length)
         self.write_and_ack("0x11 address failed", self._encode_address(address))
         nr_of_bytes = (length - 1) & 0xFF
         checksum = nr_of_bytes ^ 0xFF
         self.write_and_ack("0x11 length failed", nr_of_bytes, checksum)
-        return bytearray(self.connection.read(length))
+        if self.adaptive_timeouts:
+            self._set_timeout(self._ack_timeout(length))
+        self._read_into(buffer)
+        if self.trace is not None:
+            self.trace.ack()
+
+    def get_checksum(self, address, length):
+        """
+        Return the CRC-32 of the memory contents, computed by the MCU.
+
+        Not all bootloaders support the Get Checksum command; see
+        available_commands.  The CRC matches the result of crc32().
+
+        :param int address: Start address, word-aligned.
+        :param int length: Byte count, a multiple of 4.
+        :return int: 32-bit CRC value.
+        """
+        if length % 4 != 0:
+            raise DataLengthError("Checksum length must be a multiple of 4 bytes.")
+        self.command(self.Command.GET_CHECKSUM, "Get checksum")
+        if self.trace is not None:
+            self.trace.annotate(address, length)
+        self.write_and_ack("0xA1 address failed", self._encode_address(address))
+        self.write_and_ack("0xA1 length failed", self._encode_address(length))
+        self.write_and_ack("0xA1 polynomial failed", self._encode_address(self.CRC_POLYNOMIAL))
+        self.write_and_ack(
+            "0xA1 initial value failed", self._encode_address(self.CRC_INITIAL_VALUE)
+        )
+        if self.adaptive_timeouts:
+            self._set_timeout(
+                self._ack_timeout(5, length / float(self.CHECKSUM_BYTES_PER_SECOND))
+            )
+        data = self._read(5)
+        if len(data) != 5:
+            raise CommandError("Can't read checksum or timeout")
+        if self.trace is not None:
+            self.trace.ack()
+        if reduce(operator.xor, data) != 0:
+            raise CommandError("0xA1 checksum reply corrupted")
+        crc = struct.unpack(">I", bytes(data[:4]))[0]
+        self.debug(10, "    Checksum at 0x%X: 0x%08X" % (address, crc))
+        return crc
 
     def go(self, address):
         """Send the 'Go' command to start execution of firmware."""
         # pylint: disable=invalid-name
         self.command(self.Command.GO, "Go")
+        if self.trace is not None:
+            self.trace.annotate(address)
         self.write_and_ack("0x21 go failed", self._encode_address(address))
 
-    def write_memory(self, address, data):
+    def write_memory(self, address, data, frame=None):
         """
         Write the given data to flash at the given address.
 
         Supports maximum 256 bytes.
+
+        :param frame: The data frame, if it was encoded in advance with
+          encode_data_frames().
         """
         nr_of_bytes = len(data)
         if nr_of_bytes == 0:
@@ -352,19 +769,16 @@ class Stm32Bootloader:
         if nr_of_bytes > self.DATA_TRANSFER_SIZE:
             raise DataLengthError("Can not write more than 256 bytes at once.")
         self.command(self.Command.WRITE_MEMORY, "Write memory")
+        if self.trace is not None:
+            self.trace.annotate(address, nr_of_bytes)
         self.write_and_ack("0x31 address failed", self._encode_address(address))
 
-        # pad data length to multiple of 4 bytes
-        if nr_of_bytes % 4 != 0:
-            padding_bytes = 4 - (nr_of_bytes % 4)
-            nr_of_bytes += padding_bytes
-            # append value 0xFF: flash memory value after erase
-            data = bytearray(data)
-            data.extend([0xFF] * padding_bytes)
-
-        self.debug(10, "    %s bytes to write" % [nr_of_bytes])
-        checksum = reduce(operator.xor, data, nr_of_bytes - 1)
-        self.write_and_ack("0x31 programming failed", nr_of_bytes - 1, data, checksum)
+        if frame is None:
+            frame = self._encode_data_frame(data)
+        self.debug(10, "    %s bytes to write" % [len(frame) - 2])
+        if self.adaptive_timeouts:
+            self._set_timeout(self._ack_timeout(len(frame), self.WRITE_CHUNK_TIME))
+        self.write_and_ack("0x31 programming failed", frame)
         self.debug(10, "    Write memory done")
 
     def erase_memory(self, pages=None):
@@ -380,23 +794,29 @@ class Stm32Bootloader:
             self.extended_erase_memory(pages)
             return
 
+        # check the pages before sending the command: once it is ACKed,
+        # the bootloader waits for the page list
+        if pages and len(pages) > 255:
+            raise PageIndexError(
+                "Can not erase more than 255 pages at once.\n"
+                "Set pages to None to do global erase or supply fewer pages."
+            )
+        if pages and max(pages) > 255:
+            raise PageIndexError("Can not erase page %d without extended erase." % max(pages))
+
         self.command(self.Command.ERASE, "Erase memory")
+        if self.trace is not None:
+            self.trace.annotate(size=len(pages) if pages else None)
         if pages:
             # page erase, see ST AN3155
-            if len(pages) > 255:
-                raise PageIndexError(
-                    "Can not erase more than 255 pages at once.\n"
-                    "Set pages to None to do global erase or supply fewer pages."
-                )
             page_count = (len(pages) - 1) & 0xFF
-            page_numbers = bytearray(pages)
-            checksum = reduce(operator.xor, page_numbers, page_count)
-            self.write(page_count, page_numbers, checksum)
+            self.write(self._encode_frame(struct.pack("B", page_count), bytearray(pages)))
         else:
             # global erase: n=255 (page count)
             self.write(255, 0)
 
-        self._wait_for_ack("0x43 erase failed")
+        self._wait_for_slow_ack("0x43 erase failed")
+        self._mark_erased(pages)
         self.debug(10, "    Erase memory done")
 
     def extended_erase_memory(self, pages=None):
@@ -410,55 +830,63 @@ class Stm32Bootloader:
         :param iterable pages: Iterable of integer page addresses, zero-based.
           Set to None to trigger global mass erase.
         """
+        if pages and len(pages) > 65535:
+            raise PageIndexError(
+                "Can not erase more than 65535 pages at once.\n"
+                "Set pages to None to do global erase or supply fewer pages."
+            )
+
         self.command(self.Command.EXTENDED_ERASE, "Extended erase memory")
+        if self.trace is not None:
+            self.trace.annotate(size=len(pages) if pages else None)
         if pages:
             # page erase, see ST AN3155
-            if len(pages) > 65535:
-                raise PageIndexError(
-                    "Can not erase more than 65535 pages at once.\n"
-                    "Set pages to None to do global erase or supply fewer pages."
-                )
-            page_count = (len(pages) & 0xFF) - 1
-            page_count_bytes = bytearray(struct.pack(">H", page_count))
-            page_bytes = bytearray(len(pages) * 2)
-            for i, page in enumerate(pages):
-                struct.pack_into(">H", page_bytes, i * 2, page)
-            checksum = reduce(operator.xor, page_count_bytes)
-            checksum = reduce(operator.xor, page_bytes, checksum)
-            self.write(page_count_bytes, page_bytes, checksum)
+            page_count = len(pages) - 1
+            page_bytes = struct.pack(">%dH" % len(pages), *pages)
+            self.write(self._encode_frame(struct.pack(">H", page_count), page_bytes))
         else:
             # global mass erase: n=0xffff (page count) + checksum
             # TO DO: support 0xfffe bank 1 erase / 0xfffD bank 2 erase
             self.write(b"\xff\xff\x00")
 
-        previous_timeout_value = self.connection.timeout
-        self.connection.timeout = 30
-        print("Extended erase (0x44), this can take ten seconds or more")
-        try:
-            self._wait_for_ack("0x44 erasing failed")
-        finally:
-            self.connection.timeout = previous_timeout_value
+        self.report("Extended erase (0x44), this can take ten seconds or more")
+        self._wait_for_slow_ack("0x44 erasing failed")
+        self._mark_erased(pages)
         self.debug(10, "    Extended Erase memory done")
 
+    def erase_pages(self, pages):
+        """
+        Erase the given flash pages, with as many erase commands as needed.
+
+        :param iterable pages: Iterable of integer page addresses, zero-based.
+        """
+        pages = list(pages)
+        if self.extended_erase:
+            batch_size = self.MAX_EXTENDED_ERASE_PAGES
+        else:
+            batch_size = self.MAX_ERASE_PAGES
+        for start in range(0, len(pages), batch_size):
+            self.erase_memory(pages[start : start + batch_size])
+
     def write_protect(self, pages):
         """Enable write protection on the given flash pages."""
         self.command(self.Command.WRITE_PROTECT, "Write protect")
         nr_of_pages = (len(pages) - 1) & 0xFF
-        page_numbers = bytearray(pages)
-        checksum = reduce(operator.xor, page_numbers, nr_of_pages)
-        self.write_and_ack("0x63 write protect failed", nr_of_pages, page_numbers, checksum)
+        frame = self._encode_frame(struct.pack("B", nr_of_pages), bytearray(pages))
+        self.write(frame)
+        self._wait_for_slow_ack("0x63 write protect failed")
         self.debug(10, "    Write protect done")
 
     def write_unprotect(self):
         """Disable write protection of the flash memory."""
         self.command(self.Command.WRITE_UNPROTECT, "Write unprotect")
-        self._wait_for_ack("0x73 write unprotect failed")
+        self._wait_for_slow_ack("0x73 write unprotect failed")
         self.debug(10, "    Write Unprotect done")
 
     def readout_protect(self):
         """Enable readout protection of the flash memory."""
         self.command(self.Command.READOUT_PROTECT, "Readout protect")
-        self._wait_for_ack("0x82 readout protect failed")
+        self._wait_for_slow_ack("0x82 readout protect failed")
         self.debug(10, "    Read protect done")
 
     def readout_unprotect(self):
@@ -468,14 +896,10 @@ class Stm32Bootloader:
         Beware, this will erase the flash content.
         """
         self.command(self.Command.READOUT_UNPROTECT, "Readout unprotect")
-        previous_timeout_value = self.connection.timeout
-        self.connection.timeout = 30
         self.debug(20, "    Mass erase -- this may take a while")
-        try:
-            self._wait_for_ack("0x92 readout unprotect failed")
-        finally:
-            self.connection.timeout = previous_timeout_value
+        self._wait_for_slow_ack("0x92 readout unprotect failed")
         time.sleep(20)
+        self._mark_erased()
         self.debug(20, "    Unprotect / mass erase done")
         self.debug(20, "    Reset after automatic chip reset due to readout unprotect")
         self.reset_from_system_memory()
@@ -486,7 +910,23 @@ class Stm32Bootloader:
 
         Length may be more than 256 bytes.
         """
-        data = bytearray()
+        data = bytearray(length)
+        self.read_memory_data_into(address, data)
+        return data
+
+    def read_memory_data_into(self, address, buffer):
+        """
+        Read flash content from the given address into buffer.
+
+        Reads len(buffer) bytes, which may be more than 256.  The buffer
+        can be reused across calls and devices to avoid allocations.
+
+        :param int address: Memory address to read from.
+        :param buffer: Writable buffer such as a bytearray or memoryview.
+        """
+        view = memoryview(buffer)
+        length = len(view)
+        offset = 0
         chunk_count = int(math.ceil(length / float(self.DATA_TRANSFER_SIZE)))
         self.debug(5, "Read %d chunks at address 0x%X..." % (chunk_count, address))
         #with self.show_progress("Reading", maximum=chunk_count) as progress_bar:
@@ -498,16 +938,19 @@ class Stm32Bootloader:
                 "Read %(len)d bytes at 0x%(address)X"
                 % {"address": address, "len": read_length},
             )
-            data = data + self.read_memory(address, read_length)
+            self.read_chunk_into(address, view[offset : offset + read_length])
             progress=progress+1
             if self.show_progress:
                 self.update_progress(progress,chunk_count,"address:" + hex(address))
             length = length - read_length
+            offset = offset + read_length
             address = address + read_length
-        print("\nReading finished!")
-        return data
+        self.report("\nReading finished!")
 
     def update_progress(self, count, total, suffix=''):
+        if self.progress_reporter:
+            self.progress_reporter(count, total, suffix)
+            return
         bar_len = 20
         filled_len = int(round(bar_len * count / float(total)))
 
@@ -517,33 +960,325 @@ class Stm32Bootloader:
         sys.stdout.write('[%s] %s%s %s\r' % (bar, percents, '%', suffix))
         sys.stdout.flush()
 
-    def write_memory_data(self, address, data):
+    def write_memory_data(
+        self, address, data, skip_blank=None, start_offset=0, progress_callback=None, frames=None
+    ):
         """
         Write the given data to flash.
 
         Data length may be more than 256 bytes.
+
+        With skip_blank, trailing 0xFF bytes are trimmed from the data
+        and chunks that consist of 0xFF bytes only are not sent: erased
+        flash already holds that value.  Only use this on erased flash.
+
+        :param int address: Flash address of the start of data.
+        :param data: Bytes to write.
+        :param bool skip_blank: Skip erased (all 0xFF) chunks. Defaults to
+          skipping them inside the erased_ranges of this session.
+        :param int start_offset: Offset in data to start writing from, to
+          continue an interrupted write.  If it is not a multiple of 256,
+          the first chunk is shorter, so that the other chunks still match
+          the frames.
+        :param callable progress_callback: Called with the offset in data
+          up to which writing is confirmed, after each chunk.
+        :param frames: Data frames of all chunks, from encode_data_frames().
+        :return int: Number of skipped chunks.
         """
         length = len(data)
-        chunk_count = int(math.ceil(length / float(self.DATA_TRANSFER_SIZE)))
-        offset = 0
+        trimmed_length = len(bytearray(data).rstrip(b"\xff"))
+        trailing_range = (address + trimmed_length, length - trimmed_length)
+        if skip_blank or (skip_blank is None and self.is_erased(*trailing_range)):
+            length = trimmed_length
+        offset = min(start_offset, length)
+        length -= offset
+        address += offset
+        chunk_size = float(self.DATA_TRANSFER_SIZE)
+        chunk_count = int(math.ceil((offset % self.DATA_TRANSFER_SIZE + length) / chunk_size))
+        skipped_count = 0
         self.debug(5, "Write %d chunks at address 0x%X..." % (chunk_count, address))
         progress=0
         # with self.show_progress("Writing", maximum=chunk_count) as progress_bar:
         while length:
-            write_length = min(length, self.DATA_TRANSFER_SIZE)
-            self.debug(
-                10,
-                "Write %(len)d bytes at 0x%(address)X"
-                % {"address": address, "len": write_length},
-            )
+            # chunks start at multiples of 256 in data, like the frames
+            write_length = min(length, self.DATA_TRANSFER_SIZE - offset % self.DATA_TRANSFER_SIZE)
+            chunk = data[offset : offset + write_length]
             progress=progress+1
             if self.show_progress:
                 self.update_progress(progress,chunk_count,"address:" + hex(address))
-            self.write_memory(address, data[offset : offset + write_length])
+            if chunk == self.ERASED_CHUNK[:write_length] and (
+                skip_blank or (skip_blank is None and self.is_erased(address, write_length))
+            ):
+                self.debug(10, "Skip blank chunk at 0x%X" % address)
+                skipped_count += 1
+            else:
+                self.debug(
+                    10,
+                    "Write %(len)d bytes at 0x%(address)X"
+                    % {"address": address, "len": write_length},
+                )
+                frame = None
+                if frames and offset % self.DATA_TRANSFER_SIZE == 0:
+                    frame = frames[offset // self.DATA_TRANSFER_SIZE]
+                self._write_chunk(address, chunk, frame)
             length -= write_length
             offset += write_length
             address += write_length
-        print("\nWriting finished!")
+            if progress_callback:
+                progress_callback(offset)
+        self.report("\nWriting finished!")
+        if skipped_count:
+            self.debug(5, "Skipped %d blank chunks" % skipped_count)
+        return skipped_count
+
+    def resync_write(self, address, data, offset, check_count=2, image_bytes=None):
+        """
+        Return the offset at which an interrupted write can continue.
+
+        Read back the check_count chunks before offset, and the chunks
+        from offset on that were written after progress was last recorded.
+        Chunks that hold wrong data are erased together with their pages,
+        and the returned offset moves back to the first erased page.
+        If that page starts before address, its bytes before address are
+        written again from image_bytes.
+
+        :param int address: Flash address of the start of data.
+        :param data: Bytes that were being written.
+        :param int offset: Offset in data up to which writing was
+          confirmed.  A multiple of 256.
+        :param int check_count: Number of confirmed chunks to check.
+        :param image_bytes: Function(address, length) that returns the
+          bytes that belong in that range, e.g. of earlier image segments.
+        :return int: Offset in data to continue writing from.
+        """
+        chunk_size = self.DATA_TRANSFER_SIZE
+        bad_offset = None
+        check_start = max(0, offset - check_count * chunk_size)
+        if check_start < offset:
+            current = self.read_memory_data(address + check_start, offset - check_start)
+            for chunk_offset in range(check_start, offset, chunk_size):
+                chunk_end = min(chunk_offset + chunk_size, offset)
+                if current[chunk_offset - check_start : chunk_end - check_start] != data[
+                    chunk_offset:chunk_end
+                ]:
+                    bad_offset = chunk_offset
+                    break
+
+        # chunks may have been written after progress was last recorded
+        written_end = offset
+        while written_end < len(data):
+            chunk_end = min(written_end + chunk_size, len(data))
+            current = self.read_memory(address + written_end, chunk_end - written_end)
+            if current == data[written_end:chunk_end]:
+                written_end = chunk_end
+                continue
+            if current != self.ERASED_CHUNK[: len(current)]:
+                # written partially or wrongly
+                if bad_offset is None:
+                    bad_offset = written_end
+                written_end = chunk_end
+            break
+
+        if bad_offset is None:
+            offset = written_end
+        else:
+            pages = self.flash_pages(address + bad_offset, written_end - bad_offset)
+            self.debug(
+                5, "Data at 0x%X is damaged; erase %d pages" % (address + bad_offset, len(pages))
+            )
+            self.erase_pages([page_index for page_index, _address, _size in pages])
+            page_address = pages[0][1]
+            offset = max(0, page_address - address)
+            if page_address < address and image_bytes:
+                # the erased page also held bytes before data
+                self.debug(5, "Rewrite 0x%X up to 0x%X" % (page_address, address))
+                restored = image_bytes(page_address, address - page_address)
+                self.write_memory_data(page_address, restored, skip_blank=True)
+        self.debug(5, "Resume writing at address 0x%X" % (address + offset))
+        return offset
+
+    def write_memory_delta(self, address, data):
+        """
+        Rewrite only the flash pages whose content differs from data.
+
+        Each page that overlaps the data is compared, by on-chip checksum
+        if available or else by reading it back.  Differing pages are
+        erased (unless they are blank already) and rewritten.  Page bytes
+        outside of data keep their current content.
+
+        :param int address: Flash address to start writing at.
+        :param data: Bytes to write.
+        :return list: Indices of the rewritten pages.
+        """
+        pages = self.flash_pages(address, len(data))
+        end = address + len(data)
+        changed_pages = []
+        erase_pages = []
+        use_checksum = self.Command.GET_CHECKSUM in self.available_commands
+        self.debug(5, "Compare %d pages at address 0x%X..." % (len(pages), address))
+        for progress, (page_index, page_address, page_size) in enumerate(pages, 1):
+            if self.show_progress:
+                self.update_progress(progress, len(pages), "address:" + hex(page_address))
+            start = max(address, page_address)
+            stop = min(end, page_address + page_size)
+            if use_checksum and stop - start == page_size:
+                page_data = data[start - address : stop - address]
+                if self.get_checksum(page_address, page_size) == self.crc32(page_data):
+                    continue
+            current = self._read_page(page_address, page_size)
+            new = bytearray(current)
+            page_start, page_stop = start - page_address, stop - page_address
+            new[page_start:page_stop] = data[start - address : stop - address]
+            if new == current:
+                continue
+            self.debug(10, "Page %d at 0x%X differs" % (page_index, page_address))
+            changed_pages.append((page_index, page_address, new))
+            if current.count(b"\xff") != page_size:
+                erase_pages.append(page_index)
+        self.report("\nComparing finished!")
+        self.debug(
+            5, "%d of %d pages differ, %d need erase"
+            % (len(changed_pages), len(pages), len(erase_pages))
+        )
+
+        if erase_pages:
+            self.erase_pages(erase_pages)
+        for _page_index, page_address, new in changed_pages:
+            self.write_memory_data(page_address, new, skip_blank=True)
+        return [page_index for page_index, _address, _data in changed_pages]
+
+    def verify_memory_data(self, address, data):
+        """
+        Raise an error if the flash content differs from the given data.
+
+        Use the on-chip Get Checksum command when the bootloader offers
+        it, so that only a CRC is transferred.  Otherwise, or to locate a
+        checksum mismatch, read back the flash content.
+
+        Error type is DataMismatchError.
+
+        :param int address: Flash address of the data.
+        :param data: Reference data.
+        :return None:
+        """
+        if self.Command.GET_CHECKSUM in self.available_commands:
+            # the checksum covers whole words only; read back the rest
+            checksum_length = len(data) - len(data) % 4
+            if self.get_checksum(address, checksum_length) == self.crc32(
+                data[:checksum_length]
+            ):
+                self.debug(5, "Checksum of %d bytes matches" % checksum_length)
+                tail = data[checksum_length:]
+                if tail:
+                    self.verify_data(
+                        self.read_memory(address + checksum_length, len(tail)), tail
+                    )
+                return
+            self.debug(5, "Checksum does not match; reading back to locate the difference")
+
+        read_data = self.read_memory_data(address, len(data))
+        self.verify_data(read_data, data)
+
+    def check_memory_data(self, address, data, sample_count=None):
+        """
+        Return True if the flash content appears to equal the given data.
+
+        A quick check of flash that is expected to hold data already:
+        the full data is compared by on-chip checksum if available, or
+        else sample_count chunks spread over data are read back,
+        including the first and the last.
+
+        :param int address: Flash address of the data.
+        :param data: Reference data.
+        :param int sample_count: Number of chunks to read back. Defaults
+          to CHECK_SAMPLE_COUNT.
+        :return bool: False if a difference was found.
+        """
+        if self.Command.GET_CHECKSUM in self.available_commands:
+            # the checksum covers whole words only; read back the rest
+            checksum_length = len(data) - len(data) % 4
+            if self.get_checksum(address, checksum_length) != self.crc32(
+                data[:checksum_length]
+            ):
+                # no need to read back the data to locate the difference
+                self.debug(10, "Checksum of data at 0x%X differs" % address)
+                return False
+            tail = data[checksum_length:]
+            return not tail or self.read_memory(address + checksum_length, len(tail)) == tail
+
+        sample_count = sample_count or self.CHECK_SAMPLE_COUNT
+        chunk_size = self.DATA_TRANSFER_SIZE
+        last_chunk = (len(data) - 1) // chunk_size
+        chunks = sorted(
+            set(index * last_chunk // max(sample_count - 1, 1) for index in range(sample_count))
+        )
+        for chunk in chunks:
+            offset = chunk * chunk_size
+            reference = data[offset : offset + chunk_size]
+            if self.read_memory(address + offset, len(reference)) != reference:
+                self.debug(10, "Data at 0x%X differs" % (address + offset))
+                return False
+        return True
+
+    def read_chunk_into(self, address, buffer):
+        """
+        Read a chunk of at most 256 bytes into buffer.
+
+        Like read_memory_into(), but retries up to chunk_retries times,
+        restoring the link in between.
+        """
+        retries = 0
+        while True:
+            self.chunk_transfers += 1
+            if self.trace is not None:
+                self.trace.retries = retries
+            try:
+                self.read_memory_into(address, buffer)
+                return
+            except CommandError as e:
+                retries += 1
+                if retries > self.chunk_retries:
+                    raise
+                self._recover_link(e, address)
+
+    def _write_chunk(self, address, data, frame=None):
+        """Write a chunk of data, retrying up to chunk_retries times."""
+        retries = 0
+        while True:
+            self.chunk_transfers += 1
+            if self.trace is not None:
+                self.trace.retries = retries
+            try:
+                self.write_memory(address, data, frame)
+                return
+            except CommandError as e:
+                retries += 1
+                if retries > self.chunk_retries:
+                    raise
+                self._recover_link(e, address)
+                # the failed attempt may have programmed the chunk
+                current = self.read_memory(address, len(data))
+                if current == data:
+                    return
+                if current != self.ERASED_CHUNK[: len(data)]:
+                    raise CommandError("Chunk at 0x%X was written partially: %s" % (address, e))
+
+    def _recover_link(self, error, address):
+        """Restore the link after a failed chunk transfer."""
+        self.debug(5, "Transfer at 0x%X failed, retrying: %s" % (address, error))
+        if self.link_recovery:
+            self.link_recovery(error)
+        else:
+            self.connection.clear_input_buffer()
+
+    def _read_page(self, address, size):
+        """Return flash content of a single page, read in chunks."""
+        data = bytearray(size)
+        view = memoryview(data)
+        for offset in range(0, size, self.DATA_TRANSFER_SIZE):
+            read_length = min(size - offset, self.DATA_TRANSFER_SIZE)
+            self.read_memory_into(address + offset, view[offset : offset + read_length])
+        return data
 
     @staticmethod
     def verify_data(read_data, reference_data):
@@ -565,24 +1300,166 @@ class Stm32Bootloader:
                 % (len(read_data), len(reference_data))
             )
 
-        # data differs; find out where and raise VerifyError
-        for address, data_pair in enumerate(zip(reference_data, read_data)):
-            reference_byte, read_byte = data_pair
-            if reference_byte != read_byte:
-                raise DataMismatchError(
-                    "Verification data does not match read data. "
-                    "First mismatch at address: 0x%X read 0x%X vs 0x%X expected."
-                    % (address, bytearray([read_byte])[0], bytearray([reference_byte])[0])
-                )
-
-    def _reset(self):
-        """Enable or disable the reset IO line (if possible)."""
-        if not self._toggle_reset:
+        mismatches = Stm32Bootloader.find_mismatches(read_data, reference_data)
+        if not mismatches:
+            # equal content in different types, e.g. bytes and bytearray
             return
-        self.connection.enable_reset(True)
-        time.sleep(0.1)
+        address = mismatches[0].offset
+        raise DataMismatchError(
+            "Verification data does not match read data. "
+            "First mismatch at address: 0x%X read 0x%X vs 0x%X expected. "
+            "%d bytes differ in %d ranges."
+            % (
+                address,
+                bytearray(read_data[address : address + 1])[0],
+                bytearray(reference_data[address : address + 1])[0],
+                sum(mismatch.count for mismatch in mismatches),
+                len(mismatches),
+            ),
+            mismatches,
+        )
+
+    @staticmethod
+    def find_mismatches(read_data, reference_data):
+        """
+        Return the ranges where the data differs from its reference.
+
+        Data is compared a chunk at a time; only differing chunks are
+        searched for the differing bytes, in bulk (with NumPy if it is
+        installed).  Differences less than MISMATCH_GAP bytes apart are
+        reported as one range.
+
+        :param read_data: Data to compare.
+        :param reference_data: Data to compare, as reference; of the
+          same length.
+        :return list: MismatchRanges, with offsets into the data.
+        """
+        read_data = bytes(read_data)
+        reference_data = bytes(reference_data)
+        chunk_size = Stm32Bootloader.MISMATCH_CHUNK_SIZE
+        gap = Stm32Bootloader.MISMATCH_GAP
+        mismatches = []
+        for chunk_offset in range(0, len(reference_data), chunk_size):
+            read_chunk = read_data[chunk_offset : chunk_offset + chunk_size]
+            reference_chunk = reference_data[chunk_offset : chunk_offset + chunk_size]
+            if read_chunk == reference_chunk:
+                continue
+            # 1 for every differing byte, 0 for every equal one
+            differences = _xor(read_chunk, reference_chunk).translate(_NONZERO_TABLE)
+            start = differences.find(b"\x01")
+            while start != -1:
+                end = differences.find(b"\x00", start)
+                if end == -1:
+                    end = len(differences)
+                offset = chunk_offset + start
+                previous = mismatches[-1] if mismatches else None
+                if previous and offset - (previous.offset + previous.length) < gap:
+                    previous.length = chunk_offset + end - previous.offset
+                    previous.count += end - start
+                else:
+                    mismatches.append(MismatchRange(offset, end - start, end - start))
+                start = differences.find(b"\x01", end)
+        return mismatches
+
+    @staticmethod
+    def crc32(data, crc=CRC_INITIAL_VALUE):
+        """
+        Return the CRC-32 of data as computed by the STM32 CRC peripheral.
+
+        Data is processed as little-endian 32-bit words, most significant
+        bit first (CRC-32/MPEG-2), without final XOR.
+
+        :param data: Bytes, length a multiple of 4.
+        :param int crc: Initial CRC value.
+        :return int: 32-bit CRC value.
+        """
+        if len(data) % 4 != 0:
+            raise DataLengthError("CRC data length must be a multiple of 4 bytes.")
+        data = bytearray(data)
+        words = bytearray(len(data))
+        words[0::4] = data[3::4]
+        words[1::4] = data[2::4]
+        words[2::4] = data[1::4]
+        words[3::4] = data[0::4]
+        # MSB-first CRC equals the bit-reversed LSB-first CRC of
+        # bit-reversed data
+        reflected = bytes(words).translate(_BIT_REVERSE_TABLE)
+        register = _reverse_bits(crc, 32) ^ 0xFFFFFFFF
+        register = binascii.crc32(reflected, register) & 0xFFFFFFFF
+        return _reverse_bits(register ^ 0xFFFFFFFF, 32)
+
+    def _reset(self, boot0):
+        """
+        Set the boot0 IO line and pulse the reset IO line (if possible).
+
+        Connections that offer set_boot0_and_reset() set boot0 and enable
+        reset in one go.
+        """
+        set_boot0_and_reset = getattr(self.connection, "set_boot0_and_reset", None)
+        if set_boot0_and_reset is not None and self._toggle_boot0 and self._toggle_reset:
+            set_boot0_and_reset(boot0, True)
+        else:
+            self._enable_boot0(boot0)
+            if not self._toggle_reset:
+                return
+            self.connection.enable_reset(True)
+        time.sleep(self.reset_hold_time)
         self.connection.enable_reset(False)
-        time.sleep(0.5)
+
+    def _synchronize(self):
+        """
+        Send the synchronization byte until the bootloader replies.
+
+        The wait for a reply grows exponentially, so that the bootloader
+        is found as soon as it has started.  A NACK reply means that the
+        bootloader was synchronized already.
+
+        A reply may come late, after the next synchronization byte was
+        sent.  The synchronized bootloader takes such an extra byte for
+        a command code, and NACKs it only when the next byte fails the
+        complement check.  So after absorbing the late replies, extra
+        bytes are paired up, lest the next command is misframed.
+
+        Raise CommandError if there's no reply within SYNC_TIMEOUT.
+        """
+        previous_timeout_value = self.connection.timeout
+        deadline = _clock() + self.SYNC_TIMEOUT
+        interval = self.SYNC_PROBE_INTERVAL
+        sent_count = 0
+        try:
+            while True:
+                self.connection.timeout = min(interval, max(deadline - _clock(), 0))
+                self.write(self.Command.SYNCHRONIZE)
+                sent_count += 1
+                reply = bytearray(self.connection.read())
+                if reply and reply[0] == self.Reply.ACK:
+                    self.debug(10, "*** Synchro: ACK")
+                    break
+                if reply and reply[0] == self.Reply.NACK:
+                    self.debug(10, "*** Synchro: NACK, bootloader was synchronized")
+                    break
+                if _clock() >= deadline:
+                    raise CommandError("Can't read port or timeout")
+                interval = min(interval * 2, self.SYNC_PROBE_INTERVAL_MAX)
+            if sent_count > 1:
+                # wait for the replies to the other synchronization bytes
+                self.connection.timeout = interval
+                late_replies = self.connection.read(sent_count)
+                self.connection.clear_input_buffer()
+                self.debug(10, "*** Synchro: absorbed %d late replies" % len(late_replies))
+                self._pair_synchronization_bytes()
+        finally:
+            self.connection.timeout = previous_timeout_value
+        return 1
+
+    def _pair_synchronization_bytes(self):
+        """Send synchronization bytes until one completes a code (NACK)."""
+        for _attempt in range(2):
+            self.write(self.Command.SYNCHRONIZE)
+            if self.connection.read():
+                self.debug(10, "*** Synchro: paired the extra bytes")
+                return
+        raise CommandError("Can't read port or timeout")
 
     def _enable_boot0(self, enable=True):
         """Enable or disable the boot0 IO line (if possible)."""
@@ -591,9 +1468,79 @@ class Stm32Bootloader:
 
         self.connection.enable_boot0(enable)
 
+    def _read(self, size=1):
+        """Return up to size bytes from the connection; fewer at a timeout."""
+        data = bytearray(self.connection.read(size))
+        if len(data) < size and self._fall_back_to_default_timeout():
+            data += bytearray(self.connection.read(size - len(data)))
+        return data
+
+    def _read_into(self, buffer):
+        """Fill the buffer from the connection or raise CommandError."""
+        count = self._fill(buffer)
+        if count != len(buffer) and self._fall_back_to_default_timeout():
+            count += self._fill(memoryview(buffer)[count:])
+        if count != len(buffer):
+            raise CommandError("Can't read port or timeout")
+
+    def _fill(self, buffer):
+        """Read bytes from the connection into buffer; return their count."""
+        readinto = getattr(self.connection, "readinto", None)
+        if readinto is not None:
+            return readinto(buffer)
+        data = self.connection.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def _fall_back_to_default_timeout(self):
+        """
+        Switch to the default timeout if an adaptive timeout expired.
+
+        A latency spike (e.g. of a USB serial adapter) may delay a reply
+        beyond the adaptive timeout; the rest of the reply is then waited
+        for with the default timeout instead of failing the command.
+        """
+        if not self.adaptive_timeouts or self._timeout is None:
+            return False
+        if self.connection.timeout != self._timeout:
+            # a command with a timeout of its own, e.g. erase
+            return False
+        self.late_replies += 1
+        self.debug(5, "Reply is late; waiting up to %s s" % self._default_timeout)
+        self.connection.timeout = self._default_timeout
+        self._timeout = None
+        return True
+
+    def _ack_timeout(self, transfer_size=0, extra_time=0):
+        """
+        Return the time to wait for a reply, derived from the ACK latency.
+
+        Return None while no latency was measured yet.
+
+        :param int transfer_size: Number of bytes to transfer first.
+        :param float extra_time: Processing time on the MCU, in seconds.
+        """
+        if not self._latency_samples:
+            return None
+        latency = self.ACK_LATENCY_FACTOR * max(self._latency_samples)
+        timeout = self.ACK_TIMEOUT_MARGIN + latency + extra_time
+        baud_rate = getattr(self.connection, "baud_rate", None)
+        if transfer_size and baud_rate:
+            timeout += transfer_size * self.BITS_PER_BYTE / float(baud_rate)
+        return timeout
+
+    def _set_timeout(self, timeout):
+        """Set the connection's read timeout, if it changed."""
+        if timeout is None or timeout == self._timeout:
+            return
+        if self._default_timeout is None:
+            self._default_timeout = self.connection.timeout
+        self.connection.timeout = timeout
+        self._timeout = timeout
+
     def _wait_for_ack(self, info=""):
         """Read a byte and raise CommandError if it's not ACK."""
-        read_data = bytearray(self.connection.read())
+        read_data = self._read()
         if not read_data: # empty string
             raise CommandError("Can't read port or timeout")
 
@@ -604,18 +1551,99 @@ class Stm32Bootloader:
             raise CommandError("NACK " + info)
         if reply not in (self.Reply.ACK, self.Reply.NACK):
             # try to read additional byte in case it was just a input noise
-            read_data = bytearray(self.connection.read())
+            read_data = self._read()
             if not read_data or read_data[0] != self.Reply.ACK:
                 raise CommandError("Unknown response. " + info)
         # if len(read_data) == 2 and read_data[0] == self.Reply.NACK and read_data[1] == self.Reply.NACK:
         #     raise CommandError("RDP is active!")
+        if self.trace is not None:
+            self.trace.ack()
         return 1
 
+    def _wait_for_slow_ack(self, info=""):
+        """
+        Wait for an ACK that follows flash erase or option byte programming.
+
+        The adaptive timeout of the command does not cover that, so wait
+        up to ERASE_TIMEOUT.
+        """
+        previous_timeout_value = self.connection.timeout
+        self.connection.timeout = self.ERASE_TIMEOUT
+        try:
+            return self._wait_for_ack(info)
+        finally:
+            self.connection.timeout = previous_timeout_value
+
     @staticmethod
     def _encode_address(address):
         """Return the given address as big-endian bytes with a checksum."""
-        # address in four bytes, big-endian
-        address_bytes = bytearray(struct.pack(">I", address))
-        # checksum as single byte
-        checksum_byte = struct.pack("B", reduce(operator.xor, address_bytes))
-        return address_bytes + checksum_byte
+        # checksum: XOR of the four address bytes
+        checksum = (address ^ address >> 8 ^ address >> 16 ^ address >> 24) & 0xFF
+        # address in four bytes, big-endian, and checksum as single byte
+        return struct.pack(">IB", address, checksum)
+
+    @classmethod
+    def encode_data_frames(cls, data):
+        """
+        Return the Write Memory data frames of all chunks of data.
+
+        Frames don't depend on the connection, so boards that are written
+        with the same data can share them.  Pass them to write_memory_data().
+        """
+        encoder = cls(connection=None)
+        return [
+            bytes(encoder._encode_data_frame(data[offset : offset + cls.DATA_TRANSFER_SIZE]))
+            for offset in range(0, len(data), cls.DATA_TRANSFER_SIZE)
+        ]
+
+    def _encode_data_frame(self, data):
+        """
+        Return the Write Memory frame of data.
+
+        The frame holds byte count, data, padding and checksum.
+        """
+        # pad data length to multiple of 4 bytes
+        padding_bytes = -len(data) % 4
+        return self._encode_frame(
+            struct.pack("B", len(data) + padding_bytes - 1), data, padding_bytes
+        )
+
+    def _encode_frame(self, header, payload=b"", padding=0):
+        """
+        Return a frame of header, payload, padding and XOR checksum.
+
+        The frame is built in a buffer that is reused for every frame, so
+        the returned memoryview is only valid until the next call.
+
+        :param bytes header: Frame start, such as the byte count.
+        :param payload: Frame data.
+        :param int padding: Number of 0xFF bytes to append to the payload.
+        :return memoryview: Complete frame, ready to write.
+        """
+        header_end = len(header)
+        payload_end = header_end + len(payload)
+        frame_end = payload_end + padding
+        if len(self._frame_buffer) <= frame_end:
+            self._frame_buffer = bytearray(frame_end + 1)
+        frame = self._frame_buffer
+        frame[:header_end] = header
+        frame[header_end:payload_end] = payload
+        frame[payload_end:frame_end] = self.ERASED_CHUNK[:padding]
+        # an odd count of 0xFF padding bytes flips all checksum bits
+        checksum = self._checksum(header) ^ self._checksum(payload) ^ (0xFF * (padding % 2))
+        frame[frame_end] = checksum
+        return memoryview(frame)[: frame_end + 1]
+
+    @staticmethod
+    def _checksum(data):
+        """Return the XOR of all bytes in data, eight bytes at a time."""
+        word_count = len(data) // 8
+        checksum = 0
+        if word_count:
+            words = reduce(operator.xor, struct.unpack_from("<%dQ" % word_count, data))
+            words ^= words >> 32
+            words ^= words >> 16
+            checksum = (words ^ words >> 8) & 0xFF
+        for byte in bytearray(data[word_count * 8 :]):
+            checksum ^= byte
+        return checksum
@@ -0,0 +1,107 @@
+# GitHub repository: https://github.com/florisla/stm32loader
+#
+# This file is part of stm32loader.
+#
+# stm32loader is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# stm32loader is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with stm32loader; see the file LICENSE.  If not see
+# <http://www.gnu.org/licenses/>.
+
+"""Remember the image last verified on each device, and chip capabilities."""
+
+import json
+import os
+import threading
+
+# atomic on all platforms, but not available in Python 2
+_replace = getattr(os, "replace", os.rename)
+
+
+class FlashCache(object):
+    """
+    Host-side record of devices and chip types, in a JSON file.
+
+    Per device UID, it holds the flash ranges and digest (see
+    MemoryImage.digest()) of the image last verified on the device.
+    Per chip ID, it holds the bootloader version and supported commands
+    as reported by the Get command.  The file may be shared by several
+    loaders; every change re-reads it first.
+    """
+
+    # serializes read-modify-write cycles of the loaders in this process
+    _lock = threading.Lock()
+
+    def __init__(self, path):
+        """
+        Construct a FlashCache.
+
+        :param str path: File name of the cache file.
+        """
+        self.path = path
+
+    def lookup(self, device_uid, image):
+        """Return True if image was the last one verified on the device."""
+        entry = self._load()["devices"].get(device_uid)
+        return entry is not None and entry.get("image") == image.digest()
+
+    def store(self, device_uid, image):
+        """Record that image is verified on the device."""
+        with self._lock:
+            entries = self._load()
+            entries["devices"][device_uid] = {
+                "image": image.digest(),
+                "ranges": [[segment.address, len(segment.data)] for segment in image.segments],
+            }
+            self._save(entries)
+
+    def forget(self, device_uid):
+        """Remove the entry of the device, e.g. before its flash changes."""
+        with self._lock:
+            entries = self._load()
+            if entries["devices"].pop(device_uid, None) is not None:
+                self._save(entries)
+
+    def lookup_capabilities(self, chip_id):
+        """Return the bootloader version and commands of the chip, or None."""
+        entry = self._load()["chips"].get("0x%X" % chip_id)
+        if entry is None:
+            return None
+        return entry["version"], bytearray(entry["commands"])
+
+    def store_capabilities(self, chip_id, version, commands):
+        """Record the bootloader version and command codes of the chip."""
+        with self._lock:
+            entries = self._load()
+            entries["chips"]["0x%X" % chip_id] = {
+                "version": version,
+                "commands": list(bytearray(commands)),
+            }
+            self._save(entries)
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as cache_file:
+                entries = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            entries = None
+        if not isinstance(entries, dict):
+            entries = {}
+        for section in ["devices", "chips"]:
+            if not isinstance(entries.get(section), dict):
+                entries[section] = {}
+        return entries
+
+    def _save(self, entries):
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as cache_file:
+            json.dump(entries, cache_file, indent=1, sort_keys=True)
+        _replace(temporary_path, self.path)
@@ -0,0 +1,400 @@
+# GitHub repository: https://github.com/florisla/stm32loader
+#
+# This file is part of stm32loader.
+#
+# stm32loader is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# stm32loader is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with stm32loader; see the file LICENSE.  If not see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Capture the traffic on a bootloader connection, and replay it offline.
+
+A capture file starts with MAGIC, followed by one record per event:
+a header of event type, microseconds since the previous event started,
+duration in microseconds and payload length (little-endian '<BIII'),
+then the payload.  Read payloads start with the requested byte count.
+
+Summarize a capture with:
+
+    $ python -m stm32loader.capture capture.bin
+"""
+
+from __future__ import print_function
+
+import struct
+import sys
+import time
+
+from .bootloader import Stm32LoaderError
+
+_clock = getattr(time, "monotonic", time.time)
+
+MAGIC = b"STM32CAP\x01"
+
+_HEADER = struct.Struct("<BIII")
+_READ_SIZE = struct.Struct("<I")
+_TIMEOUT = struct.Struct("<d")
+
+
+class Event(object):
+    """Event types of a capture."""
+
+    # pylint: disable=too-few-public-methods
+
+    WRITE = 1
+    READ = 2
+    CLEAR_INPUT = 3
+    TIMEOUT = 4
+    RESET = 5
+    BOOT0 = 6
+
+    NAMES = {
+        WRITE: "write",
+        READ: "read",
+        CLEAR_INPUT: "clear input",
+        TIMEOUT: "timeout",
+        RESET: "reset",
+        BOOT0: "boot0",
+    }
+
+
+class CaptureError(Stm32LoaderError):
+    """Exception: a capture file is invalid, or replay diverged from it."""
+
+
+class CapturedEvent(object):
+    """A single event of a capture."""
+
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ["kind", "start", "duration", "data", "size"]
+
+    def __init__(self, kind, start, duration, data, size=None):
+        """
+        Construct a CapturedEvent.
+
+        :param int kind: Event type, see Event.
+        :param float start: Seconds since the capture started.
+        :param float duration: Seconds that the call took.
+        :param bytes data: Bytes written or read; packed value for others.
+        :param int size: Requested byte count of a read.
+        """
+        self.kind = kind
+        self.start = start
+        self.duration = duration
+        self.data = data
+        self.size = size
+
+    def __repr__(self):
+        return "CapturedEvent(%s, %.6f, %.6f, %r)" % (
+            Event.NAMES.get(self.kind, self.kind),
+            self.start,
+            self.duration,
+            self.data,
+        )
+
+
+class CaptureConnection(object):
+    """
+    Connection wrapper that logs all traffic to a capture file.
+
+    Pass it to Stm32Bootloader instead of the connection it wraps.
+    Attributes that it does not log are passed on to the connection.
+    """
+
+    def __init__(self, connection, file_name):
+        """
+        Construct a CaptureConnection and create the capture file.
+
+        :param connection: Connection to wrap, e.g. SerialConnection.
+        :param str file_name: Path of the capture file.
+        """
+        self.connection = connection
+        self._file = open(file_name, "wb")
+        self._file.write(MAGIC)
+        self._start = _clock()
+        self._previous_start = 0.0
+
+    def __getattr__(self, name):
+        # only called for attributes that are not found on the wrapper
+        return getattr(self.connection, name)
+
+    @property
+    def baud_rate(self):
+        """Get baud rate."""
+        return self.connection.baud_rate
+
+    @baud_rate.setter
+    def baud_rate(self, baud_rate):
+        """Set baud rate of the wrapped connection."""
+        self.connection.baud_rate = baud_rate
+
+    @property
+    def timeout(self):
+        """Get timeout."""
+        return self.connection.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        """Set timeout and log it."""
+        self.connection.timeout = timeout
+        self._log(Event.TIMEOUT, _clock(), _TIMEOUT.pack(-1 if timeout is None else timeout))
+
+    def write(self, data):
+        """Write data to the connection and log it."""
+        start = _clock()
+        result = self.connection.write(data)
+        self._log(Event.WRITE, start, bytes(data))
+        return result
+
+    def read(self, size=1):
+        """Read from the connection and log the request and the result."""
+        start = _clock()
+        data = self.connection.read(size)
+        self._log(Event.READ, start, _READ_SIZE.pack(size) + bytes(bytearray(data)))
+        return data
+
+    def readinto(self, buffer):
+        """Read into the buffer, logged like read()."""
+        start = _clock()
+        if hasattr(self.connection, "readinto"):
+            count = self.connection.readinto(buffer)
+        else:
+            data = self.connection.read(len(buffer))
+            count = len(data)
+            buffer[:count] = data
+        self._log(Event.READ, start, _READ_SIZE.pack(len(buffer)) + bytes(buffer[:count]))
+        return count
+
+    def clear_input_buffer(self):
+        """Clear the connection's input buffer and log it."""
+        start = _clock()
+        self.connection.clear_input_buffer()
+        self._log(Event.CLEAR_INPUT, start, b"")
+
+    def enable_reset(self, enable=True):
+        """Set the reset line and log it."""
+        start = _clock()
+        self.connection.enable_reset(enable)
+        self._log(Event.RESET, start, bytes(bytearray([int(enable)])))
+
+    def enable_boot0(self, enable=True):
+        """Set the boot0 line and log it."""
+        start = _clock()
+        self.connection.enable_boot0(enable)
+        self._log(Event.BOOT0, start, bytes(bytearray([int(enable)])))
+
+    def set_boot0_and_reset(self, boot0, reset):
+        """Set the boot0 and reset lines, at once if possible; log both."""
+        set_boot0_and_reset = getattr(self.connection, "set_boot0_and_reset", None)
+        if set_boot0_and_reset is None:
+            self.enable_boot0(boot0)
+            self.enable_reset(reset)
+            return
+        start = _clock()
+        set_boot0_and_reset(boot0, reset)
+        self._log(Event.BOOT0, start, bytes(bytearray([int(boot0)])))
+        self._log(Event.RESET, _clock(), bytes(bytearray([int(reset)])))
+
+    def close(self):
+        """Close the capture file."""
+        self._file.close()
+
+    def _log(self, kind, start, payload):
+        end = _clock()
+        start -= self._start
+        delta = max(int((start - self._previous_start) * 1e6), 0)
+        self._previous_start = start
+        self._file.write(
+            _HEADER.pack(kind, delta, int((end - self._start - start) * 1e6), len(payload))
+        )
+        self._file.write(payload)
+        # a capture is most useful when the session breaks down
+        self._file.flush()
+
+
+def load_capture(file_name):
+    """Return the list of CapturedEvents in a capture file."""
+    with open(file_name, "rb") as capture_file:
+        content = capture_file.read()
+    if not content.startswith(MAGIC):
+        raise CaptureError("%s is not a capture file." % file_name)
+    events = []
+    offset = len(MAGIC)
+    start = 0.0
+    while offset < len(content):
+        if offset + _HEADER.size > len(content):
+            # the capture was cut off while writing a record
+            break
+        kind, delta, duration, length = _HEADER.unpack_from(content, offset)
+        offset += _HEADER.size
+        payload = content[offset : offset + length]
+        offset += length
+        start += delta / 1e6
+        size = None
+        if kind == Event.READ:
+            size = _READ_SIZE.unpack_from(payload)[0]
+            payload = payload[_READ_SIZE.size :]
+        events.append(CapturedEvent(kind, start, duration / 1e6, payload, size))
+    return events
+
+
+class ReplayConnection(object):
+    """
+    Fake connection that plays back a capture to Stm32Bootloader.
+
+    Reads return the captured data, including short reads that were
+    timeouts.  Writes are compared with the captured writes; a
+    difference raises CaptureError.  With realtime, reads take as
+    long as they did during capture.
+
+    host_latencies collects, per write, the time the host spent since
+    the previous read returned; compare it with capture_host_latencies().
+    """
+
+    def __init__(self, events, realtime=False):
+        """
+        Construct a ReplayConnection.
+
+        :param events: CapturedEvents, see load_capture().
+        :param bool realtime: Reproduce the duration of reads.
+        """
+        self.events = list(events)
+        self.realtime = realtime
+        # there's no port; baud rate changes are only remembered
+        self.baud_rate = 115200
+        self.timeout = 5
+        self.can_toggle_reset = True
+        self.can_toggle_boot0 = True
+        self.host_latencies = []
+        self._position = 0
+        self._last_read_end = None
+
+    @classmethod
+    def load(cls, file_name, realtime=False):
+        """Return a ReplayConnection of the capture in the given file."""
+        return cls(load_capture(file_name), realtime)
+
+    def connect(self):
+        """Do nothing; the capture is the connection."""
+
+    def write(self, data):
+        """Check that the data matches the next captured write."""
+        if self._last_read_end is not None:
+            self.host_latencies.append(_clock() - self._last_read_end)
+            self._last_read_end = None
+        event = self._next(Event.WRITE)
+        if bytes(bytearray(data)) != event.data:
+            raise CaptureError(
+                "Write at %.6f s differs from capture: %r instead of %r"
+                % (event.start, bytes(bytearray(data)), event.data)
+            )
+        return len(data)
+
+    def read(self, size=1):
+        """Return the data of the next captured read."""
+        event = self._next(Event.READ)
+        if self.realtime:
+            time.sleep(event.duration)
+        self._last_read_end = _clock()
+        return event.data[:size]
+
+    def readinto(self, buffer):
+        """Read the next captured read into the buffer."""
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def clear_input_buffer(self):
+        """Follow the captured input buffer clear."""
+        self._next(Event.CLEAR_INPUT)
+
+    def enable_reset(self, enable=True):
+        """Follow the captured reset line change."""
+        # pylint: disable=unused-argument
+        self._next(Event.RESET)
+
+    def enable_boot0(self, enable=True):
+        """Follow the captured boot0 line change."""
+        # pylint: disable=unused-argument
+        self._next(Event.BOOT0)
+
+    def _next(self, kind):
+        """Return the next event, which must be of the given kind."""
+        # timeout changes are not replayed, but may come in between
+        events = self.events
+        while self._position < len(events) and events[self._position].kind == Event.TIMEOUT:
+            self._position += 1
+        if self._position >= len(events):
+            raise CaptureError("Capture ended; expected %s" % Event.NAMES[kind])
+        event = events[self._position]
+        if event.kind != kind:
+            raise CaptureError(
+                "Expected %s at %.6f s but capture has %s"
+                % (Event.NAMES[kind], event.start, Event.NAMES.get(event.kind, event.kind))
+            )
+        self._position += 1
+        return event
+
+
+def capture_host_latencies(events):
+    """Return, per write, the time since the previous read returned."""
+    latencies = []
+    read_end = None
+    for event in events:
+        if event.kind == Event.READ:
+            read_end = event.start + event.duration
+        elif event.kind == Event.WRITE and read_end is not None:
+            latencies.append(event.start - read_end)
+            read_end = None
+    return latencies
+
+
+def format_summary(events):
+    """Return statistics of a capture as readable text."""
+    written = sum(len(event.data) for event in events if event.kind == Event.WRITE)
+    reads = [event for event in events if event.kind == Event.READ]
+    received = sum(len(event.data) for event in reads)
+    short_reads = [event for event in reads if len(event.data) < event.size]
+    duration = events[-1].start + events[-1].duration if events else 0
+    lines = [
+        "Events: %d over %.3f s" % (len(events), duration),
+        "Written: %d bytes, received: %d bytes" % (written, received),
+        "Reads: %d, of which %d timed out" % (len(reads), len(short_reads)),
+    ]
+    for name, values in [
+        ("Read wait", sorted(event.duration for event in reads)),
+        ("Host latency", sorted(capture_host_latencies(events))),
+    ]:
+        if values:
+            lines.append(
+                "%s: median %.3f ms, max %.3f ms, total %.3f s"
+                % (name, 1000 * values[len(values) // 2], 1000 * values[-1], sum(values))
+            )
+    for event in short_reads:
+        lines.append(
+            "Timeout at %.6f s: %d of %d bytes after %.3f s"
+            % (event.start, len(event.data), event.size, event.duration)
+        )
+    return "\n".join(lines)
+
+
+def main(*args):
+    """Print the summary of the given capture files."""
+    for file_name in args:
+        print("%s:" % file_name)
+        print(format_summary(load_capture(file_name)))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,226 @@
+# GitHub repository: https://github.com/florisla/stm32loader
+#
+# This file is part of stm32loader.
+#
+# stm32loader is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# stm32loader is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with stm32loader; see the file LICENSE.  If not see
+# <http://www.gnu.org/licenses/>.
+
+"""Flash layout and timing of STM32 devices, by chip ID."""
+
+KIB = 1024
+
+# flash layouts as (page size, page count) runs, in address order
+_F2_F4_BANK = [(16 * KIB, 4), (64 * KIB, 1), (128 * KIB, 7)]
+
+# typical timing per family: erase time per page size (seconds) and
+# program time per KiB, from the device datasheets; x32 parallelism for
+# families with sectors
+_F0_F1_TIMES = ({1 * KIB: 0.02, 2 * KIB: 0.02}, 0.027)
+_F2_F4_TIMES = ({16 * KIB: 0.25, 64 * KIB: 0.55, 128 * KIB: 1.0}, 0.0041)
+_F7_TIMES = ({32 * KIB: 0.25, 128 * KIB: 1.0, 256 * KIB: 2.0}, 0.0041)
+_L1_TIMES = ({256: 0.0033}, 0.026)
+
+# register addresses per family: UID (None if it has none, or if it is
+# not contiguous) and flash size
+_F0_REGISTERS = (None, 0x1FFFF7CC)
+_F1_REGISTERS = (0x1FFFF7E8, 0x1FFFF7E0)
+_F2_F4_REGISTERS = (0x1FFF7A10, 0x1FFF7A22)
+_F7_REGISTERS = (0x1FF0F420, 0x1FF0F442)
+_L1_REGISTERS = (None, 0x1FF8004C)
+
+# chip ID, name, family, flash layout, registers, timing; see ST AN2606
+# and the reference manuals
+_DEVICE_TABLE = [
+    (0x440, "STM32F05xxx/030x8", "F0", [(1 * KIB, 64)], _F0_REGISTERS, _F0_F1_TIMES),
+    (0x444, "STM32F03xx4/6", "F0", [(1 * KIB, 32)], _F0_REGISTERS, _F0_F1_TIMES),
+    (0x445, "STM32F04xxx/070x6", "F0", [(1 * KIB, 32)], _F0_REGISTERS, _F0_F1_TIMES),
+    (0x448, "STM32F07xxx", "F0", [(2 * KIB, 64)], _F0_REGISTERS, _F0_F1_TIMES),
+    (0x442, "STM32F09xxx", "F0", [(2 * KIB, 128)], _F0_REGISTERS, _F0_F1_TIMES),
+    (0x412, "STM32F10x Low-density", "F1", [(1 * KIB, 32)], _F1_REGISTERS, _F0_F1_TIMES),
+    (0x410, "STM32F10x Medium-density", "F1", [(1 * KIB, 128)], _F1_REGISTERS, _F0_F1_TIMES),
+    (
+        0x420,
+        "STM32F10x Medium-density value line",
+        "F1",
+        [(1 * KIB, 128)],
+        _F1_REGISTERS,
+        _F0_F1_TIMES,
+    ),
+    (0x414, "STM32F10x High-density", "F1", [(2 * KIB, 256)], _F1_REGISTERS, _F0_F1_TIMES),
+    (
+        0x428,
+        "STM32F10x High-density value line",
+        "F1",
+        [(2 * KIB, 256)],
+        _F1_REGISTERS,
+        _F0_F1_TIMES,
+    ),
+    (0x418, "STM32F105xx/107xx", "F1", [(2 * KIB, 128)], _F1_REGISTERS, _F0_F1_TIMES),
+    # two banks of 256 pages
+    (0x430, "STM3210xx XL-density", "F1", [(2 * KIB, 512)], _F1_REGISTERS, _F0_F1_TIMES),
+    (0x411, "STM32F2xxx", "F2", _F2_F4_BANK, _F2_F4_REGISTERS, _F2_F4_TIMES),
+    (
+        0x413,
+        "STM32F405xx/07xx and STM32F415xx/17xx",
+        "F4",
+        _F2_F4_BANK,
+        _F2_F4_REGISTERS,
+        _F2_F4_TIMES,
+    ),
+    # two banks, with page indexes counting on in the second bank
+    (
+        0x419,
+        "STM32F42xxx and STM32F43xxx",
+        "F4",
+        _F2_F4_BANK * 2,
+        _F2_F4_REGISTERS,
+        _F2_F4_TIMES,
+    ),
+    (
+        0x423,
+        "STM32F401xB/C",
+        "F4",
+        [(16 * KIB, 4), (64 * KIB, 1), (128 * KIB, 1)],
+        _F2_F4_REGISTERS,
+        _F2_F4_TIMES,
+    ),
+    (
+        0x433,
+        "STM32F4xxDE",
+        "F4",
+        [(16 * KIB, 4), (64 * KIB, 1), (128 * KIB, 3)],
+        _F2_F4_REGISTERS,
+        _F2_F4_TIMES,
+    ),
+    (
+        0x431,
+        "STM32F411xx",
+        "F4",
+        [(16 * KIB, 4), (64 * KIB, 1), (128 * KIB, 3)],
+        _F2_F4_REGISTERS,
+        _F2_F4_TIMES,
+    ),
+    (
+        0x421,
+        "STM32F446xx",
+        "F4",
+        [(16 * KIB, 4), (64 * KIB, 1), (128 * KIB, 3)],
+        _F2_F4_REGISTERS,
+        _F2_F4_TIMES,
+    ),
+    (
+        0x449,
+        "STM32F74xxx/75xxx",
+        "F7",
+        [(32 * KIB, 4), (128 * KIB, 1), (256 * KIB, 3)],
+        _F7_REGISTERS,
+        _F7_TIMES,
+    ),
+    (
+        0x451,
+        "STM32F76xxx/77xxx",
+        "F7",
+        [(32 * KIB, 4), (128 * KIB, 1), (256 * KIB, 7)],
+        _F7_REGISTERS,
+        _F7_TIMES,
+    ),
+    (
+        0x416,
+        "STM32L1xxx6(8/B) Medium-density ultralow power line",
+        "L1",
+        [(256, 512)],
+        _L1_REGISTERS,
+        _L1_TIMES,
+    ),
+]
+
+_devices = None
+
+
+class DeviceDescriptor(object):
+    """Flash layout, register addresses and typical timing of a device."""
+
+    # pylint: disable=too-many-instance-attributes
+
+    FLASH_START_ADDRESS = 0x08000000
+
+    def __init__(self, chip_id, name, family, layout, registers, times):
+        """
+        Construct a DeviceDescriptor; see _DEVICE_TABLE for the arguments.
+
+        :param list layout: (page size, page count) runs, in address order.
+        """
+        self.chip_id = chip_id
+        self.name = name
+        self.family = family
+        self.flash_start = self.FLASH_START_ADDRESS
+        self.layout = layout
+        self.flash_size = sum(size * count for size, count in layout)
+        self.page_count = sum(count for _size, count in layout)
+        self.uid_address, self.flash_size_address = registers
+        self.erase_times, self.program_time_per_kib = times
+
+    def __repr__(self):
+        return "DeviceDescriptor(0x%X, %r)" % (self.chip_id, self.name)
+
+    def flash_pages(self, address, length):
+        """
+        Return the flash pages that overlap the given memory range.
+
+        :return list: (page index, page address, page size) tuples.
+        :raise ValueError: If the range is not within flash.
+        """
+        end = address + length
+        if address < self.flash_start or end > self.flash_start + self.flash_size:
+            raise ValueError(
+                "Range 0x%X-0x%X is not within the flash of %s." % (address, end - 1, self.name)
+            )
+        pages = []
+        page_index = 0
+        run_address = self.flash_start
+        for size, count in self.layout:
+            run_end = run_address + size * count
+            if length > 0 and run_address < end and run_end > address:
+                first = max(address - run_address, 0) // size
+                last = (min(end, run_end) - run_address - 1) // size
+                pages.extend(
+                    (page_index + index, run_address + index * size, size)
+                    for index in range(first, last + 1)
+                )
+            page_index += count
+            run_address = run_end
+        return pages
+
+    def erase_time(self, pages=None):
+        """
+        Return the typical time to erase the given pages, in seconds.
+
+        :param pages: (page index, page address, page size) tuples as
+          returned by flash_pages(). Defaults to all pages.
+        """
+        if pages is None:
+            pages = self.flash_pages(self.flash_start, self.flash_size)
+        return sum(self.erase_times[size] for _index, _address, size in pages)
+
+    def program_time(self, byte_count):
+        """Return the typical time to program byte_count bytes, in seconds."""
+        return self.program_time_per_kib * byte_count / float(KIB)
+
+
+def get_device(chip_id):
+    """Return the DeviceDescriptor of the chip ID, or None if unknown."""
+    global _devices  # pylint: disable=global-statement
+    if _devices is None:
+        _devices = dict((row[0], DeviceDescriptor(*row)) for row in _DEVICE_TABLE)
+    return _devices.get(chip_id)
@@ -0,0 +1,209 @@
+# GitHub repository: https://github.com/florisla/stm32loader
+#
+# This file is part of stm32loader.
+#
+# stm32loader is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# stm32loader is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with stm32loader; see the file LICENSE.  If not see
+# <http://www.gnu.org/licenses/>.
+
+"""Flash several boards at once, one serial port per board."""
+
+from __future__ import print_function
+
+import collections
+import functools
+import os
+import re
+import sys
+import threading
+import time
+
+from .main import DEFAULT_VERBOSITY, Stm32Loader
+
+_clock = getattr(time, "monotonic", time.time)
+
+
+class PortResult(object):
+    """Outcome of flashing the board at one serial port."""
+
+    def __init__(self, port, status, message, duration):
+        """
+        Construct a PortResult.
+
+        :param str port: Serial port of the board.
+        :param int status: Exit status as for a single port: 0 on success.
+        :param str message: 'OK' or the last error message.
+        :param float duration: Time taken, in seconds.
+        """
+        self.port = port
+        self.status = status
+        self.message = message
+        self.duration = duration
+
+    def __repr__(self):
+        values = (self.port, self.status, self.message, self.duration)
+        return "PortResult(%r, %r, %r, %.1f)" % values
+
+
+class _PortLoader(Stm32Loader):
+    """Stm32Loader that prefixes its messages with the serial port."""
+
+    def __init__(self, port):
+        Stm32Loader.__init__(self)
+        self.port = port
+        # last message shown at the lowest verbosity level, for the summary
+        self.last_error = None
+
+    def debug(self, level, message):
+        if level == 0:
+            self.last_error = message.strip().split("\n")[0]
+        Stm32Loader.debug(self, level, "%s: %s" % (self.port, message))
+
+
+class GangLoader(object):
+    """
+    Run the same operations on the boards at several serial ports.
+
+    Each port is handled by its own Stm32Loader, in a pool of threads.
+    The data file is read once, and its Write Memory frames are encoded
+    once, for all boards.  A failing board does not stop the others.
+    """
+
+    # progress is reported in steps of this many percent
+    PROGRESS_STEP = 10
+
+    def __init__(self, ports, configuration, verbosity=DEFAULT_VERBOSITY):
+        """
+        Construct a GangLoader.
+
+        :param ports: Serial port names.
+        :param dict configuration: Stm32Loader configuration; its port is
+          replaced by each of the ports.
+        :param int verbosity: Verbosity level of each loader.
+        """
+        self.ports = list(ports)
+        self.configuration = configuration
+        self.verbosity = verbosity
+        self.image = None
+        self.image_frames = None
+        self._print_lock = threading.Lock()
+        self._progress = {}
+
+    def run(self, jobs=None):
+        """
+        Flash all boards and return a PortResult per port, in port order.
+
+        :param int jobs: Number of boards to flash at once. Defaults to all.
+        """
+        self._load_image()
+        pending = collections.deque(self.ports)
+        results = {}
+
+        def work():
+            while True:
+                try:
+                    port = pending.popleft()
+                except IndexError:
+                    return
+                results[port] = self.flash(port)
+
+        thread_count = min(jobs or len(self.ports), len(self.ports))
+        threads = [threading.Thread(target=work) for _ in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [results[port] for port in self.ports]
+
+    def flash(self, port):
+        """Run the operations on the board at port; return its PortResult."""
+        loader = _PortLoader(port)
+        loader.configuration = dict(self.configuration, port=port)
+        loader.verbosity = self.verbosity
+        loader.image = self.image
+        loader.image_frames = self.image_frames
+        loader.journal_tag = re.sub(r"\W+", "_", port).strip("_")
+        for key in ["trace", "capture"]:
+            if self.configuration[key]:
+                root, extension = os.path.splitext(self.configuration[key])
+                loader.configuration[key] = "%s.%s%s" % (root, loader.journal_tag, extension)
+        if not self.configuration["hide_progress_bar"]:
+            loader.progress_reporter = functools.partial(self.report_progress, port)
+        loader.message_reporter = functools.partial(self.report_message, port)
+
+        start_time = _clock()
+        status = 0
+        message = "OK"
+        try:
+            try:
+                loader.connect()
+                try:
+                    loader.read_device_details()
+                    loader.perform_commands()
+                finally:
+                    loader.reset()
+                    loader.save_trace()
+            finally:
+                loader.close_capture()
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+            if status:
+                message = loader.last_error or "Failed with exit status %d" % status
+        except Exception as e:  # pylint: disable=broad-except
+            # one broken board or link must not abort the other boards
+            status = 1
+            message = str(e) or e.__class__.__name__
+            loader.debug(0, message)
+        return PortResult(port, status, message, _clock() - start_time)
+
+    def report_progress(self, port, count, total, suffix=""):
+        """Show the progress of port, once per PROGRESS_STEP percent."""
+        # pylint: disable=unused-argument
+        percent = 100 * count // total
+        step = percent - percent % self.PROGRESS_STEP
+        with self._print_lock:
+            if self._progress.get(port) == step:
+                return
+            self._progress[port] = step
+            print("%s: %d%%" % (port, step))
+            sys.stdout.flush()
+
+    def report_message(self, port, message):
+        """Show a status message of port, such as 'Verification OK'."""
+        with self._print_lock:
+            print("%s: %s" % (port, message.strip()))
+            sys.stdout.flush()
+
+    def print_summary(self, results):
+        """Print a table with the status of every port."""
+        width = max([len("Port")] + [len(result.port) for result in results])
+        print("\n%-*s  Status  Time     Result" % (width, "Port"))
+        for result in results:
+            print(
+                "%-*s  %6d  %5.1f s  %s"
+                % (width, result.port, result.status, result.duration, result.message)
+            )
+        failed = sum(1 for result in results if result.status)
+        print("%d of %d boards OK" % (len(results) - failed, len(results)))
+
+    def _load_image(self):
+        """Read the data file and encode its frames, once for all boards."""
+        if not (self.configuration["write"] or self.configuration["verify"]):
+            return
+        loader = Stm32Loader()
+        loader.configuration = self.configuration
+        loader.verbosity = self.verbosity
+        self.image = loader.read_image()
+        if self.configuration["write"] and not self.configuration["delta"]:
+            loader.encode_image_frames()
+            self.image_frames = loader.image_frames
@@ -0,0 +1,101 @@
+# GitHub repository: https://github.com/florisla/stm32loader
+#
+# This file is part of stm32loader.
+#
+# stm32loader is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# stm32loader is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with stm32loader; see the file LICENSE.  If not see
+# <http://www.gnu.org/licenses/>.
+
+
+"""
+Drive GPIO lines through the Linux GPIO character device (uAPI v2).
+
+Needs no GPIO library: the lines are requested from /dev/gpiochipN with
+one ioctl, and all of them are set with one ioctl per change.
+"""
+
+import fcntl
+import os
+import struct
+
+# struct gpio_v2_line_request in <linux/gpio.h>: offsets, consumer, config
+# (flags, attribute count, attributes), line count, event buffer size, fd
+_LINE_REQUEST = struct.Struct("=64I32sQI20x" + "IxxxxQQ" * 10 + "II20xi")
+# struct gpio_v2_line_values: bits, mask
+_LINE_VALUES = struct.Struct("=QQ")
+
+LINES_MAX = 64
+ATTRIBUTES_MAX = 10
+LINE_FLAG_OUTPUT = 1 << 3
+ATTRIBUTE_ID_OUTPUT_VALUES = 2
+
+
+def _iowr(number, size):
+    """Return the _IOWR() ioctl request code of the GPIO character device."""
+    return (3 << 30) | (size << 16) | (0xB4 << 8) | number
+
+
+GET_LINE_IOCTL = _iowr(0x07, _LINE_REQUEST.size)
+LINE_SET_VALUES_IOCTL = _iowr(0x0F, _LINE_VALUES.size)
+
+# replaced by tests to simulate a GPIO chip
+_ioctl = fcntl.ioctl
+
+
+class GpioLines(object):
+    """
+    Output lines of a GPIO chip, requested together.
+
+    Line values are bit masks: bit i is the value of the i-th requested
+    line, 1 being a high level.
+    """
+
+    def __init__(self, chip_path, offsets, values=0, consumer="stm32loader"):
+        """
+        Request the lines as outputs with the given initial values.
+
+        :param str chip_path: GPIO chip device, e.g. /dev/gpiochip0.
+        :param list offsets: Line numbers on the chip.
+        :param int values: Initial line values.
+        :raise IOError: If the chip can not be opened or the lines are
+          not available.
+        """
+        if not 0 < len(offsets) <= LINES_MAX:
+            raise ValueError("Can request 1 to %d lines, not %d." % (LINES_MAX, len(offsets)))
+        self.chip_path = chip_path
+        self.offsets = list(offsets)
+        self._mask = (1 << len(self.offsets)) - 1
+        fields = self.offsets + [0] * (LINES_MAX - len(self.offsets))
+        fields.extend([consumer.encode("ascii"), LINE_FLAG_OUTPUT, 1])
+        fields.extend([ATTRIBUTE_ID_OUTPUT_VALUES, values & self._mask, self._mask])
+        fields.extend([0, 0, 0] * (ATTRIBUTES_MAX - 1))
+        fields.extend([len(self.offsets), 0, -1])
+        request = bytearray(_LINE_REQUEST.pack(*fields))
+        chip_fd = os.open(chip_path, os.O_RDWR)
+        try:
+            _ioctl(chip_fd, GET_LINE_IOCTL, request)
+        finally:
+            os.close(chip_fd)
+        self._fd = _LINE_REQUEST.unpack(bytes(request))[-1]
+
+    def set_values(self, values):
+        """Set all lines to the given values at once."""
+        _ioctl(
+            self._fd, LINE_SET_VALUES_IOCTL, _LINE_VALUES.pack(values & self._mask, self._mask)
+        )
+
+    def close(self):
+        """Release the lines; they keep their last value."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,271 @@
+# GitHub repository: https://github.com/florisla/stm32loader
+#
+# This file is part of stm32loader.
+#
+# stm32loader is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# stm32loader is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with stm32loader; see the file LICENSE.  If not see
+# <http://www.gnu.org/licenses/>.
+
+"""Load firmware images with gaps: Intel HEX, Motorola S-record and ELF."""
+
+import binascii
+import hashlib
+import os
+import struct
+
+from .bootloader import Stm32LoaderError
+
+HEX_EXTENSIONS = [".hex", ".ihex", ".ihx"]
+SREC_EXTENSIONS = [".srec", ".s19", ".s28", ".s37", ".mot"]
+
+ELF_MAGIC = b"\x7fELF"
+
+
+class ImageError(Stm32LoaderError):
+    """Exception: the image file can not be parsed."""
+
+
+class Segment(object):
+    """Contiguous populated memory range of an image."""
+
+    # pylint: disable=too-few-public-methods
+
+    __slots__ = ["address", "data"]
+
+    def __init__(self, address, data):
+        """
+        Construct a Segment.
+
+        :param int address: Memory address of the first byte.
+        :param bytearray data: Content of the range.
+        """
+        self.address = address
+        self.data = data
+
+    @property
+    def end(self):
+        """Address just past the last byte."""
+        return self.address + len(self.data)
+
+    def __repr__(self):
+        return "Segment(0x%X, %d bytes)" % (self.address, len(self.data))
+
+
+class MemoryImage(object):
+    """
+    Memory content as a sorted list of non-overlapping segments.
+
+    Only the populated ranges are stored; a flat binary file is a
+    single segment.
+    """
+
+    def __init__(self):
+        """Construct an empty MemoryImage."""
+        self.segments = []
+
+    def add(self, address, data):
+        """Add data at address, replacing any existing content it overlaps."""
+        data = bytearray(data)
+        if not data:
+            return
+        end = address + len(data)
+        if self.segments and self.segments[-1].end == address:
+            # records of a file usually follow each other
+            self.segments[-1].data.extend(data)
+            return
+        touching = [
+            segment
+            for segment in self.segments
+            if segment.address <= end and segment.end >= address
+        ]
+        if touching:
+            start = min(address, touching[0].address)
+            merged = bytearray(max(end, touching[-1].end) - start)
+            for segment in touching:
+                merged[segment.address - start : segment.end - start] = segment.data
+                self.segments.remove(segment)
+            merged[address - start : end - start] = data
+            address, data = start, merged
+        self.segments.append(Segment(address, data))
+        self.segments.sort(key=lambda segment: segment.address)
+
+    @property
+    def size(self):
+        """Number of populated bytes."""
+        return sum(len(segment.data) for segment in self.segments)
+
+    def merged(self, chunk_size):
+        """
+        Return a copy with nearby segments joined where that saves chunks.
+
+        Gaps between joined segments are filled with 0xFF, the content of
+        erased flash.
+
+        :param int chunk_size: Bytes per transfer, e.g. 256 for Write Memory.
+        """
+        image = MemoryImage()
+        for segment in self.segments:
+            if image.segments:
+                last = image.segments[-1]
+                separate = _chunk_count(len(last.data), chunk_size) + _chunk_count(
+                    len(segment.data), chunk_size
+                )
+                if _chunk_count(segment.end - last.address, chunk_size) < separate:
+                    last.data.extend(b"\xff" * (segment.address - last.end))
+                    last.data.extend(segment.data)
+                    continue
+            image.segments.append(Segment(segment.address, bytearray(segment.data)))
+        return image
+
+    def digest(self):
+        """Return a SHA-256 hex digest of the addresses and content."""
+        digest = hashlib.sha256()
+        for segment in self.segments:
+            digest.update(struct.pack(">II", segment.address, len(segment.data)))
+            digest.update(segment.data)
+        return digest.hexdigest()
+
+
+def _chunk_count(length, chunk_size):
+    return (length + chunk_size - 1) // chunk_size
+
+
+def load_image(file_name, address):
+    """
+    Return the MemoryImage of the given file.
+
+    ELF files are recognized by their content, Intel HEX and S-record
+    files by their extension (see HEX_EXTENSIONS, SREC_EXTENSIONS).
+    Any other file is a flat binary.
+
+    :param str file_name: Image file.
+    :param int address: Load address of a flat binary; other formats
+      hold their own addresses.
+    """
+    with open(file_name, "rb") as image_file:
+        content = image_file.read()
+    extension = os.path.splitext(file_name)[1].lower()
+    if content.startswith(ELF_MAGIC):
+        return parse_elf(content)
+    if extension in HEX_EXTENSIONS:
+        return parse_intel_hex(content)
+    if extension in SREC_EXTENSIONS:
+        return parse_srec(content)
+    image = MemoryImage()
+    image.add(address, content)
+    return image
+
+
+def parse_intel_hex(content):
+    """Return the MemoryImage of Intel HEX file content."""
+    image = MemoryImage()
+    base = 0
+    for line_number, _record_type, record in _records(content, b":"):
+        count, offset, record_type = struct.unpack(">BHB", bytes(record[:4]))
+        if count + 5 != len(record):
+            raise ImageError("Line %d: wrong byte count." % line_number)
+        if sum(record) & 0xFF:
+            raise ImageError("Line %d: wrong checksum." % line_number)
+        data = record[4:-1]
+        if record_type == 0x00:
+            image.add(base + offset, data)
+        elif record_type == 0x01:
+            break
+        elif record_type == 0x02:
+            # extended segment address
+            base = struct.unpack(">H", bytes(data))[0] << 4
+        elif record_type == 0x04:
+            # extended linear address
+            base = struct.unpack(">H", bytes(data))[0] << 16
+        # 0x03 and 0x05 hold the start address, which flashing doesn't need
+    return image
+
+
+def parse_srec(content):
+    """Return the MemoryImage of Motorola S-record file content."""
+    image = MemoryImage()
+    # address byte count of the data records S1, S2 and S3
+    address_lengths = {b"1": 2, b"2": 3, b"3": 4}
+    for line_number, record_type, record in _records(content, b"S", type_length=1):
+        if record[0] + 1 != len(record):
+            raise ImageError("Line %d: wrong byte count." % line_number)
+        if sum(record) & 0xFF != 0xFF:
+            raise ImageError("Line %d: wrong checksum." % line_number)
+        address_length = address_lengths.get(record_type)
+        if address_length:
+            address = int(binascii.hexlify(bytes(record[1 : 1 + address_length])), 16)
+            image.add(address, record[1 + address_length : -1])
+    return image
+
+
+def _records(content, start_code, type_length=0):
+    """Yield line number, type code and decoded bytes of each text record."""
+    for line_number, line in enumerate(content.splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        if not line.startswith(start_code):
+            raise ImageError("Line %d: not a record." % line_number)
+        record_type = line[len(start_code) : len(start_code) + type_length]
+        try:
+            record = bytearray(binascii.unhexlify(line[len(start_code) + type_length :]))
+        except (TypeError, ValueError):
+            raise ImageError("Line %d: invalid hexadecimal data." % line_number)
+        # at least byte count, address and checksum
+        if len(record) < 4:
+            raise ImageError("Line %d: record too short." % line_number)
+        yield line_number, record_type, record
+
+
+def parse_elf(content):
+    """
+    Return the MemoryImage of ELF file content.
+
+    The content of all loadable program segments is placed at their
+    physical (load) address; initialized RAM data thus ends up in flash.
+    """
+    if len(content) < 16 or not content.startswith(ELF_MAGIC):
+        raise ImageError("Not an ELF file.")
+    elf_class, byte_order = struct.unpack("BB", content[4:6])
+    endian = {1: "<", 2: ">"}.get(byte_order)
+    if elf_class == 1:
+        header_format, program_header_format = "HHIIIIIHHH", "IIIIIIII"
+    elif elf_class == 2:
+        header_format, program_header_format = "HHIQQQIHHH", "IIQQQQQQ"
+    else:
+        endian = None
+    if endian is None:
+        raise ImageError("Unsupported ELF class or byte order.")
+    header_struct = struct.Struct(endian + header_format)
+    program_header_struct = struct.Struct(endian + program_header_format)
+    try:
+        header = header_struct.unpack_from(content, 16)
+        program_header_offset = header[4]
+        entry_size, entry_count = header[8], header[9]
+        image = MemoryImage()
+        for index in range(entry_count):
+            fields = program_header_struct.unpack_from(
+                content, program_header_offset + index * entry_size
+            )
+            if elf_class == 1:
+                segment_type, offset, _virtual, physical, file_size = fields[:5]
+            else:
+                segment_type, _flags, offset, _virtual, physical, file_size = fields[:6]
+            # PT_LOAD; the rest of a segment in memory (.bss) is not in file
+            if segment_type == 1 and file_size:
+                if offset + file_size > len(content):
+                    raise ImageError("Program segment %d is truncated." % index)
+                image.add(physical, content[offset : offset + file_size])
+    except struct.error:
+        raise ImageError("Truncated ELF headers.")
+    return image
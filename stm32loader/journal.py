@@ -0,0 +1,85 @@
+# GitHub repository: https://github.com/florisla/stm32loader
+#
+# This file is part of stm32loader.
+#
+# stm32loader is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# stm32loader is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with stm32loader; see the file LICENSE.  If not see
+# <http://www.gnu.org/licenses/>.
+
+"""Remember the progress of long operations so they can be resumed."""
+
+import json
+import os
+
+# atomic on all platforms, but not available in Python 2
+_replace = getattr(os, "replace", os.rename)
+
+
+class Journal(object):
+    """
+    Progress record of an operation, kept in a small sidecar file.
+
+    The record stores a key that identifies the operation (address,
+    length, image hash...) and the byte offset up to which the
+    operation is confirmed.  Progress is only resumed when the key
+    matches.
+    """
+
+    def __init__(self, path, key, save_interval=0):
+        """
+        Construct a Journal.
+
+        :param str path: File name of the sidecar file.
+        :param dict key: JSON-serializable description of the operation.
+        :param int save_interval: Minimum progress in bytes between two
+          saves by update().
+        """
+        self.path = path
+        self.key = key
+        self.save_interval = save_interval
+        self.offset = 0
+        self._saved_offset = 0
+
+    def load(self):
+        """Return the confirmed offset of a matching earlier run, or 0."""
+        try:
+            with open(self.path, "r") as journal_file:
+                record = json.load(journal_file)
+        except (IOError, OSError, ValueError):
+            return 0
+        if record.get("key") != self.key:
+            return 0
+        return record.get("offset", 0)
+
+    def update(self, offset):
+        """Remember the confirmed offset; save it each save_interval bytes."""
+        self.offset = offset
+        if offset - self._saved_offset >= self.save_interval:
+            self.save()
+
+    def save(self, offset=None):
+        """Record that the operation is confirmed up to the given offset."""
+        if offset is not None:
+            self.offset = offset
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as journal_file:
+            json.dump({"key": self.key, "offset": self.offset}, journal_file)
+        _replace(temporary_path, self.path)
+        self._saved_offset = self.offset
+
+    def discard(self):
+        """Remove the sidecar file, if any."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
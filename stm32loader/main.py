@@ -23,12 +23,16 @@
 
 from __future__ import print_function
 
+import functools
 import getopt
+import glob
 import os
 import sys
+import time
 
-from . import bootloader
-from .uart import SerialConnection
+# modules that only some operations need are imported where they are used,
+# to keep the start-up time short
+from . import backends, bootloader
 
 # sbc_type = os.getenv('STM32LOADER_SBC',None)
 
@@ -57,22 +61,62 @@ class Stm32Loader:
         "-n": "hide_progress_bar",
         "-R": "reset_active_high",
         "-B": "boot0_active_low",
+        "--delta": "delta",
+        "--resume": "resume",
+        "--no-reset": "no_reset",
+        "--stay-in-bootloader": "stay_in_bootloader",
     }
 
     SBC_TYPES = ["tinker", "rpi", "upboard"]
 
     INTEGER_OPTIONS = {"-b": "baud", "-a": "address", "-g": "go_address", "-l": "length"}
 
+    LONG_OPTIONS = [
+        "help",
+        "delta",
+        "resume",
+        "reset-hold=",
+        "jobs=",
+        "no-reset",
+        "stay-in-bootloader",
+        "trace=",
+        "capture=",
+        "replay=",
+        "cache=",
+        "backend=",
+    ]
+
+    # a read (-r) is flushed to disk and recorded in the journal in blocks
+    # of this size; a multiple of mmap.ALLOCATIONGRANULARITY
+    DUMP_BLOCK_SIZE = 64 * 1024
+
+    # tried from fastest to slowest by -b auto
+    AUTO_BAUD_RATES = [921600, 460800, 230400, 115200, 57600]
+    DEFAULT_BAUD_RATE = 115200
+    # with -b auto, this many link errors within LINK_ERROR_WINDOW chunk
+    # transfers make the baud rate fall back to the next lower rate
+    LINK_ERROR_LIMIT = 2
+    LINK_ERROR_WINDOW = 64
+    # retries of a failed data chunk with -b auto
+    CHUNK_RETRIES = 3
+    # pause before the second attempt to enter the bootloader; doubles
+    # for every next attempt
+    CONNECT_RETRY_DELAY = 0.05  # seconds
+
+    # a write (-w) records its progress in the journal every so many bytes
+    JOURNAL_SAVE_INTERVAL = 4 * 1024
+
     def __init__(self):
         """Construct Stm32Loader object with default settings."""
         self.stm32 = None
         self.configuration = {
             "port": os.environ.get("STM32LOADER_SERIAL_PORT"),
-            "baud": 115200,
+            "baud": self.DEFAULT_BAUD_RATE,
             "parity": self.PARITY["even"],
             "family": os.environ.get("STM32LOADER_FAMILY"),
             "address": 0x08000000,
             "core2_mode": None,
+            "backend": backends.DEFAULT_BACKEND,
             "write-unprotect": False,
             "erase": False,
             "unprotect": False,
@@ -84,21 +128,62 @@ class Stm32Loader:
             "reset_active_high": False,
             "boot0_active_low": False,
             "hide_progress_bar": False,
+            "delta": False,
+            "resume": False,
+            "no_reset": False,
+            "stay_in_bootloader": False,
+            "length": None,
+            "reset_hold": None,
+            "jobs": None,
+            "trace": None,
+            "capture": None,
+            "replay": None,
+            "cache": None,
             "data_file": None,
         }
         self.verbosity = DEFAULT_VERBOSITY
         self.max_communication_attempts = 5
+        # chunk transfer counts at recent link errors, for -b auto
+        self._link_errors = []
+        # filled in by read_device_details()
+        self.device_id = None
+        self.device_uid = None
+        # all serial ports given with -p, after glob expansion
+        self.ports = []
+        # MemoryImage of the data file for -w and -v; set in advance to
+        # share it among loaders
+        self.image = None
+        # Write Memory frames of all write_segments(), see
+        # Stm32Bootloader.encode_data_frames()
+        self.image_frames = None
+        # replaces the progress bar, see Stm32Bootloader.progress_reporter
+        self.progress_reporter = None
+        # replaces printing status messages, see report()
+        self.message_reporter = None
+        # distinguishes the write journals of loaders that write the same file
+        self.journal_tag = None
+        # CaptureConnection that records the traffic (--capture)
+        self.capture = None
 
     def debug(self, level, message):
         """Log a message to stderror if its level is low enough."""
         if self.verbosity >= level:
             print(message, file=sys.stderr)
 
+    def report(self, message):
+        """Print a status message, or pass it to message_reporter if set."""
+        if self.message_reporter:
+            self.message_reporter(message)
+            return
+        print(message)
+
     def parse_arguments(self, arguments):
         """Parse the list of command-line arguments."""
         try:
             # parse command-line arguments using getopt
-            options, arguments = getopt.getopt(arguments, "hqVeuwvrsnRBWP:p:b:a:l:g:f:c:", ["help"])
+            options, arguments = getopt.getopt(
+                arguments, "hqVeuwvrsnRBWP:p:b:a:l:g:f:c:", self.LONG_OPTIONS
+            )
         except getopt.GetoptError as err:
             # print help information and exit:
             # this prints something like "option -a not recognized"
@@ -112,6 +197,10 @@ class Stm32Loader:
 
         self._parse_option_flags(options)
 
+        if self.configuration["replay"] and not self.configuration["port"]:
+            # the capture takes the place of the serial port
+            self.configuration["port"] = self.configuration["replay"]
+
         if not self.configuration["port"]:
             self.debug(0,
                 "No serial port configured. Supply the -p option "
@@ -119,35 +208,44 @@ class Stm32Loader:
             )
             sys.exit(3)
 
+        self.ports = expand_ports(self.ports or [self.configuration["port"]])
+        if not self.ports:
+            self.debug(0, "No serial port matches %s." % self.configuration["port"])
+            sys.exit(3)
+        self.configuration["port"] = self.ports[0]
+
+        if self.configuration["replay"] and len(self.ports) > 1:
+            self.debug(0, "Replaying a capture (--replay) needs a single serial port.")
+            sys.exit(3)
+
+        if self.configuration["read"] and len(self.ports) > 1:
+            self.debug(0, "Reading (-r) needs a single serial port.")
+            sys.exit(3)
+
+        if self.configuration["read"] and not self.configuration["length"]:
+            self.debug(0, "No read length configured. Supply the -l option.")
+            sys.exit(3)
+
     def connect(self):
         """Connect to the RS-232 serial port."""
-        if self.configuration["core2_mode"] is not None:
-            if self.configuration["core2_mode"] in ["rpi", 'tinker']:
-                try:
-                    from .uart_gpios import SerialConnectionRpi
-                except ImportError as e:
-                    self.debug(0, "There was an error during importing SerialConnectionRpi:" + str(e))
-                    sys.exit(4)
-                else:
-                    serial_connection = SerialConnectionRpi(
-                        self.configuration["port"], self.configuration["baud"], self.configuration["parity"]
-                    )
-            elif self.configuration["core2_mode"] == "upboard":
-                try:
-                    from .uart_gpios import SerialConnectionUpboard
-                except ImportError as e:
-                    self.debug(0, "There was an error during importing SerialConnectionUpboard:" + str(e))
-                    sys.exit(4)
-                else:
-                    serial_connection = SerialConnectionUpboard(
-                        self.configuration["port"], self.configuration["baud"], self.configuration["parity"]
-                    )
+        auto_baud = self.configuration["baud"] == "auto"
+        if auto_baud:
+            self.configuration["baud"] = self.AUTO_BAUD_RATES[0]
+        if self.configuration["replay"]:
+            from .capture import ReplayConnection
+
+            serial_connection = ReplayConnection.load(self.configuration["replay"])
         else:
-            serial_connection = SerialConnection(
-                self.configuration["port"],
-                self.configuration["baud"],
-                self.configuration["parity"]
-            )
+            try:
+                serial_connection = backends.create_connection(
+                    self.configuration["backend"],
+                    self.configuration["port"],
+                    self.configuration["baud"],
+                    self.configuration["parity"],
+                )
+            except backends.BackendError as e:
+                self.debug(0, str(e))
+                sys.exit(4)
         self.debug(
             10,
             "Open port %(port)s, baud %(baud)d"
@@ -157,10 +255,21 @@ class Stm32Loader:
         serial_connection.swap_rts_dtr = self.configuration["swap_rts_dtr"]
         serial_connection.reset_active_high = self.configuration["reset_active_high"]
         serial_connection.boot0_active_low = self.configuration["boot0_active_low"]
-        
+        if self.configuration["no_reset"]:
+            serial_connection.can_toggle_reset = False
+            serial_connection.can_toggle_boot0 = False
+        if self.configuration["capture"]:
+            from .capture import CaptureConnection
+
+            capture_file = self.configuration["capture"]
+            serial_connection = CaptureConnection(serial_connection, capture_file)
+            self.capture = serial_connection
+
         try:
-            serial_connection.enable_boot0(False)
-            serial_connection.enable_reset(False)
+            if serial_connection.can_toggle_boot0:
+                serial_connection.enable_boot0(False)
+            if serial_connection.can_toggle_reset:
+                serial_connection.enable_reset(False)
         except IOError:
             self.debug(0, "Permission issue: couldn't set boot0 and reset pins. Try use with sudo.")
             sys.exit(5)
@@ -170,6 +279,19 @@ class Stm32Loader:
         self.stm32 = bootloader.Stm32Bootloader(
             serial_connection, verbosity=self.verbosity, show_progress=show_progress
         )
+        self.stm32.device_family = self.configuration["family"]
+        self.stm32.adaptive_timeouts = True
+        # late replies fall back to the default timeout; a chunk that
+        # fails nevertheless is tried once more
+        self.stm32.chunk_retries = 1
+        self.stm32.progress_reporter = self.progress_reporter
+        self.stm32.message_reporter = self.message_reporter
+        if self.configuration["trace"]:
+            from .trace import CommandTrace
+
+            self.stm32.trace = CommandTrace()
+        if self.configuration["reset_hold"] is not None:
+            self.stm32.reset_hold_time = self.configuration["reset_hold"] / 1000.0
 
         try:
             serial_connection.connect()
@@ -185,6 +307,22 @@ class Stm32Loader:
             )
             sys.exit(6)
 
+        if auto_baud and not serial_connection.can_toggle_reset:
+            self.debug(0, "Baud rate detection needs reset control; using default baud rate.")
+            serial_connection.baud_rate = self.configuration["baud"] = self.DEFAULT_BAUD_RATE
+        elif auto_baud:
+            self.select_baud_rate()
+            return
+
+        # skip the reset sequence if a previous run left the bootloader
+        # running (--stay-in-bootloader); without reset control, the
+        # bootloader may still wait for its synchronization byte, and
+        # probing would spoil its baud rate detection
+        if serial_connection.can_toggle_reset and self.stm32.probe():
+            self.debug(10, "Bootloader is active, skipping reset.")
+            return
+
+        retry_delay = self.CONNECT_RETRY_DELAY
         for i in range(1, self.max_communication_attempts + 1):
             try:
                 self.stm32.reset_from_system_memory()
@@ -192,24 +330,95 @@ class Stm32Loader:
                 self.debug(0,
                     "Attempt {} Can't init into bootloader: {}".format(i, e)
                 )
-            else:
-                self.debug(10,"Attempt {} was successfull.".format(i))
-                break
-            finally:
-                if(i == self.max_communication_attempts):
+                if i == self.max_communication_attempts:
                     self.debug(0,"Communication failure. Quitting...")
                     self.reset()
                     sys.exit(7)
+                time.sleep(retry_delay)
+                retry_delay *= 2
+            else:
+                self.debug(10,"Attempt {} was successfull.".format(i))
+                break
         self.debug(10, "Successfully communicated with bootloader.")
 
+    def select_baud_rate(self):
+        """
+        Use the fastest of AUTO_BAUD_RATES that passes test round trips.
+
+        At each rate, the MCU is reset and synchronized, and must answer
+        a Get command and a full-size Read Memory command.  If no rate
+        passes the read (e.g. due to readout protection), the fastest rate
+        that passed Get is used.
+
+        Afterwards, failed chunk transfers are retried, and the rate falls
+        back to a lower one if link errors repeat.
+        """
+        connection = self.stm32.connection
+        selected_rate = None
+        for baud_rate in self.AUTO_BAUD_RATES:
+            connection.baud_rate = baud_rate
+            try:
+                self.stm32.reset_from_system_memory()
+                self.stm32.get()
+            except bootloader.CommandError as e:
+                self.debug(10, "Baud rate %d failed: %s" % (baud_rate, e))
+                continue
+            selected_rate = selected_rate or baud_rate
+            try:
+                self.stm32.read_memory(
+                    self.stm32.FLASH_START_ADDRESS, self.stm32.DATA_TRANSFER_SIZE
+                )
+            except bootloader.CommandError as e:
+                self.debug(10, "Baud rate %d failed to read: %s" % (baud_rate, e))
+                continue
+            selected_rate = baud_rate
+            break
+        else:
+            if selected_rate is None:
+                self.debug(0, "Communication failure at all baud rates. Quitting...")
+                self.reset()
+                sys.exit(7)
+            connection.baud_rate = selected_rate
+            self.stm32.reset_from_system_memory()
+
+        self.debug(0, "Baud rate: %d" % selected_rate)
+        self.configuration["baud"] = selected_rate
+        self.stm32.chunk_retries = self.CHUNK_RETRIES
+        self.stm32.link_recovery = self._recover_link
+
+    def _recover_link(self, error):
+        """Reset and resynchronize, at a lower baud rate if errors repeat."""
+        # pylint: disable=unused-argument
+        transfers = self.stm32.chunk_transfers
+        self._link_errors = [
+            count for count in self._link_errors if transfers - count < self.LINK_ERROR_WINDOW
+        ]
+        self._link_errors.append(transfers)
+        connection = self.stm32.connection
+        lower_rates = [rate for rate in self.AUTO_BAUD_RATES if rate < connection.baud_rate]
+        if len(self._link_errors) >= self.LINK_ERROR_LIMIT and lower_rates:
+            self._link_errors = []
+            connection.baud_rate = self.configuration["baud"] = lower_rates[0]
+            self.debug(0, "Link errors; falling back to %d baud" % lower_rates[0])
+        self.stm32.reset_from_system_memory()
 
     def perform_commands(self):
         """Run all operations as defined by the configuration."""
         # pylint: disable=too-many-branches
-        binary_data = None
+        image = None
         if self.configuration["write"] or self.configuration["verify"]:
-            with open(self.configuration["data_file"], "rb") as read_file:
-                binary_data = bytearray(read_file.read())
+            image = self.read_image()
+        flash_cache = self._flash_cache()
+        if flash_cache and not self.device_uid:
+            self.debug(5, "Flash cache needs the device UID; supply -f [family]")
+            flash_cache = None
+        already_flashed = False
+        if flash_cache and self.configuration["write"] and not self.configuration["unprotect"]:
+            already_flashed = self._is_already_flashed(flash_cache, image)
+        if already_flashed:
+            self.debug(0, "Flash already holds this image; skipping erase, write and verify")
+        elif flash_cache and (self.configuration["write"] or self.configuration["erase"]):
+            flash_cache.forget(self.device_uid)
         if self.configuration["unprotect"]:
             try:
                 self.stm32.readout_unprotect()
@@ -233,9 +442,50 @@ class Stm32Loader:
                 sys.exit(1)
             else:
                 self.debug(0, "write unprotect done")
-        if self.configuration["erase"]:
+        write = self.configuration["write"] and not already_flashed
+        delta_write = write and self.configuration["delta"]
+        if delta_write and not self.stm32.page_layout_known:
+            # guessing the page size would erase pages outside of the image
+            self.debug(
+                0,
+                "Delta write needs the flash page layout, which is unknown for "
+                "chip family %s. Leave out --delta to do a full write."
+                % (self.configuration["family"] or "(none)"),
+            )
+            sys.exit(3)
+        resume_write = write and not delta_write and self.configuration["resume"]
+        if resume_write and not self.stm32.page_layout_known:
+            # damaged data is erased page by page before writing again
+            self.debug(
+                0,
+                "Resuming a write needs the flash page layout, which is unknown for "
+                "chip family %s. Leave out --resume to do a full write."
+                % (self.configuration["family"] or "(none)"),
+            )
+            sys.exit(3)
+        write_journal = None
+        resume_offset = 0
+        if resume_write:
+            # only a write with --resume records its progress
+            write_journal = self._write_journal(image)
+            resume_offset = write_journal.load()
+            if not resume_offset:
+                try:
+                    write_journal.save(0)
+                except (IOError, OSError) as e:
+                    self.debug(5, "Can not record write progress: %s" % e)
+                    write_journal = None
+        if resume_offset:
+            # the earlier, interrupted run did the erase
+            self.debug(0, "Resume interrupted write; skipping erase")
+        elif self.configuration["erase"] and not delta_write and not already_flashed:
+            erase_pages = self._image_pages(image)
+            self._show_time_estimate(image if write else None, erase_pages)
             try:
-                self.stm32.erase_memory()
+                if erase_pages is None:
+                    self.stm32.erase_memory()
+                else:
+                    self.stm32.erase_pages(erase_pages)
             except bootloader.CommandError as e:
                 # may be caused by readout protection
                 self.debug(
@@ -246,50 +496,316 @@ class Stm32Loader:
                 self.debug(0, str(e))
                 self.reset()
                 sys.exit(1)
-        if self.configuration["write"]:
-            #TODO: erase required sectors
-            self.stm32.write_memory_data(self.configuration["address"], binary_data)
-        if self.configuration["verify"]:
-            read_data = self.stm32.read_memory_data(
-                self.configuration["address"], len(binary_data)
-            )
-            try:
-                bootloader.Stm32Bootloader.verify_data(read_data, binary_data)
-                print("Verification OK")
-            except bootloader.DataMismatchError as e:
-                print("Verification FAILED: %s" % e)
+        if delta_write:
+            # erases only the pages that differ, so -e is not needed;
+            # the gaps between segments keep their current content
+            changed_pages = set()
+            for segment in image.segments:
+                changed_pages.update(
+                    self.stm32.write_memory_delta(segment.address, segment.data)
+                )
+            self.debug(0, "Delta write: rewrote %d pages" % len(changed_pages))
+        elif write:
+            self.write_image(image, write_journal, resume_offset)
+        if self.configuration["verify"] and not already_flashed:
+            # compare all populated ranges, including blank chunks that
+            # were skipped while writing
+            mismatches = []
+            for segment in image.segments:
+                try:
+                    self.stm32.verify_memory_data(segment.address, segment.data)
+                except bootloader.DataMismatchError as e:
+                    if not e.mismatches:
+                        self.report("Verification FAILED: %s" % e)
+                        sys.exit(1)
+                    for mismatch in e.mismatches:
+                        mismatch.offset += segment.address
+                    mismatches.extend(e.mismatches)
+            if mismatches:
+                self.report("Verification FAILED: %s" % bootloader.format_mismatches(mismatches))
                 sys.exit(1)
+            self.report("Verification OK")
+            if flash_cache:
+                flash_cache.store(self.device_uid, image)
         if not self.configuration["write"] and self.configuration["read"]:
-            read_data = self.stm32.read_memory_data(
-                self.configuration["address"], self.configuration["length"]
-            )
-            with open(self.configuration["data_file"], "wb") as out_file:
-                out_file.write(read_data)
+            self.dump_memory()
         if self.configuration["go_address"] != -1:
             self.stm32.go(self.configuration["go_address"])
 
+    def _flash_cache(self):
+        """Return the FlashCache of --cache, or None if not used."""
+        if not self.configuration["cache"]:
+            return None
+        from .cache import FlashCache
+
+        return FlashCache(self.configuration["cache"])
+
+    def _is_already_flashed(self, flash_cache, image):
+        """
+        Return True if the image was verified on this device before and
+        a quick check confirms the flash still holds it.
+        """
+        if not flash_cache.lookup(self.device_uid, image):
+            return False
+        for segment in image.segments:
+            if not self.stm32.check_memory_data(segment.address, segment.data):
+                self.debug(5, "Flash changed since the image was verified")
+                return False
+        return True
+
+    def read_image(self):
+        """
+        Return the MemoryImage of the data file, reading it only once.
+
+        A flat binary file is loaded at the -a address; HEX, S-record
+        and ELF files hold their own addresses.
+        """
+        if self.image is None:
+            from .image import ImageError, load_image
+
+            try:
+                self.image = load_image(
+                    self.configuration["data_file"], self.configuration["address"]
+                )
+            except ImageError as e:
+                self.debug(0, "Can not load %s: %s" % (self.configuration["data_file"], e))
+                sys.exit(1)
+            if len(self.image.segments) > 1:
+                self.debug(
+                    5,
+                    "Image has %d segments, %d bytes"
+                    % (len(self.image.segments), self.image.size),
+                )
+        return self.image
+
+    def encode_image_frames(self):
+        """Encode the Write Memory frames of the image in advance."""
+        self.image_frames = []
+        for segment in write_segments(self.read_image()):
+            self.image_frames.extend(bootloader.Stm32Bootloader.encode_data_frames(segment.data))
+
+    def write_image(self, image, journal=None, resume_offset=0):
+        """
+        Write the image to flash, recording progress in the journal.
+
+        The journal offset counts the bytes of write_segments(image) as if
+        they were concatenated.  If the write fails, the journal keeps the
+        confirmed offset so that a run with --resume can continue there,
+        without erasing again.
+        """
+        skip_blank = None
+        if resume_offset:
+            # flash was erased by the interrupted run
+            skip_blank = True
+        chunk_size = self.stm32.DATA_TRANSFER_SIZE
+        # offset of the segment in the concatenated segments
+        base = 0
+        frame_index = 0
+        segments = write_segments(image)
+        for segment in segments:
+            address, data = segment.address, segment.data
+            chunk_count = (len(data) + chunk_size - 1) // chunk_size
+            frames = None
+            if self.image_frames:
+                frames = self.image_frames[frame_index : frame_index + chunk_count]
+            frame_index += chunk_count
+            start_offset = 0
+            if resume_offset >= base + len(data):
+                base += len(data)
+                continue
+            if resume_offset:
+                start_offset = self.stm32.resync_write(
+                    address,
+                    data,
+                    max(resume_offset - base, 0),
+                    image_bytes=functools.partial(_segment_bytes, segments),
+                )
+                resume_offset = 0
+            progress_callback = None
+            if journal:
+                progress_callback = functools.partial(_add_offset, journal.update, base)
+            try:
+                self.stm32.write_memory_data(
+                    address,
+                    data,
+                    skip_blank=skip_blank,
+                    start_offset=start_offset,
+                    progress_callback=progress_callback,
+                    frames=frames,
+                )
+            except (bootloader.CommandError, IOError):
+                if journal:
+                    journal.save()
+                    self.debug(
+                        0,
+                        "Write interrupted at address 0x%X; run again with --resume to continue."
+                        % (address + journal.offset - base),
+                    )
+                raise
+            base += len(data)
+            if journal:
+                # a resumed write starts in the segment that was interrupted
+                journal.save(base)
+        if journal:
+            journal.discard()
+
+    def _write_journal(self, image):
+        """Return the Journal of writing this image to this device."""
+        key = {
+            "image": image.digest(),
+            "address": self.configuration["address"],
+            "device": self.device_uid or self.configuration["port"],
+        }
+        file_name = self.configuration["data_file"]
+        if self.journal_tag:
+            file_name += "." + self.journal_tag
+        from .journal import Journal
+
+        return Journal(file_name + ".journal", key, self.JOURNAL_SAVE_INTERVAL)
+
+    def dump_memory(self):
+        """
+        Stream flash content to the data file.
+
+        The file is preallocated and memory-mapped; every DUMP_BLOCK_SIZE
+        bytes it is flushed and the progress is recorded in a sidecar
+        file, so that --resume can continue an interrupted read.
+        """
+        import mmap
+
+        from .journal import Journal
+
+        address = self.configuration["address"]
+        length = self.configuration["length"]
+        file_name = self.configuration["data_file"]
+        journal = Journal(file_name + ".progress", {"address": address, "length": length})
+        offset = 0
+        if self.configuration["resume"] and os.path.isfile(file_name):
+            if os.path.getsize(file_name) == length:
+                offset = journal.load()
+        if offset:
+            self.debug(0, "Resume reading at address 0x%X" % (address + offset))
+
+        chunk_size = self.stm32.DATA_TRANSFER_SIZE
+        chunk_count = (length + chunk_size - 1) // chunk_size
+        with open(file_name, "r+b" if offset else "w+b") as dump_file:
+            dump_file.truncate(length)
+            dump = mmap.mmap(dump_file.fileno(), length)
+            try:
+                while offset < length:
+                    block_end = min(offset + self.DUMP_BLOCK_SIZE, length)
+                    for chunk_offset in range(offset, block_end, chunk_size):
+                        chunk_end = min(chunk_offset + chunk_size, block_end)
+                        # no memoryview of the mmap: Python 2 lacks it
+                        chunk = bytearray(chunk_end - chunk_offset)
+                        self.stm32.read_chunk_into(address + chunk_offset, chunk)
+                        dump[chunk_offset:chunk_end] = bytes(chunk)
+                        if self.stm32.show_progress:
+                            self.stm32.update_progress(
+                                (chunk_end + chunk_size - 1) // chunk_size,
+                                chunk_count,
+                                "address:" + hex(address + chunk_offset),
+                            )
+                    dump.flush(offset, block_end - offset)
+                    offset = block_end
+                    journal.save(offset)
+            finally:
+                dump.close()
+        journal.discard()
+        self.report("\nReading finished!")
+
+    def _image_pages(self, image):
+        """
+        Return the indices of the flash pages covered by the image segments.
+
+        Return None if global erase is needed instead: when nothing is
+        written or the flash page layout is unknown.
+        """
+        if not self.configuration["write"]:
+            return None
+        if not self.stm32.page_layout_known:
+            self.debug(5, "Global erase: the flash page layout is unknown")
+            return None
+        pages = set()
+        try:
+            for segment in image.segments:
+                pages.update(
+                    page_index
+                    for page_index, _address, _size in self.stm32.flash_pages(
+                        segment.address, len(segment.data)
+                    )
+                )
+        except bootloader.PageIndexError as e:
+            self.debug(5, "Global erase: %s" % e)
+            return None
+        self.debug(5, "Erase %d pages covered by the image" % len(pages))
+        return sorted(pages)
+
+    def _show_time_estimate(self, image, erase_pages):
+        """Show the typical erase and programming time of the chip."""
+        device = self.stm32.device
+        if device is None:
+            return
+        if erase_pages is None:
+            erase_time = device.erase_time()
+        else:
+            erase_pages = set(erase_pages)
+            erase_time = device.erase_time([
+                page
+                for page in device.flash_pages(device.flash_start, device.flash_size)
+                if page[0] in erase_pages
+            ])
+        program_time = device.program_time(image.size) if image else 0
+        self.debug(
+            5,
+            "Typical flash time of %s: erase %.1f s, program %.1f s"
+            % (device.name, erase_time, program_time),
+        )
+
+    def save_trace(self):
+        """Write the command timing trace (--trace) and show its summary."""
+        if not self.configuration["trace"]:
+            return
+        trace = self.stm32.trace
+        trace.save(self.configuration["trace"])
+        self.debug(5, trace.format_summary())
+
+    def close_capture(self):
+        """Close the capture file (--capture), if one is open."""
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
     def reset(self):
-        """Reset the microcontroller."""
-        self.stm32.reset_from_flash()
-        if( self.configuration['core2_mode'] is not None and self.configuration['core2_mode'] in ['rpi','tinker','upboard']):
-            self.stm32.connection.clean_gpio_pins()
+        """Reset the MCU, unless it should stay in the bootloader."""
+        if not self.configuration["stay_in_bootloader"]:
+            self.stm32.reset_from_flash()
+        clean_gpio_pins = getattr(self.stm32.connection, "clean_gpio_pins", None)
+        if clean_gpio_pins is not None:
+            clean_gpio_pins()
 
     @staticmethod
     def print_usage():
         """Print help text explaining the command-line arguments."""
         help_text = """Usage: %s [-hqVeuwvrsRB] [-l length] [-p port] [-b baud] [-P parity]
-          [-a address] [-g address] [-f family] [file.bin]
+          [-a address] [-g address] [-f family] [--delta] [--resume] [--jobs n]
+          [file.bin]
     -e          Erase (note: this is required on previously written memory)
+                With -w and a known family, only the pages covered by the file
+                are erased
     -u          Unprotect in case erase fails
     -w          Write file content to flash
     -v          Verify flash content versus local file (recommended)
     -r          Read from flash and store in local file
     -l length   Length of read
     -p port     Serial port (default: /dev/tty.usbserial-ftCYPMYJ)
-    -b baud     Baudrate (default: 115200)
-    -a address  Target address (default: 0x08000000)
+                Repeat -p or use a pattern like /dev/ttyUSB* to flash several
+                boards at once
+    -b baud     Baudrate (default: 115200), or "auto" to use the fastest working one
+    -a address  Target address of a flat binary file (default: 0x08000000)
     -g address  Start executing from address (0x08000000, usually)
     -f family   Device family to read out device UID and flash size; e.g F1 for STM32F1xx
+                (default: detected from the chip ID)
 
     -h          Print this help text
     -q          Quiet mode
@@ -303,6 +819,25 @@ class Stm32Loader:
     -u          Readout unprotect
     -n          No progress: don't show progress bar
     -P parity   Parity: "even" for STM32 (default), "none" for BlueNRG
+    --delta     Only erase and rewrite the flash pages that differ from the file
+                (requires a known flash page layout)
+    --resume    Continue an interrupted read (-r) or write (-w) where it stopped
+                (a write must have been started with --resume as well, and
+                requires a known flash page layout)
+    --reset-hold=ms  Time to hold the MCU in reset (default: 100)
+    --jobs=n    Number of boards to flash at once with several ports (default: all)
+    --no-reset  Don't toggle RESET and BOOT0; the MCU must be in the bootloader already
+    --stay-in-bootloader  Don't reset the MCU at exit, so that the next run
+                can skip the reset sequence
+    --trace=file  Save the timing of every command as JSON, or CSV if file ends in .csv
+    --capture=file  Record all serial traffic with timestamps to file
+    --replay=file  Play back a capture instead of using a serial port
+    --cache=file  Skip -e -w -v if file records the image as verified on this
+                device and a quick check agrees (requires a known family);
+                also skips the Get command for known chip IDs
+    --backend=name  Connection backend: serial (default), rpi, tinker, upboard,
+                gpiochip or one installed in the "stm32loader.backends" entry
+                point group
 
     Example: ./%s -p COM7 -f F1
     Example: ./%s -e -w -v example/main.bin
@@ -312,39 +847,56 @@ class Stm32Loader:
         print(help_text)
 
     def read_device_details(self):
-        """Show MCU details (bootloader version, chip ID, UID, flash size)."""
-        boot_version = self.stm32.get()
-        self.debug(0, "Bootloader version: 0x%X" % boot_version)
+        """
+        Show MCU details (bootloader version, chip ID, UID, flash size).
+
+        The Get command is skipped if its result is known already: from
+        probing an active bootloader, or per chip ID from the --cache file.
+        """
         device_id = self.stm32.get_id()
+        self.device_id = device_id
+        flash_cache = self._flash_cache()
+        if self.stm32.bootloader_version is None and flash_cache:
+            capabilities = flash_cache.lookup_capabilities(device_id)
+            if capabilities:
+                self.stm32.set_capabilities(*capabilities)
+        if self.stm32.bootloader_version is None:
+            self.stm32.get()
+            if flash_cache:
+                flash_cache.store_capabilities(
+                    device_id, self.stm32.bootloader_version, self.stm32.available_commands
+                )
+        self.debug(0, "Bootloader version: 0x%X" % self.stm32.bootloader_version)
         self.debug(
             0, "Chip id: 0x%X (%s)" % (device_id, bootloader.CHIP_IDS.get(device_id, "Unknown"))
         )
+        from . import devices
+
         family = self.configuration["family"]
+        device = devices.get_device(device_id)
+        if device and family and device.family != family:
+            message = "Chip id 0x%X is not of family %s; ignoring its flash layout"
+            self.debug(5, message % (device_id, family))
+            device = None
+        self.stm32.device = device
+        if device and not family:
+            family = self.configuration["family"] = self.stm32.device_family = device.family
+            self.debug(5, "Device family: %s" % family)
         if not family:
             self.debug(0, "Supply -f [family] to see flash size and device UID, e.g: -f F1")
-        else:
-            # special fix for F4 devices
-            if family == "F4":
-                try:
-                    device_uid, flash_size = self.stm32.get_flash_size_and_uid_f4()
-                except bootloader.CommandError as e:
-                    self.debug(0,"Something was wrong with reading chip family data: ")
-                    self.debug(0, str(e))
-                else:
-                    device_uid_string = self.stm32.format_uid(device_uid)
-                    self.debug(0, "Device UID: %s" % device_uid_string)
-                    self.debug(0, "Flash size: %d KiB" % flash_size)
-            else:
-                try:
-                    flash_size = self.stm32.get_flash_size(family)
-                    device_uid = self.stm32.get_uid(family)
-                except bootloader.CommandError as e:
-                    self.debug(0,"Something was wrong with reading chip family data: ")
-                    self.debug(0, str(e))
-                else:
-                    device_uid_string = self.stm32.format_uid(device_uid)
-                    self.debug(0, "Device UID: %s" % device_uid_string)
-                    self.debug(0, "Flash size: %d KiB" % flash_size)
+            return
+        try:
+            device_uid, flash_size = self.stm32.get_device_info(family)
+        except bootloader.CommandError as e:
+            self.debug(0,"Something was wrong with reading chip family data: ")
+            self.debug(0, str(e))
+            return
+        device_uid_string = self.stm32.format_uid(device_uid)
+        if isinstance(device_uid, bytearray):
+            self.device_uid = device_uid_string
+        self.debug(0, "Device UID: %s" % device_uid_string)
+        if flash_size is not None:
+            self.debug(0, "Flash size: %d KiB" % flash_size)
 
     def _parse_option_flags(self, options):
         # pylint: disable=eval-used
@@ -356,6 +908,7 @@ class Stm32Loader:
                     self.debug(0, "Incorrect SBC type!")
                     sys.exit(1)
                 self.configuration["core2_mode"] = value
+                self.configuration["backend"] = value
                 if value == 'rpi':
                     self.configuration["port"] = '/dev/serial0'                
                 elif value == 'tinker':
@@ -370,8 +923,30 @@ class Stm32Loader:
                 sys.exit(0)
             elif option == "-p":
                 self.configuration["port"] = value
+                self.ports.append(value)
             elif option == "-f":
                 self.configuration["family"] = value
+            elif option == "--reset-hold":
+                self.configuration["reset_hold"] = float(value)
+            elif option == "--jobs":
+                self.configuration["jobs"] = int(value)
+            elif option == "--trace":
+                self.configuration["trace"] = value
+            elif option == "--capture":
+                self.configuration["capture"] = value
+            elif option == "--replay":
+                self.configuration["replay"] = value
+            elif option == "--cache":
+                self.configuration["cache"] = value
+            elif option == "--backend":
+                names = backends.backend_names()
+                if value not in names:
+                    message = "Unknown connection backend '%s'; choose from: %s"
+                    self.debug(0, message % (value, ", ".join(names)))
+                    sys.exit(2)
+                self.configuration["backend"] = value
+            elif option == "-b" and value == "auto":
+                self.configuration["baud"] = value
             elif option == "-P":
                 assert (
                     value.lower() in Stm32Loader.PARITY
@@ -384,6 +959,47 @@ class Stm32Loader:
             else:
                 assert False, "unhandled option %s" % option
 
+
+def write_segments(image):
+    """Return the segments of image to write, joined if that saves chunks."""
+    return image.merged(bootloader.Stm32Bootloader.DATA_TRANSFER_SIZE).segments
+
+
+def _add_offset(callback, base, offset):
+    """Call callback with the offset moved by base."""
+    callback(base + offset)
+
+
+def _segment_bytes(segments, address, length):
+    """Return the bytes of segments in the given range; 0xFF in gaps."""
+    data = bytearray(b"\xff" * length)
+    end = address + length
+    for segment in segments:
+        start, stop = max(segment.address, address), min(segment.end, end)
+        if start < stop:
+            data[start - address : stop - address] = segment.data[
+                start - segment.address : stop - segment.address
+            ]
+    return data
+
+
+def expand_ports(patterns):
+    """
+    Return the serial ports given by the patterns, without duplicates.
+
+    Patterns with wildcards (e.g. /dev/ttyUSB*) are matched against the
+    existing device files; other patterns are used verbatim.
+    """
+    ports = []
+    for pattern in patterns:
+        if any(char in pattern for char in "*?["):
+            matches = sorted(glob.glob(pattern))
+        else:
+            matches = [pattern]
+        ports.extend(port for port in matches if port not in ports)
+    return ports
+
+
 def main(*args, **kwargs):
     """
     Parse arguments and execute tasks.
@@ -393,12 +1009,23 @@ def main(*args, **kwargs):
     try:
         loader = Stm32Loader()
         loader.parse_arguments(args)
-        loader.connect()
+        if len(loader.ports) > 1:
+            from .gang import GangLoader
+
+            gang = GangLoader(loader.ports, loader.configuration, loader.verbosity)
+            results = gang.run(loader.configuration["jobs"])
+            gang.print_summary(results)
+            sys.exit(max(result.status for result in results))
         try:
-            loader.read_device_details()
-            loader.perform_commands()
+            loader.connect()
+            try:
+                loader.read_device_details()
+                loader.perform_commands()
+            finally:
+                loader.reset()
+                loader.save_trace()
         finally:
-            loader.reset()
+            loader.close_capture()
     except SystemExit:
         if not kwargs.get("avoid_system_exit", False):
             raise
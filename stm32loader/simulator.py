@@ -0,0 +1,619 @@
+# GitHub repository: https://github.com/florisla/stm32loader
+#
+# This file is part of stm32loader.
+#
+# stm32loader is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# stm32loader is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with stm32loader; see the file LICENSE.  If not see
+# <http://www.gnu.org/licenses/>.
+
+"""
+Simulate the STM32 USART bootloader (ST AN3155) in software.
+
+BootloaderSimulator implements the protocol and a model of flash
+memory, including the time that transfers, programming and erasing
+take.  It can be reached in two ways:
+
+ * SimulatedConnection: an in-process connection for Stm32Bootloader,
+   which counts simulated time instead of waiting;
+ * PtySimulator: a Linux pseudo-terminal that replies in real time, e.g.
+   for running stm32loader end to end:
+
+       $ python -m stm32loader.simulator --family F1 &
+       Simulating chip 0x410 on /dev/pts/5
+       $ stm32loader -p /dev/pts/5 --no-reset -e -w -v firmware.bin
+
+Requires Python 3.
+"""
+
+import getopt
+import os
+import select
+import struct
+import sys
+import threading
+import time
+import types
+from functools import reduce
+
+from .bootloader import Stm32Bootloader
+
+ACK = bytes([Stm32Bootloader.Reply.ACK])
+NACK = bytes([Stm32Bootloader.Reply.NACK])
+
+Command = Stm32Bootloader.Command
+
+
+class _Nack(Exception):
+    """Reply NACK and wait for the next command."""
+
+
+class BootloaderSimulator:
+    """
+    Software model of an STM32 in system memory boot mode.
+
+    Feed the bytes sent by the host to feed(); the replies, each with
+    the simulated time at which it is completely transmitted, are
+    collected with take_output().
+
+    Flash behaves like the real thing: erasing sets all bits, writing
+    can only clear bits, and protected pages and readout-protected
+    memory refuse access with a NACK.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    RAM_ADDRESS = 0x20000000
+    # commands that are refused while readout protection is active
+    READOUT_PROTECTED_COMMANDS = [
+        Command.READ_MEMORY,
+        Command.GO,
+        Command.WRITE_MEMORY,
+        Command.ERASE,
+        Command.EXTENDED_ERASE,
+        Command.WRITE_PROTECT,
+        Command.WRITE_UNPROTECT,
+        Command.READOUT_PROTECT,
+        Command.GET_CHECKSUM,
+    ]
+    # bytes per frame on the wire: start bit, 8 data bits, parity, stop bit
+    BITS_PER_BYTE = Stm32Bootloader.BITS_PER_BYTE
+
+    def __init__(
+        self,
+        chip_id=0x410,
+        family="F1",
+        flash_size=64 * 1024,
+        page_size=1024,
+        baud_rate=115200,
+        version=0x31,
+        extended_erase=False,
+        get_checksum=False,
+        uid=bytes(range(1, 13)),
+        ram_size=20 * 1024,
+    ):
+        """
+        Construct a BootloaderSimulator, powered on in bootloader mode.
+
+        :param int chip_id: Product ID returned by Get ID.
+        :param str family: Device family; selects the addresses of the
+          UID and flash size registers, and the sector layout of
+          families listed in Stm32Bootloader.FLASH_SECTOR_SIZES.
+        :param int flash_size: Flash size in bytes; for sector families,
+          the sectors that fit.
+        :param int page_size: Erase page size in bytes of other families.
+        :param int baud_rate: Baud rate, for the byte transfer time.
+        :param int version: Bootloader version reported by Get.
+        :param bool extended_erase: Offer Extended Erase (0x44) instead
+          of Erase (0x43).
+        :param bool get_checksum: Offer the Get Checksum command (0xA1).
+        :param bytes uid: 12-byte unique device ID.
+        :param int ram_size: RAM size in bytes; RAM can be written and read.
+        """
+        self.chip_id = chip_id
+        self.family = family
+        self.baud_rate = baud_rate
+        self.version = version
+        self.extended_erase = extended_erase
+        self.commands = [
+            Command.GET,
+            Command.GET_VERSION,
+            Command.GET_ID,
+            Command.READ_MEMORY,
+            Command.GO,
+            Command.WRITE_MEMORY,
+            Command.EXTENDED_ERASE if extended_erase else Command.ERASE,
+            Command.WRITE_PROTECT,
+            Command.WRITE_UNPROTECT,
+            Command.READOUT_PROTECT,
+            Command.READOUT_UNPROTECT,
+        ]
+        if get_checksum:
+            self.commands.append(Command.GET_CHECKSUM)
+
+        # reply latency of the bootloader, and flash operation times
+        self.response_time = 0.0001  # seconds
+        self.write_time = 0.005  # seconds per Write Memory command
+        self.page_erase_time = 0.02  # seconds per page or sector
+        self.mass_erase_time = 0.04  # seconds
+
+        self.pages = self._page_layout(family, flash_size, page_size)
+        flash_size = sum(size for _address, size in self.pages)
+        self.flash = bytearray(b"\xff" * flash_size)
+        self.ram = bytearray(ram_size)
+        self.system = self._system_memory(family, flash_size, uid)
+        self.write_protected = set()
+        self.readout_protected = False
+
+        # simulated time, in seconds
+        self.clock = 0.0
+        # "bootloader", or "application" after Go or reset without boot0
+        self.mode = "bootloader"
+        self.boot0 = True
+        self._input = bytearray()
+        self._output = []
+        self._session = None
+        self._needed = 0
+        self.reset()
+
+    @property
+    def byte_time(self):
+        """Return the transfer time of a single byte, in seconds."""
+        return self.BITS_PER_BYTE / float(self.baud_rate)
+
+    def reset(self, boot0=None):
+        """Reset the MCU; start the bootloader if boot0 is enabled."""
+        if boot0 is not None:
+            self.boot0 = boot0
+        self.mode = "bootloader" if self.boot0 else "application"
+        self._input = bytearray()
+        self._start_session()
+
+    def feed(self, data):
+        """Receive bytes sent by the host."""
+        self.clock += len(data) * self.byte_time
+        if self.mode != "bootloader":
+            # the application ignores the bootloader protocol
+            return
+        self._input.extend(data)
+        while len(self._input) >= self._needed:
+            received = bytes(self._input[: self._needed])
+            del self._input[: self._needed]
+            try:
+                self._needed = self._session.send(received)
+            except StopIteration:
+                # the MCU was reset by the command
+                self._start_session()
+
+    def take_output(self):
+        """Return and forget the pending (completion time, reply) tuples."""
+        output, self._output = self._output, []
+        return output
+
+    def read(self, address, length):
+        """Return memory content without going through the protocol."""
+        memory, offset = self._locate(address, length)
+        return bytes(memory[offset : offset + length])
+
+    def _send(self, data, busy_time=0.0):
+        """Queue a reply, sent after busy_time and the response time."""
+        self.clock += self.response_time + busy_time + len(data) * self.byte_time
+        self._output.append((self.clock, data))
+
+    def _start_session(self):
+        self._session = self._run_session()
+        self._needed = next(self._session)
+
+    def _run_session(self):
+        """
+        Handle the protocol; yields the byte count it needs next.
+
+        Command handlers that need more input are generators too.  A
+        handler returns True if the command makes the MCU reset.
+        """
+        # autobaud: the synchronization byte comes first
+        while (yield 1) != bytes([Command.SYNCHRONIZE]):
+            pass
+        self._send(ACK)
+        handlers = {
+            Command.GET: self._get,
+            Command.GET_VERSION: self._get_version,
+            Command.GET_ID: self._get_id,
+            Command.READ_MEMORY: self._read_memory,
+            Command.GO: self._go,
+            Command.WRITE_MEMORY: self._write_memory,
+            Command.ERASE: self._erase,
+            Command.EXTENDED_ERASE: self._extended_erase,
+            Command.WRITE_PROTECT: self._write_protect,
+            Command.WRITE_UNPROTECT: self._write_unprotect,
+            Command.READOUT_PROTECT: self._readout_protect,
+            Command.READOUT_UNPROTECT: self._readout_unprotect,
+            Command.GET_CHECKSUM: self._get_checksum,
+        }
+        while True:
+            # like the real bootloader, take a synchronization byte sent
+            # after autobaud for a command code: it gets no reply until a
+            # second byte fails the complement check
+            code = (yield 1)[0]
+            complement = (yield 1)[0]
+            if complement != code ^ 0xFF or code not in self.commands:
+                self._send(NACK)
+                continue
+            if self.readout_protected and code in self.READOUT_PROTECTED_COMMANDS:
+                self._send(NACK)
+                continue
+            self._send(ACK)
+            try:
+                result = handlers[code]()
+                if isinstance(result, types.GeneratorType):
+                    result = yield from result
+            except _Nack:
+                self._send(NACK)
+                continue
+            if result:
+                return
+
+    def _get(self):
+        self._send(bytes([len(self.commands), self.version] + self.commands) + ACK)
+
+    def _get_version(self):
+        self._send(bytes([self.version, 0, 0]) + ACK)
+
+    def _get_id(self):
+        self._send(bytes([1]) + struct.pack(">H", self.chip_id) + ACK)
+
+    def _read_memory(self):
+        address = self._decode_address((yield 5))
+        self._send(ACK)
+        length_data = yield 2
+        if length_data[1] != length_data[0] ^ 0xFF:
+            raise _Nack()
+        length = length_data[0] + 1
+        memory, offset = self._locate(address, length)
+        self._send(ACK)
+        self._send(bytes(memory[offset : offset + length]))
+
+    def _go(self):
+        self._decode_address((yield 5))
+        self._send(ACK)
+        self.mode = "application"
+
+    def _write_memory(self):
+        address = self._decode_address((yield 5))
+        self._send(ACK)
+        count = (yield 1)[0]
+        frame = yield count + 2
+        if reduce(lambda x, y: x ^ y, frame, count) != 0:
+            raise _Nack()
+        data = frame[:-1]
+        memory, offset = self._locate(address, len(data))
+        if memory is self.flash:
+            if any(
+                self._page_index(address + index) in self.write_protected
+                for index in (0, len(data) - 1)
+            ):
+                raise _Nack()
+            # programming can only clear bits
+            for index, byte in enumerate(data):
+                memory[offset + index] &= byte
+            self._send(ACK, self.write_time)
+        else:
+            memory[offset : offset + len(data)] = data
+            self._send(ACK)
+
+    def _erase(self):
+        count = (yield 1)[0]
+        if count == 0xFF:
+            # global erase is confirmed with 0x00, not with a checksum
+            if (yield 1) != b"\x00":
+                raise _Nack()
+            self._erase_pages(None)
+            return
+        frame = yield count + 2
+        self._checksum_frame([count], frame)
+        self._erase_pages(list(frame[:-1]))
+
+    def _extended_erase(self):
+        count_data = yield 2
+        count = struct.unpack(">H", count_data)[0]
+        if count >= 0xFFF0:
+            # mass erase and bank erases
+            self._checksum_frame(count_data, (yield 1))
+            self._erase_pages(None)
+            return
+        frame = yield 2 * (count + 1) + 1
+        self._checksum_frame(count_data, frame)
+        self._erase_pages(list(struct.unpack(">%dH" % (count + 1), frame[:-1])))
+
+    def _write_protect(self):
+        count = (yield 1)[0]
+        frame = yield count + 2
+        self._checksum_frame([count], frame)
+        self.write_protected.update(frame[:-1])
+        self._send(ACK)
+        return True
+
+    def _write_unprotect(self):
+        self.write_protected.clear()
+        self._send(ACK)
+        return True
+
+    def _readout_protect(self):
+        self.readout_protected = True
+        self._send(ACK)
+        return True
+
+    def _readout_unprotect(self):
+        self.flash[:] = b"\xff" * len(self.flash)
+        self.readout_protected = False
+        self._send(ACK, self.mass_erase_time)
+        return True
+
+    def _get_checksum(self):
+        address = self._decode_address((yield 5))
+        self._send(ACK)
+        length = self._decode_address((yield 5))
+        self._send(ACK)
+        polynomial = self._decode_address((yield 5))
+        self._send(ACK)
+        initial_value = self._decode_address((yield 5))
+        if (polynomial, initial_value) != (
+            Stm32Bootloader.CRC_POLYNOMIAL,
+            Stm32Bootloader.CRC_INITIAL_VALUE,
+        ):
+            # only the CRC peripheral defaults are simulated
+            raise _Nack()
+        memory, offset = self._locate(address, length)
+        self._send(ACK)
+        crc = Stm32Bootloader.crc32(memory[offset : offset + length])
+        crc_bytes = struct.pack(">I", crc)
+        self._send(crc_bytes + bytes([reduce(lambda x, y: x ^ y, crc_bytes)]))
+
+    def _erase_pages(self, pages):
+        """Erase the given pages, or all flash if pages is None."""
+        if pages is None:
+            if self.write_protected:
+                raise _Nack()
+            self.flash[:] = b"\xff" * len(self.flash)
+            self._send(ACK, self.mass_erase_time)
+            return
+        if any(page >= len(self.pages) or page in self.write_protected for page in pages):
+            raise _Nack()
+        for page in pages:
+            address, size = self.pages[page]
+            self.flash[address : address + size] = b"\xff" * size
+        self._send(ACK, self.page_erase_time * len(pages))
+
+    def _locate(self, address, length):
+        """Return the memory and offset of the range, or raise _Nack."""
+        regions = [
+            (Stm32Bootloader.FLASH_START_ADDRESS, self.flash),
+            (self.RAM_ADDRESS, self.ram),
+        ] + [(system_address, memory) for system_address, memory in self.system]
+        for start, memory in regions:
+            if start <= address and address + length <= start + len(memory):
+                return memory, address - start
+        raise _Nack()
+
+    def _page_index(self, address):
+        offset = address - Stm32Bootloader.FLASH_START_ADDRESS
+        for index, (page_offset, size) in enumerate(self.pages):
+            if page_offset <= offset < page_offset + size:
+                return index
+        return None
+
+    @staticmethod
+    def _decode_address(data):
+        address = struct.unpack(">I", data[:4])[0]
+        if reduce(lambda x, y: x ^ y, data) != 0:
+            raise _Nack()
+        return address
+
+    @staticmethod
+    def _checksum_frame(header, frame):
+        if reduce(lambda x, y: x ^ y, bytes(header) + bytes(frame)) != 0:
+            raise _Nack()
+
+    @staticmethod
+    def _page_layout(family, flash_size, page_size):
+        """Return (offset, size) of each flash page or sector."""
+        sector_sizes = Stm32Bootloader.FLASH_SECTOR_SIZES.get(family)
+        if not sector_sizes:
+            return [(offset, page_size) for offset in range(0, flash_size, page_size)]
+        pages = []
+        offset = 0
+        for size_kib in sector_sizes:
+            if offset + size_kib * 1024 > flash_size:
+                break
+            pages.append((offset, size_kib * 1024))
+            offset += size_kib * 1024
+        return pages
+
+    @staticmethod
+    def _system_memory(family, flash_size, uid):
+        """Return (address, content) of the UID and flash size registers."""
+        areas = {}
+        registers = [
+            (Stm32Bootloader.UID_ADDRESS.get(family), bytes(uid)),
+            (
+                Stm32Bootloader.FLASH_SIZE_ADDRESS.get(family),
+                struct.pack("<H", flash_size // 1024),
+            ),
+        ]
+        for address, value in registers:
+            if address is None:
+                continue
+            base = address & ~0xFF
+            area = areas.setdefault(base, bytearray(b"\xff" * 0x100))
+            area[address - base : address - base + len(value)] = value
+        return sorted(areas.items())
+
+
+class SimulatedConnection:
+    """
+    In-process connection from Stm32Bootloader to a BootloaderSimulator.
+
+    Nothing waits in real time: the simulator's clock counts how long
+    the transfers would take, including read timeouts.
+    """
+
+    def __init__(self, simulator):
+        """Construct a SimulatedConnection to the BootloaderSimulator."""
+        self.simulator = simulator
+        self.timeout = 5
+        self.can_toggle_reset = True
+        self.can_toggle_boot0 = True
+        self._received = bytearray()
+        self._boot0 = False
+        self._reset = False
+
+    @property
+    def baud_rate(self):
+        """Get baud rate."""
+        return self.simulator.baud_rate
+
+    @baud_rate.setter
+    def baud_rate(self, baud_rate):
+        """Set baud rate."""
+        self.simulator.baud_rate = baud_rate
+
+    def write(self, data):
+        """Send the given data to the simulator."""
+        self.simulator.feed(bytes(data))
+        for _clock, reply in self.simulator.take_output():
+            self._received.extend(reply)
+
+    def read(self, size=1):
+        """Return size bytes, or fewer after a (simulated) timeout."""
+        data = bytes(self._received[:size])
+        del self._received[:size]
+        if len(data) < size:
+            self.simulator.clock += self.timeout or 0
+        return data
+
+    def readinto(self, buffer):
+        """Read bytes into the given buffer and return their count."""
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def clear_input_buffer(self):
+        """Discard all received bytes."""
+        del self._received[:]
+
+    def enable_reset(self, enable=True):
+        """Hold the MCU in reset, or release it and let it boot."""
+        if self._reset and not enable:
+            self.simulator.reset(boot0=self._boot0)
+        self._reset = enable
+
+    def enable_boot0(self, enable=True):
+        """Enable or disable boot0, taking effect at the next reset."""
+        self._boot0 = enable
+
+
+class PtySimulator:
+    """
+    Serve a BootloaderSimulator on a pseudo-terminal, in real time.
+
+    A pseudo-terminal has no RESET and BOOT0 lines, so run stm32loader
+    with --no-reset.  The simulated MCU starts in bootloader mode.
+    """
+
+    def __init__(self, simulator):
+        """Construct a PtySimulator and create its pseudo-terminal."""
+        # pylint: disable=import-outside-toplevel
+        import tty
+
+        self.simulator = simulator
+        self._master, self._slave = os.openpty()
+        # the slave end stays open, so the pty survives clients closing it
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Serve in a background thread."""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop serving and close the pseudo-terminal."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def serve_forever(self):
+        """Answer the bytes that arrive on the pty, until stop() is called."""
+        start_time = time.time()
+        while not self._stop.is_set():
+            readable, _writable, _error = select.select([self._master], [], [], 0.1)
+            if not readable:
+                continue
+            data = os.read(self._master, 4096)
+            self.simulator.clock = max(self.simulator.clock, time.time() - start_time)
+            self.simulator.feed(data)
+            for ready_time, reply in self.simulator.take_output():
+                delay = ready_time - (time.time() - start_time)
+                if delay > 0:
+                    time.sleep(delay)
+                os.write(self._master, reply)
+
+
+def main(*args):
+    """Run a simulator on a pseudo-terminal until interrupted."""
+    options, _arguments = getopt.getopt(
+        args,
+        "",
+        [
+            "chip-id=",
+            "family=",
+            "flash-size=",
+            "page-size=",
+            "baud=",
+            "extended-erase",
+            "checksum",
+        ],
+    )
+    settings = {}
+    for option, value in options:
+        if option == "--chip-id":
+            settings["chip_id"] = int(value, 0)
+        elif option == "--family":
+            settings["family"] = value
+        elif option == "--flash-size":
+            # in KiB, like the flash size register
+            settings["flash_size"] = int(value, 0) * 1024
+        elif option == "--page-size":
+            settings["page_size"] = int(value, 0)
+        elif option == "--baud":
+            settings["baud_rate"] = int(value)
+        elif option == "--extended-erase":
+            settings["extended_erase"] = True
+        elif option == "--checksum":
+            settings["get_checksum"] = True
+    simulator = BootloaderSimulator(**settings)
+    pty_simulator = PtySimulator(simulator)
+    print("Simulating chip 0x%X on %s" % (simulator.chip_id, pty_simulator.port))
+    sys.stdout.flush()
+    try:
+        pty_simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,222 @@
+# GitHub repository: https://github.com/florisla/stm32loader
+#
+# This file is part of stm32loader.
+#
+# stm32loader is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation; either version 3, or (at your option) any later
+# version.
+#
+# stm32loader is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with stm32loader; see the file LICENSE.  If not see
+# <http://www.gnu.org/licenses/>.
+
+"""Record the timing of every bootloader command."""
+
+import csv
+import json
+import time
+
+_clock = getattr(time, "monotonic", time.time)
+
+
+class TraceRecord(object):
+    """Timing of a single bootloader command."""
+
+    # pylint: disable=too-few-public-methods
+
+    FIELDS = [
+        "command",
+        "name",
+        "address",
+        "size",
+        "start",
+        "command_ack",
+        "final_ack",
+        "retries",
+    ]
+
+    __slots__ = FIELDS
+
+    def __init__(self, command, name, start, retries=0):
+        """
+        Construct a TraceRecord.
+
+        :param int command: Command code.
+        :param str name: Command description.
+        :param float start: Time at which the command was sent, in seconds.
+        :param int retries: Number of earlier failed attempts of this chunk.
+        """
+        self.command = command
+        self.name = name
+        self.address = None
+        # data bytes for read, write and checksum; page count for erase
+        self.size = None
+        self.start = start
+        # seconds from start until the command is acknowledged
+        self.command_ack = None
+        # seconds from start until the last ACK or reply data
+        self.final_ack = None
+        self.retries = retries
+
+    def as_dict(self):
+        """Return the record as a dictionary."""
+        return dict((field, getattr(self, field)) for field in self.FIELDS)
+
+
+class CommandTrace(object):
+    """
+    Timing trace of bootloader commands, filled in by Stm32Bootloader.
+
+    Set it as the bootloader's trace attribute; without a trace, the
+    bootloader only checks for None.  The trace can be exported as JSON
+    or CSV, and summarized per command type.
+    """
+
+    # upper bounds of the histogram buckets, in seconds
+    HISTOGRAM_BOUNDS = [0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5]
+    # a chunk or page is an outlier if its command takes this many times
+    # longer than the median of its command type
+    OUTLIER_FACTOR = 3
+
+    def __init__(self, clock=_clock):
+        """
+        Construct an empty CommandTrace.
+
+        :param callable clock: Returns the current time in seconds.
+        """
+        self.clock = clock
+        self.records = []
+        # set by the bootloader before retrying a chunk transfer; applies
+        # to the next command only
+        self.retries = 0
+        self._current = None
+
+    def begin(self, command, name):
+        """Start the record of a command that is being sent."""
+        self._current = TraceRecord(command, name, self.clock(), self.retries)
+        self.records.append(self._current)
+        self.retries = 0
+
+    def annotate(self, address=None, size=None):
+        """Set the address and payload size of the current command."""
+        self._current.address = address
+        self._current.size = size
+
+    def ack(self):
+        """Register an ACK or the reply data of the current command."""
+        if self._current is None:
+            return
+        elapsed = self.clock() - self._current.start
+        if self._current.command_ack is None:
+            self._current.command_ack = elapsed
+        self._current.final_ack = elapsed
+
+    def summary(self):
+        """
+        Return statistics of the final ACK time per command name.
+
+        :return dict: Per name: count, retries, mean command ACK time and
+          min, median, 90th percentile and max final ACK time (seconds),
+          and a histogram: the count per HISTOGRAM_BOUNDS bucket, the
+          last bucket holding everything above.
+        """
+        summary = {}
+        for name in sorted(set(record.name for record in self.records)):
+            records = [record for record in self.records if record.name == name]
+            command_acks = [record.command_ack for record in records if record.command_ack]
+            times = sorted(record.final_ack for record in records if record.final_ack is not None)
+            histogram = [0] * (len(self.HISTOGRAM_BOUNDS) + 1)
+            for elapsed in times:
+                bucket = 0
+                bounds = self.HISTOGRAM_BOUNDS
+                while bucket < len(bounds) and elapsed > bounds[bucket]:
+                    bucket += 1
+                histogram[bucket] += 1
+            summary[name] = {
+                "count": len(records),
+                "retries": sum(record.retries for record in records),
+                "command_ack_mean": (
+                    sum(command_acks) / len(command_acks) if command_acks else None
+                ),
+                "min": times[0] if times else None,
+                "median": _percentile(times, 50),
+                "p90": _percentile(times, 90),
+                "max": times[-1] if times else None,
+                "histogram": histogram,
+            }
+        return summary
+
+    def outliers(self, factor=None):
+        """
+        Return the records that took much longer than their command's median.
+
+        Only commands with an address count, such as Read and Write Memory;
+        slow writes often point to worn flash pages.
+        """
+        factor = factor or self.OUTLIER_FACTOR
+        summary = self.summary()
+        slow = []
+        for record in self.records:
+            if record.address is None or record.final_ack is None:
+                continue
+            median = summary[record.name]["median"]
+            if median and record.final_ack > factor * median:
+                slow.append(record)
+        return slow
+
+    def save(self, file_name):
+        """Write the records to a file: CSV for a .csv name, else JSON."""
+        with open(file_name, "w") as trace_file:
+            if file_name.lower().endswith(".csv"):
+                writer = csv.writer(trace_file)
+                writer.writerow(TraceRecord.FIELDS)
+                for record in self.records:
+                    writer.writerow([getattr(record, field) for field in TraceRecord.FIELDS])
+            else:
+                json.dump(
+                    {
+                        "records": [record.as_dict() for record in self.records],
+                        "summary": self.summary(),
+                        "histogram_bounds": self.HISTOGRAM_BOUNDS,
+                    },
+                    trace_file,
+                    indent=1,
+                )
+
+    def format_summary(self):
+        """Return the summary and outliers as readable text."""
+        lines = [
+            "%-24s %6s %7s %9s %9s %9s" % ("command", "count", "retries", "median", "p90", "max")
+        ]
+        for name, stats in sorted(self.summary().items()):
+            lines.append(
+                "%-24s %6d %7d %7.2fms %7.2fms %7.2fms"
+                % (
+                    name,
+                    stats["count"],
+                    stats["retries"],
+                    1000 * (stats["median"] or 0),
+                    1000 * (stats["p90"] or 0),
+                    1000 * (stats["max"] or 0),
+                )
+            )
+        for record in self.outliers():
+            lines.append(
+                "Slow %s at 0x%X: %.2f ms"
+                % (record.name, record.address, 1000 * record.final_ack)
+            )
+        return "\n".join(lines)
+
+
+def _percentile(sorted_values, percent):
+    """Return the value below which percent of the sorted values are."""
+    if not sorted_values:
+        return None
+    index = int(round((len(sorted_values) - 1) * percent / 100.0))
+    return sorted_values[index]
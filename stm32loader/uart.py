@@ -36,7 +36,7 @@ class SerialConnection(object):
     def __init__(self, serial_port, baud_rate=115200, parity="E"):
         """Construct a SerialConnection (not yet connected)."""
         self.serial_port = serial_port
-        self.baud_rate = baud_rate
+        self._baud_rate = baud_rate
         self.parity = parity
 
         # advertise reset / boot0 toggle capability
@@ -63,11 +63,23 @@ class SerialConnection(object):
         self._timeout = timeout
         self.serial_connection.timeout = timeout
 
+    @property
+    def baud_rate(self):
+        """Get baud rate."""
+        return self._baud_rate
+
+    @baud_rate.setter
+    def baud_rate(self, baud_rate):
+        """Set baud rate, also when connected."""
+        self._baud_rate = baud_rate
+        if self.serial_connection:
+            self.serial_connection.baudrate = baud_rate
+
     def connect(self):
         """Connect to the RS-232 serial port."""
         self.serial_connection = serial.Serial(
             port=self.serial_port,
-            baudrate=self.baud_rate,
+            baudrate=self._baud_rate,
             # number of write_data bits
             bytesize=8,
             parity=self.parity,
@@ -95,6 +107,10 @@ class SerialConnection(object):
         """Read the given amount of bytes from the serial connection."""
         return self.serial_connection.read(*args, **kwargs)
 
+    def readinto(self, buffer):
+        """Read bytes from the serial connection into the given buffer."""
+        return self.serial_connection.readinto(buffer)
+
     def enable_reset(self, enable=True):
         """Enable or disable the reset IO line."""
         # reset on the STM32 is active low (0 Volt puts the MCU in reset)
@@ -24,9 +24,13 @@ Offer support for toggling RESET and BOOT0.
 """
 
 # not naming this file itself 'serial', becase that name-clashes in Python 2
-from __future__ import print_function
+import os
+
 import serial
-import sys
+
+from .backends import BackendError
+from .gpiochip import GpioLines
+from .uart import SerialConnection
 
 # fixes the problem with setters method
 # https://stackoverflow.com/questions/598077/why-does-foo-setter-in-python-not-work-for-me
@@ -40,7 +44,7 @@ class SerialConnectionRpi(object):
     def __init__(self, serial_port, baud_rate=115200, parity="E", gpio_reset_pin=int(12), gpio_boot0_pin=int(11)):
         """Construct a SerialConnectionRpi (not yet connected)."""
         self.serial_port = serial_port
-        self.baud_rate = baud_rate
+        self._baud_rate = baud_rate
         self.parity = parity
         self.can_toggle_reset = True
         self.can_toggle_boot0 = True
@@ -59,15 +63,15 @@ class SerialConnectionRpi(object):
         try:
             import RPi.GPIO as GPIO
         except ImportError:
-            print("Couldn't import RPi.GPIO. Check if the RPi.GPIO is installed on your system", file=sys.stderr)
-            exit(1)
+            raise BackendError(
+                "Couldn't import RPi.GPIO. Check if the RPi.GPIO is installed on your system"
+            )
         try:
             self._gpio_instance = GPIO
             self._gpio_instance.setmode(self._gpio_instance.BOARD)
             self._gpio_instance.setwarnings(False)
         except IOError:
-            print("Couldn't initialise the RPi.GPIO instance.", file=sys.stderr)
-            exit(1)
+            raise BackendError("Couldn't initialise the RPi.GPIO instance.")
 
     @property
     def timeout(self):
@@ -80,11 +84,23 @@ class SerialConnectionRpi(object):
         self._timeout = timeout
         self.serial_connection.timeout = timeout
 
+    @property
+    def baud_rate(self):
+        """Get baud rate."""
+        return self._baud_rate
+
+    @baud_rate.setter
+    def baud_rate(self, baud_rate):
+        """Set baud rate, also when connected."""
+        self._baud_rate = baud_rate
+        if self.serial_connection:
+            self.serial_connection.baudrate = baud_rate
+
     def connect(self):
         """Connect to the RS-232 serial port."""
         self.serial_connection = serial.Serial(
             port=self.serial_port,
-            baudrate=self.baud_rate,
+            baudrate=self._baud_rate,
             # number of write_data bits
             bytesize=8,
             parity=self.parity,
@@ -112,6 +128,10 @@ class SerialConnectionRpi(object):
         """Read the given amount of bytes from the serial connection."""
         return self.serial_connection.read(*args, **kwargs)
 
+    def readinto(self, buffer):
+        """Read bytes from the serial connection into the given buffer."""
+        return self.serial_connection.readinto(buffer)
+
     def enable_reset(self, enable=True):
         """Enable or disable the reset IO line."""
         # by default reset is active low
@@ -151,7 +171,7 @@ class SerialConnectionUpboard(object):
     def __init__(self, serial_port, baud_rate=115200, parity="E", gpio_reset_pin=int(18), gpio_boot0_pin=int(17)):
         """Construct a SerialConnectionRpi (not yet connected)."""
         self.serial_port = serial_port
-        self.baud_rate = baud_rate
+        self._baud_rate = baud_rate
         self.parity = parity
         self.can_toggle_reset = True
         self.can_toggle_boot0 = True
@@ -169,14 +189,17 @@ class SerialConnectionUpboard(object):
         try:
             from periphery import GPIO
         except ImportError:
-            print("Couldn't import periphery.GPIO. Check if the periphery is installed on your system", file=sys.stderr)
-            exit(1)
+            raise BackendError(
+                "Couldn't import periphery.GPIO. "
+                "Check if the periphery is installed on your system"
+            )
         try:
             self._reset = GPIO(self._gpio_reset_pin, "out")
             self._boot0 = GPIO(self._gpio_boot0_pin, "out")
         except IOError:
-            print("Couldn't initialise the periphery.GPIO instances. Try use the script with sudo.", file=sys.stderr)
-            exit(1)
+            raise BackendError(
+                "Couldn't initialise the periphery.GPIO instances. Try use the script with sudo."
+            )
 
     @property
     def timeout(self):
@@ -189,11 +212,23 @@ class SerialConnectionUpboard(object):
         self._timeout = timeout
         self.serial_connection.timeout = timeout
 
+    @property
+    def baud_rate(self):
+        """Get baud rate."""
+        return self._baud_rate
+
+    @baud_rate.setter
+    def baud_rate(self, baud_rate):
+        """Set baud rate, also when connected."""
+        self._baud_rate = baud_rate
+        if self.serial_connection:
+            self.serial_connection.baudrate = baud_rate
+
     def connect(self):
         """Connect to the RS-232 serial port."""
         self.serial_connection = serial.Serial(
             port=self.serial_port,
-            baudrate=self.baud_rate,
+            baudrate=self._baud_rate,
             # number of write_data bits
             bytesize=8,
             parity=self.parity,
@@ -221,6 +256,10 @@ class SerialConnectionUpboard(object):
         """Read the given amount of bytes from the serial connection."""
         return self.serial_connection.read(*args, **kwargs)
 
+    def readinto(self, buffer):
+        """Read bytes from the serial connection into the given buffer."""
+        return self.serial_connection.readinto(buffer)
+
     def enable_reset(self, enable=True):
         """Enable or disable the reset IO line."""
         # by default reset is active low
@@ -244,3 +283,86 @@ class SerialConnectionUpboard(object):
     def clean_gpio_pins(self):
         self._boot0.close()
         self._reset.close()
+
+
+class SerialConnectionGpiochip(SerialConnection):
+    """
+    Serial connection that drives reset and boot0 with GPIO chip lines.
+
+    Talks to the Linux GPIO character device directly (see
+    stm32loader.gpiochip), so it works on any SBC with a recent kernel.
+    Both lines are requested at connect(), with the levels set so far as
+    initial values, and set_boot0_and_reset() changes them together.
+
+    The chip and line numbers come from the environment variables
+    STM32LOADER_GPIO_CHIP, STM32LOADER_GPIO_RESET and
+    STM32LOADER_GPIO_BOOT0, unless given.
+    """
+
+    DEFAULT_CHIP = "/dev/gpiochip0"
+    # BCM numbers of the CORE2 header pins used by SerialConnectionRpi
+    DEFAULT_RESET_LINE = 18
+    DEFAULT_BOOT0_LINE = 17
+
+    def __init__(
+        self,
+        serial_port,
+        baud_rate=115200,
+        parity="E",
+        chip=None,
+        reset_line=None,
+        boot0_line=None,
+    ):
+        """Construct a SerialConnectionGpiochip (not yet connected)."""
+        super(SerialConnectionGpiochip, self).__init__(serial_port, baud_rate, parity)
+        self.chip = chip or os.environ.get("STM32LOADER_GPIO_CHIP", self.DEFAULT_CHIP)
+        if reset_line is None:
+            reset_line = os.environ.get("STM32LOADER_GPIO_RESET", self.DEFAULT_RESET_LINE)
+        if boot0_line is None:
+            boot0_line = os.environ.get("STM32LOADER_GPIO_BOOT0", self.DEFAULT_BOOT0_LINE)
+        self.reset_line = int(reset_line)
+        self.boot0_line = int(boot0_line)
+        # stm32loader.gpiochip.GpioLines, from connect() on
+        self.gpio_lines = None
+        self._reset = False
+        self._boot0 = False
+
+    def connect(self):
+        """Connect to the serial port and request the GPIO lines."""
+        super(SerialConnectionGpiochip, self).connect()
+        try:
+            self.gpio_lines = GpioLines(
+                self.chip, [self.reset_line, self.boot0_line], self._line_values()
+            )
+        except (IOError, OSError) as e:
+            raise IOError(
+                "Can not request lines %d and %d of %s: %s"
+                % (self.reset_line, self.boot0_line, self.chip, e)
+            )
+
+    def set_boot0_and_reset(self, boot0, reset):
+        """Enable or disable the boot0 and reset IO lines at once."""
+        self._boot0 = boot0
+        self._reset = reset
+        if self.gpio_lines is not None:
+            self.gpio_lines.set_values(self._line_values())
+
+    def enable_reset(self, enable=True):
+        """Enable or disable the reset IO line."""
+        self.set_boot0_and_reset(self._boot0, enable)
+
+    def enable_boot0(self, enable=True):
+        """Enable or disable the boot0 IO line."""
+        self.set_boot0_and_reset(enable, self._reset)
+
+    def clean_gpio_pins(self):
+        """Release the GPIO lines."""
+        if self.gpio_lines is not None:
+            self.gpio_lines.close()
+            self.gpio_lines = None
+
+    def _line_values(self):
+        # reset is active low and boot0 active high, unless inverted
+        reset_level = self._reset == self.reset_active_high
+        boot0_level = self._boot0 != self.boot0_active_low
+        return int(reset_level) | int(boot0_level) << 1
@@ -0,0 +1,13 @@
+"""Test configuration for the unit tests."""
+
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    # asyncio support, the simulator and the tests built on it need Python 3
+    collect_ignore = [
+        "test_aio.py",
+        "test_benchmark.py",
+        "test_capture.py",
+        "test_simulator.py",
+    ]
@@ -0,0 +1,222 @@
+"""Unit tests for the asyncio bootloader client."""
+
+import asyncio
+import os
+
+import pytest
+
+from stm32loader.aio import AsyncSerialConnection, AsyncStm32Bootloader
+from stm32loader.bootloader import CommandError, PageIndexError, Stm32Bootloader
+from stm32loader.devices import get_device
+
+# pylint: disable=missing-docstring, redefined-outer-name
+
+ACK = Stm32Bootloader.Reply.ACK
+NACK = Stm32Bootloader.Reply.NACK
+
+
+class FakeConnection:
+    """Replies with queued bytes; an empty queue times out."""
+
+    def __init__(self, replies=b""):
+        self.replies = bytearray(replies)
+        self.written_data = bytearray()
+        self.timeout = 5
+        self.timeouts = []
+
+    async def read(self, size=1):
+        self.timeouts.append(self.timeout)
+        await asyncio.sleep(0)
+        data = bytes(self.replies[:size])
+        del self.replies[:size]
+        return data
+
+    def write(self, data):
+        self.written_data.extend(data)
+
+    def clear_input_buffer(self):
+        pass
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_get_returns_version_and_remembers_commands():
+    connection = FakeConnection(bytes([ACK, 2, 0x31, 0x00, 0x44, ACK]))
+    stm32 = AsyncStm32Bootloader(connection)
+    assert run(stm32.get()) == 0x31
+    assert stm32.extended_erase
+    assert connection.written_data == b"\x00\xff"
+
+
+def test_get_id_returns_product_id():
+    connection = FakeConnection(bytes([ACK, 1, 0x04, 0x10, ACK]))
+    assert run(AsyncStm32Bootloader(connection).get_id()) == 0x410
+
+
+def test_read_memory_data_reads_in_chunks():
+    chunk_reply = bytes([ACK, ACK, ACK]) + bytes(range(256))
+    connection = FakeConnection(chunk_reply * 2)
+    data = run(AsyncStm32Bootloader(connection).read_memory_data(0x08000000, 300))
+    assert data == bytes(range(256)) + bytes(range(44))
+    assert b"\x08\x00\x01\x00\x09" in connection.written_data
+
+
+def test_write_memory_sends_same_frame_as_blocking_bootloader():
+    data = bytearray(b"\x01\x02\x03")
+    connection = FakeConnection(bytes([ACK] * 3))
+    run(AsyncStm32Bootloader(connection).write_memory(0x08000000, data))
+    assert connection.written_data.endswith(Stm32Bootloader.encode_data_frames(data)[0])
+
+
+def test_write_memory_data_skips_blank_chunks_after_erase():
+    data = bytearray(256) + bytearray(b"\xff" * 256) + bytearray(1)
+    connection = FakeConnection(bytes([ACK] * 6))
+    stm32 = AsyncStm32Bootloader(connection)
+    stm32.erased_ranges.append(Stm32Bootloader.GLOBAL_ERASE_RANGE)
+    assert run(stm32.write_memory_data(0x08000000, data)) == 1
+    assert not connection.replies
+
+
+def test_write_memory_data_after_blank_chunk_sends_frame_of_its_chunk():
+    data = bytearray(b"\xff" * 256) + bytearray(b"\x01" * 256) + bytearray(b"\x02" * 4)
+    frames = Stm32Bootloader.encode_data_frames(data)
+    connection = FakeConnection(bytes([ACK] * 6))
+    stm32 = AsyncStm32Bootloader(connection)
+    stm32.erased_ranges.append(Stm32Bootloader.GLOBAL_ERASE_RANGE)
+    assert run(stm32.write_memory_data(0x08000000, data, frames=frames)) == 1
+    assert frames[1] in connection.written_data
+    assert connection.written_data.endswith(frames[2])
+
+
+def test_erase_memory_waits_with_erase_timeout_and_restores_timeout():
+    connection = FakeConnection(bytes([ACK, ACK]))
+    stm32 = AsyncStm32Bootloader(connection)
+    run(stm32.erase_memory())
+    assert connection.timeouts[-1] == stm32.ERASE_TIMEOUT
+    assert connection.timeout == 5
+    assert stm32.erased_ranges == [Stm32Bootloader.GLOBAL_ERASE_RANGE]
+
+
+def test_page_erase_records_erased_pages():
+    connection = FakeConnection(bytes([ACK, ACK]))
+    stm32 = AsyncStm32Bootloader(connection)
+    stm32.device = get_device(0x410)
+    run(stm32.erase_memory([1]))
+    assert stm32.erased_ranges == [(0x08000400, 0x08000800)]
+
+
+@pytest.mark.parametrize("pages", [[256], [1] * 256])
+def test_erase_memory_with_invalid_pages_raises_before_sending_command(pages):
+    connection = FakeConnection(bytes([ACK, ACK]))
+    with pytest.raises(PageIndexError):
+        run(AsyncStm32Bootloader(connection).erase_memory(pages))
+    assert not connection.written_data
+
+
+def test_nack_raises_command_error():
+    connection = FakeConnection(bytes([NACK]))
+    with pytest.raises(CommandError, match="NACK"):
+        run(AsyncStm32Bootloader(connection).go(0x08000000))
+
+
+def test_synchronize_repeats_sync_byte_until_reply():
+    connection = FakeConnection()
+    stm32 = AsyncStm32Bootloader(connection)
+    stm32.SYNC_TIMEOUT = 0.01
+
+    with pytest.raises(CommandError, match="timeout"):
+        run(stm32.reset_from_system_memory())
+    assert len(connection.written_data) > 1
+
+
+class LateSyncConnection(FakeConnection):
+    """Replies to synchronization bytes like the bootloader, but late."""
+
+    def __init__(self, late_reads):
+        super().__init__()
+        self.late_reads = late_reads
+        # None before autobaud, then whether a command code is pending
+        self.pending = None
+
+    async def read(self, size=1):
+        if self.late_reads:
+            self.late_reads -= 1
+            return b""
+        return await super().read(size)
+
+    def write(self, data):
+        super().write(data)
+        for _byte in bytearray(data):
+            if self.pending is None:
+                self.replies.append(ACK)
+            elif self.pending:
+                self.replies.append(NACK)
+            self.pending = self.pending is False
+
+
+@pytest.mark.parametrize("late_reads", [1, 2, 3])
+def test_synchronize_absorbs_late_replies_and_pairs_extra_bytes(late_reads):
+    connection = LateSyncConnection(late_reads)
+    run(AsyncStm32Bootloader(connection).reset_from_system_memory())
+    # the next command code is not taken for the complement of another
+    assert connection.pending is False
+    assert not connection.replies
+
+
+def test_one_event_loop_drives_several_boards():
+    connections = [FakeConnection(bytes([ACK, 1, 0x04, index, ACK])) for index in range(4)]
+
+    async def get_ids():
+        return await asyncio.gather(
+            *(AsyncStm32Bootloader(connection).get_id() for connection in connections)
+        )
+
+    assert run(get_ids()) == [0x400, 0x401, 0x402, 0x403]
+
+
+class PipeSerial:
+    """Minimal non-blocking pyserial stand-in on a pipe."""
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+        self.timeout = None
+
+    in_waiting = 0
+
+    def fileno(self):
+        return self.read_fd
+
+    def read(self, size):
+        return os.read(self.read_fd, size)
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+
+class PipeConnection:
+    def __init__(self):
+        self.serial_connection = PipeSerial()
+
+
+def test_async_serial_connection_reads_bytes_as_they_arrive():
+    connection = AsyncSerialConnection(PipeConnection())
+
+    async def exchange():
+        await connection.connect()
+        loop = asyncio.get_event_loop()
+        loop.call_later(0.01, os.write, connection.connection.serial_connection.write_fd, b"ab")
+        data = await connection.read(2)
+        connection.timeout = 0.01
+        timed_out = await connection.read(1)
+        connection.close()
+        return data, timed_out
+
+    assert run(exchange()) == (b"ab", b"")
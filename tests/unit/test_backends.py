@@ -0,0 +1,118 @@
+"""Unit tests for the connection backend registry."""
+
+import subprocess
+import sys
+
+import pytest
+
+from stm32loader import backends
+from stm32loader.backends import BackendError, get_backend
+
+# pylint: disable=missing-docstring
+
+# seconds that importing stm32loader.main may take in a fresh interpreter
+IMPORT_TIME_BUDGET = 1.0
+
+# modules of backends that importing stm32loader.main must not import
+BACKEND_MODULES = [
+    "serial",
+    "RPi",
+    "RPi.GPIO",
+    "periphery",
+    "stm32loader.uart",
+    "stm32loader.uart_gpios",
+]
+
+# modules that only some operations need, imported when they run
+OPERATION_MODULES = [
+    "threading",
+    "mmap",
+    "json",
+    "hashlib",
+    "stm32loader.gang",
+    "stm32loader.cache",
+    "stm32loader.image",
+    "stm32loader.devices",
+    "stm32loader.journal",
+]
+
+
+def run_python(code):
+    return subprocess.check_output([sys.executable, "-c", code]).decode().strip()
+
+
+@pytest.mark.parametrize("arguments", [["--help"], ["--no-such-option"], ["-e"]])
+def test_command_line_errors_and_help_do_not_import_serial(arguments):
+    imported = run_python(
+        "import sys\n"
+        "from stm32loader.main import main\n"
+        "main(*%r, avoid_system_exit=True)\n"
+        "print('serial' in sys.modules)\n" % (arguments,)
+    )
+    assert imported.splitlines()[-1] == "False"
+
+
+def test_import_time_of_main_is_within_budget():
+    # best of three, to be less sensitive to a busy machine
+    duration = min(
+        float(
+            run_python(
+                "import time\n"
+                "start = time.time()\n"
+                "import stm32loader.main\n"
+                "print(time.time() - start)\n"
+            )
+        )
+        for _attempt in range(3)
+    )
+    assert duration < IMPORT_TIME_BUDGET
+
+
+@pytest.mark.parametrize("modules", [BACKEND_MODULES, OPERATION_MODULES])
+def test_import_of_main_does_not_import_modules_of_backends_or_operations(modules):
+    imported = run_python(
+        "import sys\n"
+        "import stm32loader.main\n"
+        "print([name for name in %r if name in sys.modules])\n" % (modules,)
+    )
+    assert imported == "[]"
+
+
+def test_import_of_backends_does_not_import_bootloader():
+    imported = run_python(
+        "import sys\n"
+        "import stm32loader.backends\n"
+        "print('stm32loader.bootloader' in sys.modules)\n"
+    )
+    assert imported == "False"
+
+
+def test_get_backend_imports_builtin_backend_module():
+    pytest.importorskip("serial")
+    from stm32loader.uart import SerialConnection
+
+    assert get_backend("serial") is SerialConnection
+
+
+def test_get_backend_with_unknown_name_raises_backend_error():
+    with pytest.raises(BackendError, match="Unknown connection backend 'nope'"):
+        get_backend("nope")
+
+
+def test_get_backend_with_missing_module_raises_backend_error(monkeypatch):
+    monkeypatch.setitem(backends.BUILTIN_BACKENDS, "missing", ("stm32loader.no_such_module", "X"))
+    with pytest.raises(BackendError, match="Can not use connection backend 'missing'"):
+        get_backend("missing")
+
+
+def test_get_backend_loads_entry_point(monkeypatch):
+    class EntryPoint(object):
+        name = "plugin"
+
+        @staticmethod
+        def load():
+            return dict
+
+    monkeypatch.setattr(backends, "_entry_points", lambda: {"plugin": EntryPoint()})
+    assert "plugin" in backends.backend_names()
+    assert get_backend("plugin") is dict
@@ -0,0 +1,34 @@
+"""Unit tests for the throughput benchmarks."""
+
+import json
+
+from stm32loader.benchmark import format_table, run_benchmark, run_suite
+
+# pylint: disable=missing-docstring
+
+
+def test_write_benchmark_reports_throughput_below_wire_speed():
+    result = run_benchmark("write", 4096, baud_rate=115200)
+    assert result["frames"] == 3 * 16
+    assert result["link_time"] > 4096 * 11 / 115200.0
+    assert 0 < result["wire_speed_percent"] < 100
+    assert result["bytes_per_second"] == 4096 / result["total_time"]
+
+
+def test_link_time_scales_with_baud_rate():
+    slow = run_benchmark("read", 4096, baud_rate=57600)
+    fast = run_benchmark("read", 4096, baud_rate=115200)
+    assert slow["link_time"] > 1.8 * fast["link_time"]
+
+
+def test_verify_with_checksum_transfers_no_image():
+    result = run_benchmark("verify", 4096, checksum=True)
+    assert result["frames"] < 10
+    assert result["wire_speed_percent"] is None
+
+
+def test_suite_results_are_json_serializable():
+    suite = run_suite(sizes=[1024], operations=["erase", "session"])
+    assert [result["operation"] for result in suite["results"]] == ["erase", "session"]
+    assert json.loads(json.dumps(suite))["baud_rate"] == 115200
+    assert "session" in format_table(suite)
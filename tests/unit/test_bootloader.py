@@ -4,6 +4,7 @@ import pytest
 
 from stm32loader import bootloader as Stm32
 from stm32loader.bootloader import Stm32Bootloader
+from stm32loader.devices import get_device
 
 try:
     from unittest.mock import MagicMock
@@ -18,6 +19,7 @@ except ImportError:
 def connection():
     connection = MagicMock()
     connection.read.return_value = [Stm32Bootloader.Reply.ACK]
+    connection.readinto.side_effect = len
     return connection
 
 
@@ -121,6 +123,23 @@ def test_reset_from_system_memory_sends_command_synchronize(bootloader, write):
     assert write.data_was_written(bytearray([synchro_command]))
 
 
+def test_reset_from_system_memory_sets_boot0_and_reset_together(bootloader, connection):
+    bootloader.reset_hold_time = 0
+    bootloader.reset_from_system_memory()
+    connection.set_boot0_and_reset.assert_called_once_with(True, True)
+    connection.enable_reset.assert_called_once_with(False)
+    assert not connection.enable_boot0.called
+
+
+def test_reset_from_flash_without_set_boot0_and_reset_sets_lines_in_turn(connection):
+    del connection.set_boot0_and_reset
+    bootloader = Stm32Bootloader(connection)
+    bootloader.reset_hold_time = 0
+    bootloader.reset_from_flash()
+    connection.enable_boot0.assert_called_once_with(False)
+    assert connection.enable_reset.call_args_list == [((True,),), ((False,),)]
+
+
 def test_encode_address_returns_correct_bytes_with_checksum():
     # pylint:disable=protected-access
     encoded_address = Stm32Bootloader._encode_address(0x04030201)
@@ -205,6 +224,90 @@ def test_get_uid_for_unknown_family_returns_uid_address_unknown(bootloader):
     assert bootloader.UID_ADDRESS_UNKNOWN == bootloader.get_uid("X")
 
 
+def test_verify_data_reports_all_mismatch_ranges():
+    reference = bytearray(10000)
+    read = bytearray(reference)
+    read[5:8] = b"\xff\xff\xff"
+    read[4090:4100] = b"\x01" * 10
+    read[9999] = 0x02
+    message = "mismatch at address: 0x5.*14 bytes differ in 3 ranges"
+    with pytest.raises(Stm32.DataMismatchError, match=message) as error:
+        Stm32Bootloader.verify_data(read, reference)
+    assert error.value.mismatches == [
+        Stm32.MismatchRange(5, 3, 3),
+        Stm32.MismatchRange(4090, 10, 10),
+        Stm32.MismatchRange(9999, 1, 1),
+    ]
+
+
+@pytest.mark.parametrize("numpy", [False, None])
+def test_find_mismatches_joins_nearby_differences(monkeypatch, numpy):
+    # without NumPy, and with it if installed
+    monkeypatch.setattr(Stm32, "_numpy", numpy)
+    reference = bytes(bytearray(range(256)) * 64)
+    read = bytearray(reference)
+    for offset in [100, 110, 115, 4095, 4096]:
+        read[offset] ^= 0x80
+    assert Stm32Bootloader.find_mismatches(read, reference) == [
+        Stm32.MismatchRange(100, 16, 3),
+        Stm32.MismatchRange(4095, 2, 2),
+    ]
+    assert Stm32Bootloader.find_mismatches(reference, reference) == []
+
+
+def test_format_mismatches_summarizes_ranges():
+    mismatches = [Stm32.MismatchRange(0x08000000 + 0x100 * index, 4, 2) for index in range(10)]
+    summary = Stm32.format_mismatches(mismatches, limit=2)
+    assert summary.splitlines() == [
+        "20 bytes differ in 10 ranges",
+        "  0x08000000-0x08000003: 2 of 4 bytes",
+        "  0x08000100-0x08000103: 2 of 4 bytes",
+        "  ... and 8 more ranges",
+    ]
+
+
+@pytest.mark.parametrize(
+    "family, start, length",
+    [("F1", 0x1FFFF7E0, 20), ("F4", 0x1FFF7A10, 20), ("F7", 0x1FF0F420, 36)],
+)
+def test_get_device_info_reads_uid_and_flash_size_at_once(bootloader, family, start, length):
+    data = bytearray(range(length))
+    bootloader.read_memory = MagicMock(return_value=data)
+    uid, flash_size = bootloader.get_device_info(family)
+    bootloader.read_memory.assert_called_once_with(start, length)
+    uid_offset = bootloader.UID_ADDRESS[family] - start
+    flash_size_offset = bootloader.FLASH_SIZE_ADDRESS[family] - start
+    assert uid == data[uid_offset : uid_offset + 12]
+    assert flash_size == data[flash_size_offset] + 256 * data[flash_size_offset + 1]
+
+
+def test_get_flash_size_and_uid_f4_combines_flash_size_bytes(bootloader):
+    data = bytearray(20)
+    data[0x12:0x14] = b"\x00\x04"
+    bootloader.read_memory = MagicMock(return_value=data)
+    assert bootloader.get_flash_size_and_uid_f4()[1] == 1024
+
+
+def test_get_device_info_for_family_without_uid_reads_flash_size_only(bootloader):
+    bootloader.read_memory = MagicMock(return_value=bytearray(b"\x40\x00"))
+    assert bootloader.get_device_info("F0") == (bootloader.UID_NOT_SUPPORTED, 64)
+    bootloader.read_memory.assert_called_once_with(bootloader.FLASH_SIZE_ADDRESS["F0"], 2)
+
+
+def test_get_device_info_for_unknown_family_reads_nothing(bootloader):
+    bootloader.read_memory = MagicMock()
+    assert bootloader.get_device_info("X") == (bootloader.UID_ADDRESS_UNKNOWN, None)
+    assert not bootloader.read_memory.called
+
+
+def test_set_capabilities_replaces_get(bootloader):
+    bootloader.set_capabilities(0x31, [0x00, 0x44])
+    assert bootloader.bootloader_version == 0x31
+    assert bootloader.extended_erase
+    bootloader.set_capabilities(0x22, [0x00, 0x43])
+    assert not bootloader.extended_erase
+
+
 @pytest.mark.parametrize(
     "uid_string",
     [
@@ -217,3 +320,557 @@ def test_format_uid_returns_correct_string(bootloader, uid_string):
     uid, expected_description = uid_string
     description = bootloader.format_uid(uid)
     assert description == expected_description
+
+
+def test_write_memory_data_without_erase_sends_blank_chunks(bootloader, write):
+    bootloader.write_memory_data(0, b"\xff" * 256)
+    assert write.data_was_written(b"\xff" * 256)
+
+
+def test_write_memory_data_after_erase_skips_blank_chunks(bootloader, write):
+    bootloader.erase_memory()
+    data = b"\x01" * 256 + b"\xff" * 256 + b"\x02" * 256
+    skipped = bootloader.write_memory_data(0, data)
+    assert skipped == 1
+    assert not write.data_was_written(b"\xff" * 256)
+    assert write.data_was_written(b"\x02" * 256)
+
+
+def test_write_memory_data_after_page_erase_skips_blank_chunks_of_erased_pages_only(
+    bootloader, write
+):
+    bootloader.device = get_device(0x410)
+    bootloader.erase_memory([1, 2])
+    flash = bootloader.FLASH_START_ADDRESS
+    assert bootloader.erased_ranges == [(flash + 1024, flash + 3072)]
+    # blank chunks: at the start of erased page 1, and in page 3
+    data = b"\x01" * 768 + b"\xff" * 256 + b"\x02" * 2048 + b"\xff" * 256
+    skipped = bootloader.write_memory_data(flash + 256, data)
+    assert skipped == 1
+    assert write.data_was_written(b"\xff" * 256)
+    # trailing blank bytes are trimmed only inside erased pages
+    bootloader.write_memory_data(flash + 2048, b"\x03" * 4 + b"\xff" * 1020)
+    assert not write.data_was_written(b"\x03" * 4 + b"\xff" * 252)
+
+
+def test_write_memory_data_after_page_erase_of_unknown_layout_sends_blank_chunks(
+    bootloader, write
+):
+    bootloader.erase_memory([0])
+    assert bootloader.erased_ranges == []
+    bootloader.write_memory_data(bootloader.FLASH_START_ADDRESS, b"\xff" * 256)
+    assert write.data_was_written(b"\xff" * 256)
+
+
+def test_write_memory_data_with_skip_blank_trims_trailing_erased_bytes(bootloader, write):
+    bootloader.write_memory_data(0, b"\x01" * 4 + b"\xff" * 600, skip_blank=True)
+    # command byte, control byte, 4 address bytes, address checksum,
+    # length byte, 4 data bytes, checksum byte
+    assert len(write.written_data) == 2 + 4 + 1 + 1 + 4 + 1
+
+
+def test_write_memory_data_with_skip_blank_false_sends_blank_chunks_after_erase(
+    bootloader, write
+):
+    bootloader.erase_memory()
+    bootloader.write_memory_data(0, b"\xff" * 256, skip_blank=False)
+    assert write.data_was_written(b"\xff" * 256)
+
+
+@pytest.fixture
+def flash(bootloader):
+    """Replace bootloader memory access by a bytearray of 4 erased pages."""
+    # pages of FLASH_PAGE_SIZE bytes
+    bootloader.device = get_device(0x410)
+    flash = bytearray(b"\xff" * 4 * bootloader.FLASH_PAGE_SIZE)
+    start = bootloader.FLASH_START_ADDRESS
+
+    def read_memory_into(address, buffer):
+        buffer[:] = flash[address - start : address - start + len(buffer)]
+
+    bootloader.read_memory_into = read_memory_into
+    bootloader.erase_pages = MagicMock()
+    bootloader.write_memory_data = MagicMock()
+    return flash
+
+
+def test_flash_pages_returns_pages_overlapping_range(bootloader):
+    bootloader.device = get_device(0x410)
+    start = bootloader.FLASH_START_ADDRESS
+    pages = bootloader.flash_pages(start + 1000, 1100)
+    assert pages == [(0, start, 1024), (1, start + 1024, 1024), (2, start + 2048, 1024)]
+
+
+@pytest.mark.parametrize("family", [None, "F1", "L4"])
+def test_flash_pages_with_unknown_page_layout_raises_page_index_error(bootloader, family):
+    # e.g. F1 has 1 KiB or 2 KiB pages, depending on the device
+    bootloader.device_family = family
+    assert not bootloader.page_layout_known
+    with pytest.raises(Stm32.PageIndexError, match="layout .* is unknown"):
+        bootloader.flash_pages(bootloader.FLASH_START_ADDRESS, 16)
+
+
+def test_flash_pages_with_address_below_flash_raises_page_index_error(bootloader):
+    with pytest.raises(Stm32.PageIndexError):
+        bootloader.flash_pages(0x0, 16)
+
+
+def test_write_memory_delta_with_identical_data_writes_nothing(bootloader, flash):
+    flash[0:4] = b"\x01\x02\x03\x04"
+    changed = bootloader.write_memory_delta(bootloader.FLASH_START_ADDRESS, b"\x01\x02\x03\x04")
+    assert changed == []
+    assert not bootloader.erase_pages.called
+    assert not bootloader.write_memory_data.called
+
+
+def test_write_memory_delta_erases_and_rewrites_only_differing_pages(bootloader, flash):
+    page_size = bootloader.FLASH_PAGE_SIZE
+    flash[:] = b"\x11" * len(flash)
+    data = b"\x11" * page_size + b"\x22" * page_size
+    changed = bootloader.write_memory_delta(bootloader.FLASH_START_ADDRESS, data)
+    assert changed == [1]
+    bootloader.erase_pages.assert_called_once_with([1])
+    bootloader.write_memory_data.assert_called_once_with(
+        bootloader.FLASH_START_ADDRESS + page_size, bytearray(data[page_size:]), skip_blank=True
+    )
+
+
+def test_write_memory_delta_keeps_page_content_outside_of_data(bootloader, flash):
+    flash[:] = b"\x11" * len(flash)
+    changed = bootloader.write_memory_delta(bootloader.FLASH_START_ADDRESS + 2, b"\x22")
+    assert changed == [0]
+    written = bootloader.write_memory_data.call_args[0][1]
+    assert written[:4] == b"\x11\x11\x22\x11"
+
+
+def test_write_memory_delta_does_not_erase_blank_pages(bootloader, flash):
+    changed = bootloader.write_memory_delta(bootloader.FLASH_START_ADDRESS, b"\x22")
+    assert changed == [0]
+    assert not bootloader.erase_pages.called
+
+
+def test_flash_pages_for_sector_family_returns_sectors(bootloader):
+    bootloader.device_family = "F4"
+    start = bootloader.FLASH_START_ADDRESS
+    pages = bootloader.flash_pages(start + 60 * 1024, 8 * 1024)
+    assert pages == [(3, start + 48 * 1024, 16 * 1024), (4, start + 64 * 1024, 64 * 1024)]
+
+
+def test_flash_pages_with_device_descriptor_uses_its_layout(bootloader):
+    bootloader.device = get_device(0x414)
+    start = bootloader.FLASH_START_ADDRESS
+    assert bootloader.flash_pages(start + 2048, 2) == [(1, start + 2048, 2048)]
+    with pytest.raises(Stm32.PageIndexError):
+        bootloader.flash_pages(start + 511 * 1024, 2048)
+
+
+def test_get_device_info_uses_device_descriptor_registers(bootloader):
+    bootloader.device = get_device(0x440)
+    bootloader.read_memory = MagicMock(return_value=bytearray(b"\x20\x00"))
+    assert bootloader.get_device_info("F0") == (bootloader.UID_NOT_SUPPORTED, 32)
+    bootloader.read_memory.assert_called_once_with(0x1FFFF7CC, 2)
+
+
+@pytest.mark.parametrize("pages", [[256], [1] * 256])
+def test_erase_memory_with_invalid_pages_raises_before_sending_command(
+    bootloader, write, pages
+):
+    with pytest.raises(Stm32.PageIndexError):
+        bootloader.erase_memory(pages)
+    assert not write.written_data
+
+
+def test_erase_memory_with_page_index_higher_than_255_raises_page_index_error(bootloader):
+    with pytest.raises(Stm32.PageIndexError, match="Can not erase page 256"):
+        bootloader.erase_memory([256])
+
+
+def test_extended_erase_memory_with_more_than_256_pages_sends_two_byte_sector_count(
+    bootloader, write
+):
+    bootloader.extended_erase_memory(list(range(300)))
+    assert write.data_was_written(b'\x01\x2b\x00\x00')
+
+
+def test_erase_pages_splits_page_list_in_several_erase_commands(bootloader):
+    bootloader.erase_memory = MagicMock()
+    bootloader.erase_pages(range(300))
+    assert bootloader.erase_memory.call_count == 2
+    assert bootloader.erase_memory.call_args[0][0] == list(range(255, 300))
+
+
+def test_crc32_matches_stm32_crc_peripheral():
+    assert Stm32Bootloader.crc32(b"\x78\x56\x34\x12") == 0xDF8A8A2B
+
+
+def test_crc32_with_length_not_multiple_of_4_raises_data_length_error():
+    with pytest.raises(Stm32.DataLengthError):
+        Stm32Bootloader.crc32(b"\x01\x02\x03")
+
+
+def test_get_checksum_sends_address_and_length_with_checksum(bootloader, write):
+    bootloader.connection.read.side_effect = [[Stm32Bootloader.Reply.ACK]] * 5 + [
+        b"\x12\x34\x56\x78\x08"
+    ]
+    crc = bootloader.get_checksum(0x08000000, 0x400)
+    assert crc == 0x12345678
+    assert write.data_was_written(b"\xa1\x5e\x08\x00\x00\x00\x08\x00\x00\x04\x00\x04")
+
+
+def test_verify_memory_data_with_checksum_command_does_not_read_back(bootloader):
+    bootloader.available_commands = bytearray([Stm32Bootloader.Command.GET_CHECKSUM])
+    bootloader.get_checksum = MagicMock(return_value=0xDF8A8A2B)
+    bootloader.read_memory_data = MagicMock()
+    bootloader.verify_memory_data(0x08000000, b"\x78\x56\x34\x12")
+    assert not bootloader.read_memory_data.called
+
+
+def test_verify_memory_data_with_checksum_mismatch_reads_back_to_locate_error(bootloader):
+    bootloader.available_commands = bytearray([Stm32Bootloader.Command.GET_CHECKSUM])
+    bootloader.get_checksum = MagicMock(return_value=0)
+    bootloader.read_memory_data = MagicMock(return_value=bytearray(b"\x78\x56\x34\x13"))
+    with pytest.raises(Stm32.DataMismatchError, match="mismatch at address: 0x3"):
+        bootloader.verify_memory_data(0x08000000, b"\x78\x56\x34\x12")
+
+
+def test_verify_memory_data_without_checksum_command_reads_back(bootloader):
+    bootloader.read_memory_data = MagicMock(return_value=bytearray(b"\x01\x02"))
+    bootloader.verify_memory_data(0x08000000, b"\x01\x02")
+    bootloader.read_memory_data.assert_called_once_with(0x08000000, 2)
+
+
+def test_write_with_several_arguments_calls_connection_write_once(bootloader, write):
+    bootloader.write(0x03, b'\x01\x02', 0x0a)
+    assert write.call_count == 1
+    assert write.data_was_written(b'\x03\x01\x02\x0a')
+
+
+def test_write_memory_sends_data_frame_in_single_write(bootloader, write):
+    bootloader.write_memory(0, bytearray(range(256)))
+    # command, address, data frame
+    assert write.call_count == 3
+
+
+@pytest.mark.parametrize("length", [0, 1, 7, 8, 9, 255, 256])
+def test_checksum_equals_xor_of_all_bytes(length):
+    # pylint:disable=protected-access
+    data = bytearray((i * 37 + 11) & 0xFF for i in range(length))
+    expected = 0
+    for byte in data:
+        expected ^= byte
+    assert Stm32Bootloader._checksum(data) == expected
+
+
+def test_encode_frame_appends_padding_and_checksum(bootloader):
+    # pylint:disable=protected-access
+    frame = bootloader._encode_frame(b'\x03', b'\x01\x02', padding=2)
+    assert bytes(frame) == b'\x03\x01\x02\xff\xff\x00'
+
+
+def test_read_memory_data_into_fills_caller_supplied_buffer(bootloader, connection):
+    def readinto(buffer):
+        buffer[:] = b"\x5a" * len(buffer)
+        return len(buffer)
+
+    connection.readinto.side_effect = readinto
+    buffer = bytearray(600)
+    bootloader.read_memory_data_into(0x08000000, buffer)
+    assert buffer == b"\x5a" * 600
+    assert connection.readinto.call_count == 3
+
+
+def test_read_memory_without_readinto_falls_back_to_read(bootloader, connection):
+    del connection.readinto
+    connection.read.side_effect = [[Stm32Bootloader.Reply.ACK]] * 3 + [b"\x01\x02"]
+    assert bootloader.read_memory(0, 2) == b"\x01\x02"
+
+
+def test_read_memory_with_short_read_raises_command_error(bootloader, connection):
+    connection.readinto.side_effect = lambda buffer: len(buffer) - 1
+    with pytest.raises(Stm32.CommandError, match="timeout"):
+        bootloader.read_memory(0, 4)
+
+
+def test_write_memory_data_with_start_offset_skips_data_before_offset(bootloader, write):
+    bootloader.write_memory_data(0, b"\x01" * 256 + b"\x02" * 256, start_offset=256)
+    assert not write.data_was_written(b"\x01" * 4)
+    assert write.data_was_written(b"\x02" * 256)
+
+
+def test_write_memory_data_reports_confirmed_offset_to_progress_callback(bootloader):
+    progress_callback = MagicMock()
+    bootloader.write_memory_data(0, b"\x01" * 300, progress_callback=progress_callback)
+    assert [call[0][0] for call in progress_callback.call_args_list] == [256, 300]
+
+
+def test_report_passes_message_to_message_reporter(bootloader, capsys):
+    bootloader.message_reporter = MagicMock()
+    bootloader.report("Writing finished!")
+    bootloader.message_reporter.assert_called_once_with("Writing finished!")
+    assert not capsys.readouterr().out
+
+
+def test_resync_write_continues_after_chunks_written_since_last_record(bootloader, flash):
+    data = b"\x11" * 1024
+    flash[:768] = data[:768]
+    offset = bootloader.resync_write(bootloader.FLASH_START_ADDRESS, data, 256)
+    assert offset == 768
+    assert not bootloader.erase_pages.called
+
+
+def test_resync_write_with_partially_written_chunk_erases_its_page(bootloader, flash):
+    page_size = bootloader.FLASH_PAGE_SIZE
+    data = b"\x11" * 2 * page_size
+    flash[: page_size + 256] = data[: page_size + 256]
+    flash[page_size + 256 : page_size + 258] = b"\x00\x00"
+    offset = bootloader.resync_write(bootloader.FLASH_START_ADDRESS, data, page_size + 256)
+    assert offset == page_size
+    bootloader.erase_pages.assert_called_once_with([1])
+
+
+def test_resync_write_with_damaged_confirmed_chunk_erases_its_page(bootloader, flash):
+    data = b"\x11" * 1024
+    flash[:512] = data[:512]
+    flash[300] = 0x00
+    offset = bootloader.resync_write(bootloader.FLASH_START_ADDRESS, data, 512)
+    assert offset == 0
+    bootloader.erase_pages.assert_called_once_with([0])
+
+
+def test_resync_write_in_page_of_earlier_segment_rewrites_its_data(bootloader, flash):
+    # this segment starts halfway page 0, after an earlier segment
+    data = b"\x11" * 1024
+    flash[:512] = b"\x22" * 512
+    flash[512:768] = data[:256]
+    flash[600] = 0x00
+    address = bootloader.FLASH_START_ADDRESS + 512
+    image_bytes = MagicMock(return_value=b"\x22" * 512)
+    offset = bootloader.resync_write(address, data, 256, image_bytes=image_bytes)
+    assert offset == 0
+    bootloader.erase_pages.assert_called_once_with([0])
+    image_bytes.assert_called_once_with(bootloader.FLASH_START_ADDRESS, 512)
+    bootloader.write_memory_data.assert_called_once_with(
+        bootloader.FLASH_START_ADDRESS, b"\x22" * 512, skip_blank=True
+    )
+
+
+def test_write_memory_data_with_chunk_retries_retries_failed_chunk(bootloader):
+    bootloader.chunk_retries = 1
+    bootloader.link_recovery = MagicMock()
+    bootloader.write_memory = MagicMock(side_effect=[Stm32.CommandError("timeout"), None])
+    bootloader.read_memory = MagicMock(return_value=bytearray(b"\xff" * 4))
+    bootloader.write_memory_data(0, b"\x01" * 4)
+    assert bootloader.write_memory.call_count == 2
+    assert bootloader.link_recovery.called
+
+
+def test_write_memory_data_with_chunk_retries_does_not_rewrite_programmed_chunk(bootloader):
+    bootloader.chunk_retries = 1
+    bootloader.write_memory = MagicMock(side_effect=[Stm32.CommandError("timeout"), None])
+    bootloader.read_memory = MagicMock(return_value=bytearray(b"\x01" * 4))
+    bootloader.write_memory_data(0, b"\x01" * 4)
+    assert bootloader.write_memory.call_count == 1
+
+
+def test_write_memory_data_with_partially_written_chunk_raises_command_error(bootloader):
+    bootloader.chunk_retries = 1
+    bootloader.write_memory = MagicMock(side_effect=Stm32.CommandError("timeout"))
+    bootloader.read_memory = MagicMock(return_value=bytearray(b"\x01\xff\xff\xff"))
+    with pytest.raises(Stm32.CommandError, match="written partially"):
+        bootloader.write_memory_data(0, b"\x01" * 4)
+
+
+def test_write_memory_data_without_chunk_retries_raises_first_error(bootloader):
+    bootloader.write_memory = MagicMock(side_effect=Stm32.CommandError("timeout"))
+    with pytest.raises(Stm32.CommandError, match="timeout"):
+        bootloader.write_memory_data(0, b"\x01" * 4)
+    assert bootloader.write_memory.call_count == 1
+
+
+def test_command_with_adaptive_timeouts_sets_timeout_from_measured_latency(
+    bootloader, connection
+):
+    bootloader.adaptive_timeouts = True
+    bootloader.command(0x01, "bogus command")
+    bootloader.command(0x01, "bogus command")
+    assert connection.timeout < 1
+
+
+def test_command_without_adaptive_timeouts_keeps_timeout(bootloader, connection):
+    connection.timeout = 5
+    bootloader.command(0x01, "bogus command")
+    bootloader.command(0x01, "bogus command")
+    assert connection.timeout == 5
+
+
+def test_read_memory_with_adaptive_timeouts_allows_for_transfer_time(bootloader, connection):
+    # pylint:disable=protected-access
+    bootloader.adaptive_timeouts = True
+    bootloader._latency_samples = [0.001]
+    connection.baud_rate = 9600
+    bootloader.read_memory(0, 256)
+    # 256 bytes of 11 bits at 9600 baud take about 0.3 seconds
+    assert 0.3 < connection.timeout < 0.5
+
+
+def test_late_reply_falls_back_to_default_timeout(bootloader, connection):
+    # pylint:disable=protected-access
+    connection.timeout = 5
+    bootloader.adaptive_timeouts = True
+    bootloader._latency_samples = [0.001]
+    timeouts = []
+    replies = [b"", [Stm32Bootloader.Reply.ACK]]
+
+    def read(*_args):
+        timeouts.append(connection.timeout)
+        return replies.pop(0)
+
+    connection.read.side_effect = read
+    bootloader.command(0x01, "bogus command")
+    assert timeouts[0] < 1
+    assert timeouts[1] == 5
+    assert bootloader.late_replies == 1
+    # the next command uses the adaptive timeout again
+    connection.read.side_effect = None
+    bootloader.command(0x01, "bogus command")
+    assert connection.timeout < 1
+
+
+def test_late_data_falls_back_to_default_timeout(bootloader, connection):
+    # pylint:disable=protected-access
+    connection.timeout = 5
+    bootloader.adaptive_timeouts = True
+    bootloader._latency_samples = [0.001]
+    connection.readinto.side_effect = [100, 156]
+    assert len(bootloader.read_memory(0, 256)) == 256
+    assert len(connection.readinto.call_args_list[1][0][0]) == 156
+    assert bootloader.late_replies == 1
+
+
+def test_erase_memory_with_adaptive_timeouts_uses_erase_timeout(bootloader, connection):
+    bootloader.adaptive_timeouts = True
+    timeouts = []
+    connection.read.side_effect = lambda *args: timeouts.append(connection.timeout) or [
+        Stm32Bootloader.Reply.ACK
+    ]
+    bootloader.erase_memory()
+    assert timeouts[-1] == Stm32Bootloader.ERASE_TIMEOUT
+
+
+@pytest.mark.parametrize(
+    "protect",
+    [
+        lambda stm32: stm32.write_protect([0]),
+        Stm32Bootloader.write_unprotect,
+        Stm32Bootloader.readout_protect,
+    ],
+)
+def test_option_byte_commands_with_adaptive_timeouts_use_erase_timeout(
+    bootloader, connection, protect
+):
+    # pylint:disable=protected-access
+    bootloader.adaptive_timeouts = True
+    bootloader._latency_samples = [0.001]
+    timeouts = []
+    connection.read.side_effect = lambda *args: timeouts.append(connection.timeout) or [
+        Stm32Bootloader.Reply.ACK
+    ]
+    protect(bootloader)
+    assert timeouts[0] < 1
+    assert timeouts[-1] == Stm32Bootloader.ERASE_TIMEOUT
+
+
+def test_reset_from_system_memory_repeats_synchronize_until_reply(bootloader, connection, write):
+    bootloader.SYNC_PROBE_INTERVAL = 0.001
+    ack, nack = Stm32Bootloader.Reply.ACK, Stm32Bootloader.Reply.NACK
+    # no late replies; then the first extra byte is pending, and the
+    # second completes it
+    connection.read.side_effect = [b"", b"", [ack], b"", b"", [nack]]
+    bootloader.reset_from_system_memory()
+    assert write.written_data == b"\x7f\x7f\x7f\x7f\x7f"
+
+
+def test_reset_from_system_memory_absorbs_late_replies_to_synchronize(bootloader, connection):
+    bootloader.SYNC_PROBE_INTERVAL = 0.001
+    ack, nack = Stm32Bootloader.Reply.ACK, Stm32Bootloader.Reply.NACK
+    # the ACK of the first byte arrives after the second one was sent;
+    # one more byte completes the second one, pending as a command code
+    connection.read.side_effect = [b"", [ack], b"", [nack], [ack], [1], [0x31], [0x00], [ack]]
+    bootloader.reset_from_system_memory()
+    bootloader.get()
+    assert bootloader.bootloader_version == 0x31
+
+
+def test_reset_from_system_memory_without_reply_raises_command_error(bootloader, connection):
+    bootloader.SYNC_PROBE_INTERVAL = 0.001
+    bootloader.SYNC_TIMEOUT = 0.01
+    connection.read.return_value = b""
+    with pytest.raises(Stm32.CommandError, match="timeout"):
+        bootloader.reset_from_system_memory()
+
+
+def test_reset_from_system_memory_accepts_nack_of_synchronized_bootloader(bootloader, connection):
+    connection.read.return_value = [Stm32Bootloader.Reply.NACK]
+    assert bootloader.reset_from_system_memory()
+
+
+def test_reset_from_system_memory_restores_timeout(bootloader, connection):
+    connection.timeout = 5
+    bootloader.reset_from_system_memory()
+    assert connection.timeout == 5
+
+
+def test_probe_with_get_reply_returns_true(bootloader, connection, write):
+    ack = Stm32Bootloader.Reply.ACK
+    connection.read.side_effect = [[ack], [1], [0x31], [0x00], [ack]]
+    assert bootloader.probe()
+    assert write.written_data == b"\x00\xff"
+
+
+def test_probe_without_reply_returns_false(bootloader, connection):
+    connection.read.return_value = b""
+    assert not bootloader.probe()
+
+
+def test_probe_restores_timeout_and_adaptive_timeouts(bootloader, connection):
+    connection.timeout = 5
+    connection.read.return_value = b""
+    bootloader.adaptive_timeouts = True
+    bootloader.probe()
+    assert connection.timeout == 5
+    assert bootloader.adaptive_timeouts
+    assert not bootloader._latency_samples
+
+
+def test_encode_data_frames_matches_frames_of_write_memory(bootloader, write):
+    data = bytearray(range(256)) + bytearray(b"\x01\x02\x03")
+    frames = Stm32Bootloader.encode_data_frames(data)
+    assert len(frames) == 2
+    bootloader.write_memory(0, data[256:])
+    assert write.written_data.endswith(frames[1])
+    assert frames[1] == b"\x03\x01\x02\x03\xff\xfc"
+
+
+def test_write_memory_data_sends_given_frames(bootloader, write):
+    data = bytearray(512)
+    frames = [b"\xffframe0", b"\xffframe1"]
+    bootloader.write_memory_data(0x08000000, data, frames=frames)
+    assert write.data_was_written(b"\xffframe0")
+    assert write.data_was_written(b"\xffframe1")
+
+
+def test_write_memory_data_with_unaligned_start_offset_sends_frames_of_whole_chunks(
+    bootloader, write
+):
+    # e.g. the offset of a page after resync_write(), in a segment that
+    # starts at 0x08000010
+    data = bytearray(b"\x01" * 1008 + b"\x02" * 256)
+    frames = Stm32Bootloader.encode_data_frames(data)
+    progress_callback = MagicMock()
+    bootloader.write_memory_data(
+        0x08000010, data, start_offset=1008, frames=frames, progress_callback=progress_callback
+    )
+    # 16 bytes up to the chunk boundary, then the frame of the last chunk
+    assert write.data_was_written(Stm32Bootloader.encode_data_frames(b"\x02" * 16)[0])
+    assert write.written_data.endswith(frames[4])
+    assert [call[0][0] for call in progress_callback.call_args_list] == [1024, 1264]
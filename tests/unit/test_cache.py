@@ -0,0 +1,169 @@
+"""Unit tests for the cache of images verified per device."""
+
+import sys
+
+import pytest
+
+from stm32loader.cache import FlashCache
+from stm32loader.image import MemoryImage
+
+# pylint: disable=missing-docstring, redefined-outer-name
+# pylint: disable=import-outside-toplevel
+
+FLASH = 0x08000000
+
+needs_simulator = pytest.mark.skipif(
+    sys.version_info < (3, 5), reason="the simulator needs Python 3"
+)
+
+
+def memory_image(data, address=FLASH):
+    image = MemoryImage()
+    image.add(address, data)
+    return image
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return FlashCache(str(tmp_path / "cache.json"))
+
+
+def test_lookup_matches_stored_image_per_device(cache):
+    image = memory_image(b"\x01\x02")
+    assert not cache.lookup("UID-1", image)
+    cache.store("UID-1", image)
+    assert cache.lookup("UID-1", image)
+    assert not cache.lookup("UID-2", image)
+    assert not cache.lookup("UID-1", memory_image(b"\x01\x02", FLASH + 4))
+
+
+def test_forget_removes_entry(cache):
+    image = memory_image(b"\x01\x02")
+    cache.store("UID-1", image)
+    cache.store("UID-2", image)
+    cache.forget("UID-1")
+    assert not cache.lookup("UID-1", image)
+    assert cache.lookup("UID-2", image)
+
+
+def test_corrupt_cache_file_is_empty(cache):
+    with open(cache.path, "w") as cache_file:
+        cache_file.write("{not json")
+    assert not cache.lookup("UID-1", memory_image(b"\x01"))
+    cache.store("UID-1", memory_image(b"\x01"))
+    assert cache.lookup("UID-1", memory_image(b"\x01"))
+
+
+def test_capabilities_per_chip_id(cache):
+    assert cache.lookup_capabilities(0x410) is None
+    cache.store_capabilities(0x410, 0x22, bytearray([0x00, 0x01, 0x43]))
+    cache.store("UID-1", memory_image(b"\x01"))
+    assert cache.lookup_capabilities(0x410) == (0x22, bytearray([0x00, 0x01, 0x43]))
+    assert cache.lookup_capabilities(0x414) is None
+    assert cache.lookup("UID-1", memory_image(b"\x01"))
+
+
+@pytest.fixture
+def simulator():
+    from stm32loader.simulator import BootloaderSimulator
+
+    return BootloaderSimulator(chip_id=0x410, family="F1", flash_size=16 * 1024)
+
+
+def connect(simulator):
+    from stm32loader.bootloader import Stm32Bootloader
+    from stm32loader.simulator import SimulatedConnection
+
+    stm32 = Stm32Bootloader(SimulatedConnection(simulator), verbosity=0)
+    stm32.reset_from_system_memory()
+    stm32.get()
+    return stm32
+
+
+@needs_simulator
+def test_check_memory_data_samples_first_and_last_chunk(simulator):
+    data = bytearray(range(256)) * 16
+    simulator.flash[: len(data)] = data
+    stm32 = connect(simulator)
+    assert stm32.check_memory_data(FLASH, data)
+    simulator.flash[len(data) - 1] ^= 0xFF
+    assert not stm32.check_memory_data(FLASH, data)
+
+
+@needs_simulator
+def test_check_memory_data_with_checksum_mismatch_reads_nothing_back(monkeypatch):
+    from stm32loader.simulator import BootloaderSimulator
+
+    simulator = BootloaderSimulator(get_checksum=True)
+    data = bytearray(range(256)) * 16 + bytearray(b"\x01\x02")
+    simulator.flash[: len(data)] = data
+    stm32 = connect(simulator)
+    assert stm32.check_memory_data(FLASH, data)
+
+    def read_memory(*_args):
+        raise AssertionError("flash read back")
+
+    monkeypatch.setattr(stm32, "read_memory", read_memory)
+    monkeypatch.setattr(stm32, "read_memory_data", read_memory)
+    simulator.flash[0] ^= 0xFF
+    assert not stm32.check_memory_data(FLASH, data)
+
+
+@needs_simulator
+def test_already_flashed_image_is_not_written_again(simulator, cache, tmp_path):
+    pytest.importorskip("serial")
+    from stm32loader.main import Stm32Loader
+
+    data_file = tmp_path / "image.bin"
+    data_file.write_bytes(bytes(bytearray(range(256)) * 32))
+
+    def run():
+        loader = Stm32Loader()
+        loader.configuration.update(
+            data_file=str(data_file),
+            family="F1",
+            cache=cache.path,
+            erase=True,
+            write=True,
+            verify=True,
+        )
+        loader.device_uid = "UID-1"
+        loader.stm32 = connect(simulator)
+        loader.stm32.device_family = "F1"
+        start = simulator.clock
+        loader.perform_commands()
+        return simulator.clock - start
+
+    first_run = run()
+    assert simulator.read(FLASH, 8192) == data_file.read_bytes()
+    second_run = run()
+    assert second_run < first_run / 5
+
+    # changed flash is written again
+    simulator.flash[0] = 0x55
+    run()
+    assert simulator.read(FLASH, 1) == b"\x00"
+
+
+@needs_simulator
+def test_read_device_details_skips_get_known_from_cache(simulator, cache):
+    pytest.importorskip("serial")
+    from unittest.mock import MagicMock
+
+    from stm32loader.main import Stm32Loader
+
+    def read_device_details():
+        loader = Stm32Loader()
+        loader.configuration.update(family="F1", cache=cache.path)
+        loader.stm32 = connect(simulator)
+        loader.stm32.bootloader_version = None
+        loader.stm32.get = MagicMock(wraps=loader.stm32.get)
+        loader.read_device_details()
+        return loader
+
+    first = read_device_details()
+    assert first.stm32.get.call_count == 1
+    second = read_device_details()
+    assert not second.stm32.get.called
+    assert second.stm32.available_commands == first.stm32.available_commands
+    assert second.device_uid == first.device_uid
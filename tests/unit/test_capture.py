@@ -0,0 +1,156 @@
+"""Unit tests for capturing and replaying bootloader traffic."""
+
+import pytest
+
+from stm32loader import bootloader as Stm32
+from stm32loader.bootloader import Stm32Bootloader
+from stm32loader.capture import (
+    MAGIC,
+    CaptureConnection,
+    CaptureError,
+    Event,
+    ReplayConnection,
+    capture_host_latencies,
+    format_summary,
+    load_capture,
+)
+from stm32loader.simulator import BootloaderSimulator, SimulatedConnection
+
+# pylint: disable=missing-docstring, redefined-outer-name
+
+FLASH = Stm32Bootloader.FLASH_START_ADDRESS
+DATA = bytearray(range(256)) * 2 + bytearray(b"\x01\x02\x03")
+
+
+def session(connection):
+    stm32 = Stm32Bootloader(connection, verbosity=0)
+    stm32.reset_from_system_memory()
+    stm32.get()
+    chip_id = stm32.get_id()
+    stm32.erase_memory()
+    stm32.write_memory_data(FLASH, DATA)
+    return chip_id, stm32.read_memory_data(FLASH, len(DATA))
+
+
+@pytest.fixture
+def capture_file(tmp_path):
+    file_name = str(tmp_path / "session.cap")
+    simulator = BootloaderSimulator(chip_id=0x410, family="F1", flash_size=16 * 1024)
+    connection = CaptureConnection(SimulatedConnection(simulator), file_name)
+    assert session(connection) == (0x410, DATA)
+    connection.close()
+    return file_name
+
+
+def test_capture_records_all_traffic(capture_file):
+    events = load_capture(capture_file)
+    kinds = [event.kind for event in events]
+    assert Event.RESET in kinds and Event.BOOT0 in kinds
+    writes = [event.data for event in events if event.kind == Event.WRITE]
+    assert writes[0] == b"\x7f"
+    assert writes[1] == b"\x00\xff"
+    reads = [event for event in events if event.kind == Event.READ]
+    assert all(event.size == len(event.data) for event in reads)
+    starts = [event.start for event in events]
+    assert starts == sorted(starts)
+
+
+def test_replay_reproduces_session(capture_file):
+    connection = ReplayConnection.load(capture_file)
+    assert session(connection) == (0x410, DATA)
+    assert connection._position == len(connection.events)
+    assert len(connection.host_latencies) == len(capture_host_latencies(connection.events))
+
+
+def test_replay_detects_different_write(capture_file):
+    connection = ReplayConnection.load(capture_file)
+    stm32 = Stm32Bootloader(connection, verbosity=0)
+    stm32.reset_from_system_memory()
+    with pytest.raises(CaptureError, match="differs from capture"):
+        stm32.get_id()
+
+
+def test_capture_passes_baud_rate_to_connection(tmp_path):
+    simulator = BootloaderSimulator()
+    connection = CaptureConnection(SimulatedConnection(simulator), str(tmp_path / "baud.cap"))
+    connection.baud_rate = 921600
+    connection.close()
+    assert simulator.baud_rate == 921600
+    assert connection.baud_rate == 921600
+
+
+def test_replay_remembers_baud_rate(capture_file):
+    connection = ReplayConnection.load(capture_file)
+    assert connection.baud_rate == 115200
+    connection.baud_rate = 57600
+    assert connection.baud_rate == 57600
+
+
+class LossyConnection(SimulatedConnection):
+    """Loses all replies once lossy is set."""
+
+    lossy = False
+
+    def read(self, size=1):
+        data = SimulatedConnection.read(self, size)
+        return b"" if self.lossy else data
+
+
+def test_replay_reproduces_timeout(tmp_path):
+    file_name = str(tmp_path / "timeout.cap")
+    lossy_connection = LossyConnection(BootloaderSimulator())
+    stm32 = Stm32Bootloader(CaptureConnection(lossy_connection, file_name), verbosity=0)
+    stm32.reset_from_system_memory()
+    lossy_connection.lossy = True
+    with pytest.raises(Stm32.CommandError):
+        stm32.get()
+    stm32.connection.close()
+
+    events = load_capture(file_name)
+    assert "of which 1 timed out" in format_summary(events)
+    replay = Stm32Bootloader(ReplayConnection(events), verbosity=0)
+    replay.reset_from_system_memory()
+    with pytest.raises(Stm32.CommandError):
+        replay.get()
+
+
+def test_load_capture_ignores_cut_off_record(capture_file):
+    with open(capture_file, "rb") as file:
+        content = file.read()
+    with open(capture_file, "wb") as file:
+        file.write(content[:-3])
+    assert len(load_capture(capture_file)) >= 1
+
+
+def test_load_capture_rejects_other_files(tmp_path):
+    file_name = str(tmp_path / "other.bin")
+    with open(file_name, "wb") as file:
+        file.write(b"\x00" * len(MAGIC))
+    with pytest.raises(CaptureError):
+        load_capture(file_name)
+
+
+def test_main_closes_capture_file(tmp_path, monkeypatch):
+    # pylint: disable=import-outside-toplevel
+    from stm32loader import backends
+    from stm32loader.main import main
+
+    class Connection(SimulatedConnection):
+        def connect(self):
+            pass
+
+    simulator = BootloaderSimulator(chip_id=0x410, family="F1", flash_size=16 * 1024)
+    monkeypatch.setattr(backends, "create_connection", lambda *_args: Connection(simulator))
+    closed = []
+    close = CaptureConnection.close
+
+    def spy_close(self):
+        closed.append(self)
+        close(self)
+
+    monkeypatch.setattr(CaptureConnection, "close", spy_close)
+    file_name = str(tmp_path / "session.cap")
+    main("-p", "sim", "-f", "F1", "--capture=" + file_name, avoid_system_exit=True)
+    assert len(closed) == 1
+    assert closed[0]._file.closed  # pylint: disable=protected-access
+    assert load_capture(file_name)
@@ -0,0 +1,86 @@
+"""Unit tests for the device descriptor table."""
+
+import sys
+
+import pytest
+
+from stm32loader import devices
+from stm32loader.devices import KIB, get_device
+
+# pylint: disable=missing-docstring, import-outside-toplevel
+
+FLASH = 0x08000000
+
+
+def test_get_device_returns_descriptor_of_chip_id():
+    device = get_device(0x410)
+    assert device.family == "F1"
+    assert device.flash_size == 128 * KIB
+    assert device.page_count == 128
+    assert get_device(0x410) is device
+
+
+def test_get_device_with_unknown_chip_id_returns_none():
+    assert get_device(0x123) is None
+
+
+@pytest.mark.parametrize("row", devices._DEVICE_TABLE)  # pylint: disable=protected-access
+def test_device_table_is_consistent(row):
+    device = get_device(row[0])
+    pages = device.flash_pages(FLASH, device.flash_size)
+    assert len(pages) == device.page_count
+    assert pages[-1][1] + pages[-1][2] == FLASH + device.flash_size
+    assert all(size in device.erase_times for _index, _address, size in pages)
+
+
+def test_flash_pages_of_uniform_layout():
+    device = get_device(0x414)
+    assert device.flash_pages(FLASH + 2047, 2) == [(0, FLASH, 2048), (1, FLASH + 2048, 2048)]
+    assert device.flash_pages(FLASH, 0) == []
+
+
+def test_flash_pages_of_sector_layout():
+    device = get_device(0x413)
+    assert device.flash_pages(FLASH + 60 * KIB, 8 * KIB) == [
+        (3, FLASH + 48 * KIB, 16 * KIB),
+        (4, FLASH + 64 * KIB, 64 * KIB),
+    ]
+    assert device.flash_pages(FLASH + 1024 * KIB - 1, 1) == [(11, FLASH + 896 * KIB, 128 * KIB)]
+
+
+def test_flash_pages_of_dual_bank_device():
+    device = get_device(0x419)
+    second_bank = FLASH + device.flash_size // 2
+    assert device.flash_pages(second_bank, 1) == [(12, second_bank, 16 * KIB)]
+
+
+def test_flash_pages_outside_flash_raises_value_error():
+    device = get_device(0x410)
+    with pytest.raises(ValueError, match="not within the flash"):
+        device.flash_pages(FLASH + 128 * KIB - 1, 2)
+
+
+def test_erase_and_program_time():
+    device = get_device(0x413)
+    assert device.erase_time(device.flash_pages(FLASH, 1)) == pytest.approx(0.25)
+    assert device.erase_time() == pytest.approx(4 * 0.25 + 0.55 + 7 * 1.0)
+    assert device.program_time(64 * KIB) == pytest.approx(64 * 0.0041)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="the simulator needs Python 3")
+def test_read_device_details_detects_family_from_chip_id():
+    pytest.importorskip("serial")
+    from stm32loader.bootloader import Stm32Bootloader
+    from stm32loader.main import Stm32Loader
+    from stm32loader.simulator import BootloaderSimulator, SimulatedConnection
+
+    simulator = BootloaderSimulator(chip_id=0x410, family="F1", flash_size=128 * KIB)
+    loader = Stm32Loader()
+    loader.configuration["family"] = None
+    loader.stm32 = Stm32Bootloader(SimulatedConnection(simulator), verbosity=0)
+    loader.stm32.reset_from_system_memory()
+    loader.read_device_details()
+    assert loader.configuration["family"] == "F1"
+    assert loader.stm32.device_family == "F1"
+    assert loader.stm32.device is get_device(0x410)
+    assert loader.device_uid
@@ -0,0 +1,93 @@
+"""Unit tests for flashing several boards at once."""
+
+import pytest
+
+pytest.importorskip("serial")
+
+# pylint: disable=wrong-import-position
+from stm32loader import gang  # noqa: E402
+from stm32loader.main import Stm32Loader, expand_ports  # noqa: E402
+
+# pylint: disable=missing-docstring, redefined-outer-name
+
+
+@pytest.fixture
+def configuration():
+    loader = Stm32Loader()
+    return dict(loader.configuration, write=True, data_file="image.bin")
+
+
+@pytest.fixture
+def loaders(monkeypatch):
+    loaders = []
+
+    def connect(self):
+        loaders.append(self)
+        if self.port == "broken":
+            self.debug(0, "Communication failure. Quitting...")
+            raise SystemExit(7)
+
+    monkeypatch.setattr(gang._PortLoader, "connect", connect)
+    monkeypatch.setattr(gang._PortLoader, "read_device_details", lambda self: None)
+    monkeypatch.setattr(gang._PortLoader, "perform_commands", lambda self: None)
+    monkeypatch.setattr(gang._PortLoader, "reset", lambda self: None)
+    return loaders
+
+
+def test_expand_ports_matches_patterns_and_keeps_plain_names(tmp_path):
+    for name in ["ttyUSB1", "ttyUSB0", "ttyACM0"]:
+        tmp_path.joinpath(name).touch()
+    pattern = str(tmp_path.joinpath("ttyUSB*"))
+    ports = expand_ports(["COM3", pattern, "COM3"])
+    assert ports == ["COM3", str(tmp_path.joinpath("ttyUSB0")), str(tmp_path.joinpath("ttyUSB1"))]
+
+
+def test_parse_arguments_collects_repeated_port_options():
+    loader = Stm32Loader()
+    loader.parse_arguments(["-p", "COM3", "-p", "COM4", "-w", "image.bin"])
+    assert loader.ports == ["COM3", "COM4"]
+
+
+def test_parse_arguments_rejects_read_from_several_ports():
+    loader = Stm32Loader()
+    with pytest.raises(SystemExit):
+        loader.parse_arguments(["-p", "COM3", "-p", "COM4", "-r", "-l", "16", "dump.bin"])
+
+
+def test_run_reports_status_of_each_port(configuration, loaders, monkeypatch):
+    monkeypatch.setattr(gang.GangLoader, "_load_image", lambda self: None)
+    gang_loader = gang.GangLoader(["COM3", "broken", "COM4"], configuration)
+    results = gang_loader.run(jobs=2)
+    assert [result.port for result in results] == ["COM3", "broken", "COM4"]
+    assert [result.status for result in results] == [0, 7, 0]
+    assert results[1].message == "Communication failure. Quitting..."
+
+
+def test_run_shares_image_and_frames(configuration, loaders, tmp_path):
+    data_file = tmp_path.joinpath("image.bin")
+    data_file.write_bytes(b"\x00" * 300)
+    configuration["data_file"] = str(data_file)
+    gang.GangLoader(["COM3", "COM4"], configuration).run()
+    assert len(loaders) == 2
+    assert loaders[0].image is loaders[1].image
+    assert loaders[0].image_frames is loaders[1].image_frames
+    assert len(loaders[0].image_frames) == 2
+    assert loaders[0].journal_tag != loaders[1].journal_tag
+
+
+def test_report_progress_prints_each_step_once(configuration, capsys):
+    gang_loader = gang.GangLoader(["COM3"], configuration)
+    for count in range(1, 21):
+        gang_loader.report_progress("COM3", count, 20)
+    assert capsys.readouterr().out.count("COM3: ") == 11
+
+
+def test_status_messages_are_prefixed_with_port(configuration, loaders, monkeypatch, capsys):
+    monkeypatch.setattr(gang.GangLoader, "_load_image", lambda self: None)
+    monkeypatch.setattr(
+        gang._PortLoader, "perform_commands", lambda self: self.report("\nWriting finished!")
+    )
+    gang.GangLoader(["COM3", "COM4"], configuration).run()
+    output = capsys.readouterr().out
+    assert "COM3: Writing finished!\n" in output
+    assert "COM4: Writing finished!\n" in output
@@ -0,0 +1,108 @@
+"""Unit tests for the GPIO character device lines, on a fake GPIO chip."""
+
+import os
+
+import pytest
+
+fcntl = pytest.importorskip("fcntl")
+
+from stm32loader import gpiochip  # noqa: E402 pylint: disable=wrong-import-position
+from stm32loader.gpiochip import GpioLines  # noqa: E402 pylint: disable=wrong-import-position
+
+# pylint: disable=missing-docstring, redefined-outer-name
+# pylint: disable=import-outside-toplevel, protected-access
+
+
+class FakeChip(object):
+    """Answer the GPIO ioctls like a kernel GPIO chip would."""
+
+    def __init__(self):
+        self.levels = {}
+        # levels after each change
+        self.history = []
+        self.requests = []
+        self.ioctl_count = 0
+        self.line_fd = None
+        self._offsets = None
+
+    def ioctl(self, fd, request, argument):
+        self.ioctl_count += 1
+        if request == gpiochip.GET_LINE_IOCTL:
+            fields = list(gpiochip._LINE_REQUEST.unpack(bytes(argument)))
+            line_count = fields[-3]
+            self._offsets = fields[:line_count]
+            flags, attribute_count, attribute_id, values, mask = fields[65:70]
+            assert flags == gpiochip.LINE_FLAG_OUTPUT
+            assert attribute_count == 1
+            assert attribute_id == gpiochip.ATTRIBUTE_ID_OUTPUT_VALUES
+            self.requests.append((self._offsets, fields[64].rstrip(b"\0")))
+            self._apply(values, mask)
+            # the line request fd; any open fd will do
+            self.line_fd = os.open(os.devnull, os.O_RDONLY)
+            fields[-1] = self.line_fd
+            argument[:] = gpiochip._LINE_REQUEST.pack(*fields)
+        elif request == gpiochip.LINE_SET_VALUES_IOCTL:
+            assert fd == self.line_fd
+            self._apply(*gpiochip._LINE_VALUES.unpack(argument))
+        else:
+            raise IOError("unexpected ioctl 0x%X" % request)
+        return 0
+
+    def _apply(self, values, mask):
+        for index, offset in enumerate(self._offsets):
+            if mask & (1 << index):
+                self.levels[offset] = (values >> index) & 1
+        self.history.append(dict(self.levels))
+
+
+@pytest.fixture
+def chip(monkeypatch):
+    chip = FakeChip()
+    monkeypatch.setattr(gpiochip, "_ioctl", chip.ioctl)
+    return chip
+
+
+def test_ioctl_request_codes_match_linux_uapi():
+    assert gpiochip.GET_LINE_IOCTL == 0xC250B407
+    assert gpiochip.LINE_SET_VALUES_IOCTL == 0xC010B40F
+
+
+def test_lines_are_requested_once_with_initial_values(chip):
+    lines = GpioLines(os.devnull, [18, 17], values=0b01)
+    assert chip.requests == [([18, 17], b"stm32loader")]
+    assert chip.levels == {18: 1, 17: 0}
+    lines.close()
+
+
+def test_set_values_changes_all_lines_with_one_ioctl(chip):
+    lines = GpioLines(os.devnull, [18, 17])
+    count = chip.ioctl_count
+    lines.set_values(0b10)
+    assert chip.ioctl_count == count + 1
+    assert chip.levels == {18: 0, 17: 1}
+    lines.close()
+
+
+def test_gpiochip_backend_enters_bootloader_with_two_line_changes(chip, monkeypatch):
+    pytest.importorskip("serial")
+    from stm32loader.bootloader import Stm32Bootloader
+    from stm32loader.uart import SerialConnection
+    from stm32loader.uart_gpios import SerialConnectionGpiochip
+
+    monkeypatch.setattr(SerialConnection, "connect", lambda self: None)
+    connection = SerialConnectionGpiochip(
+        "/dev/null", chip=os.devnull, reset_line=5, boot0_line=6
+    )
+    # as main does before connecting: boot0 off, reset released
+    connection.enable_boot0(False)
+    connection.enable_reset(False)
+    connection.connect()
+    assert chip.levels == {5: 1, 6: 0}
+
+    del chip.history[:]
+    stm32 = Stm32Bootloader(connection)
+    stm32.reset_hold_time = 0
+    stm32._reset(boot0=True)
+    # reset and boot0 change together, then reset is released
+    assert chip.history == [{5: 0, 6: 1}, {5: 1, 6: 1}]
+    connection.clean_gpio_pins()
@@ -0,0 +1,263 @@
+"""Unit tests for loading HEX, S-record and ELF images."""
+
+import struct
+import sys
+
+import pytest
+
+from stm32loader.image import (
+    ImageError,
+    MemoryImage,
+    load_image,
+    parse_elf,
+    parse_intel_hex,
+    parse_srec,
+)
+
+# pylint: disable=missing-docstring
+
+
+def hex_record(record_type, offset, data):
+    record = bytearray([len(data), offset >> 8, offset & 0xFF, record_type]) + bytearray(data)
+    record.append(-sum(record) & 0xFF)
+    return ":" + "".join("%02X" % byte for byte in record)
+
+
+def srec_record(record_type, address, data):
+    address_length = {0: 2, 1: 2, 2: 3, 3: 4, 7: 4, 9: 2}[record_type]
+    record = bytearray([address_length + len(data) + 1])
+    record += bytearray(
+        (address >> (8 * shift)) & 0xFF for shift in reversed(range(address_length))
+    )
+    record += bytearray(data)
+    record.append(0xFF - sum(record) & 0xFF)
+    return "S%d" % record_type + "".join("%02X" % byte for byte in record)
+
+
+def elf32(segments, byte_order="<"):
+    """Return an ELF32 file with a PT_LOAD header per (address, data)."""
+    header_size, entry_size = 52, 32
+    content = bytearray(
+        b"\x7fELF" + bytearray([1, 1 if byte_order == "<" else 2, 1]) + b"\x00" * 9
+    )
+    content += struct.pack(
+        byte_order + "HHIIIIIHHH",
+        2,
+        40,
+        1,
+        0x08000000,
+        header_size,
+        0,
+        0,
+        header_size,
+        entry_size,
+        len(segments),
+    )
+    content += b"\x00" * 6
+    offset = header_size + entry_size * len(segments)
+    for address, data in segments:
+        content += struct.pack(
+            byte_order + "IIIIIIII",
+            1,
+            offset,
+            0x20000000,
+            address,
+            len(data),
+            len(data) + 8,
+            5,
+            4,
+        )
+        offset += len(data)
+    for _address, data in segments:
+        content += data
+    return bytes(content)
+
+
+def segments(image):
+    return [(segment.address, bytes(segment.data)) for segment in image.segments]
+
+
+def test_add_joins_adjacent_and_overlapping_data():
+    image = MemoryImage()
+    image.add(0x100, b"\x01\x02")
+    image.add(0x102, b"\x03")
+    image.add(0x200, b"\x09")
+    image.add(0x0FF, b"\x00\x11")
+    assert segments(image) == [(0x0FF, b"\x00\x11\x02\x03"), (0x200, b"\x09")]
+    assert image.size == 5
+
+
+def test_merged_joins_segments_only_if_that_saves_chunks():
+    image = MemoryImage()
+    image.add(0x000, b"\x01" * 16)
+    image.add(0x020, b"\x02" * 16)
+    image.add(0x400, b"\x03" * 16)
+    merged = image.merged(256)
+    assert segments(merged) == [
+        (0x000, b"\x01" * 16 + b"\xff" * 16 + b"\x02" * 16),
+        (0x400, b"\x03" * 16),
+    ]
+    # the original is not modified
+    assert len(image.segments) == 3
+
+
+def test_digest_depends_on_addresses():
+    first, second = MemoryImage(), MemoryImage()
+    first.add(0x100, b"\x01")
+    second.add(0x200, b"\x01")
+    assert first.digest() != second.digest()
+
+
+def test_parse_intel_hex_with_extended_linear_address():
+    lines = [
+        hex_record(0x04, 0, b"\x08\x00"),
+        hex_record(0x00, 0x0000, b"\x01\x02\x03\x04"),
+        hex_record(0x00, 0x0004, b"\x05\x06"),
+        hex_record(0x00, 0x4000, b"\xaa"),
+        hex_record(0x05, 0, b"\x08\x00\x01\x01"),
+        hex_record(0x01, 0, b""),
+    ]
+    image = parse_intel_hex("\n".join(lines).encode("ascii"))
+    assert segments(image) == [(0x08000000, b"\x01\x02\x03\x04\x05\x06"), (0x08004000, b"\xaa")]
+
+
+def test_parse_intel_hex_rejects_wrong_checksum():
+    record = hex_record(0x00, 0, b"\x01\x02")
+    broken = record[:-2] + ("%02X" % (int(record[-2:], 16) ^ 1))
+    with pytest.raises(ImageError, match="Line 1: wrong checksum"):
+        parse_intel_hex(broken.encode("ascii"))
+
+
+def test_parse_srec():
+    lines = [
+        srec_record(0, 0, b"hdr"),
+        srec_record(3, 0x08000000, b"\x01\x02"),
+        srec_record(2, 0x010000, b"\x03"),
+        srec_record(7, 0x08000000, b""),
+    ]
+    image = parse_srec("\r\n".join(lines).encode("ascii"))
+    assert segments(image) == [(0x010000, b"\x03"), (0x08000000, b"\x01\x02")]
+
+
+def test_parse_srec_rejects_garbage():
+    with pytest.raises(ImageError, match="Line 2"):
+        parse_srec((srec_record(1, 0, b"\x01") + "\nX1234").encode("ascii"))
+
+
+@pytest.mark.parametrize("byte_order", ["<", ">"])
+def test_parse_elf_uses_load_addresses(byte_order):
+    content = elf32([(0x08000000, b"\x01\x02\x03\x04"), (0x08001000, b"\x05\x06")], byte_order)
+    image = parse_elf(content)
+    assert segments(image) == [(0x08000000, b"\x01\x02\x03\x04"), (0x08001000, b"\x05\x06")]
+
+
+def test_parse_elf_rejects_truncated_file():
+    content = elf32([(0x08000000, b"\x01\x02\x03\x04")])
+    with pytest.raises(ImageError):
+        parse_elf(content[:-2])
+
+
+def test_load_image_detects_format(tmp_path):
+    binary = tmp_path.joinpath("image.bin")
+    binary.write_bytes(b"\x01\x02")
+    assert segments(load_image(str(binary), 0x08000400)) == [(0x08000400, b"\x01\x02")]
+
+    intel_hex = tmp_path.joinpath("image.hex")
+    intel_hex.write_bytes(hex_record(0x00, 0x10, b"\x07").encode("ascii"))
+    assert segments(load_image(str(intel_hex), 0x08000000)) == [(0x10, b"\x07")]
+
+    elf = tmp_path.joinpath("image.axf")
+    elf.write_bytes(elf32([(0x08000000, b"\x01")]))
+    assert segments(load_image(str(elf), 0)) == [(0x08000000, b"\x01")]
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="the simulator needs Python 3")
+def test_write_and_verify_segments(tmp_path):
+    pytest.importorskip("serial")
+    # pylint: disable=import-outside-toplevel
+    from stm32loader.bootloader import Stm32Bootloader
+    from stm32loader.devices import get_device
+    from stm32loader.main import Stm32Loader
+    from stm32loader.simulator import BootloaderSimulator, SimulatedConnection
+
+    simulator = BootloaderSimulator(chip_id=0x410, family="F1", flash_size=16 * 1024)
+    data_file = tmp_path.joinpath("image.hex")
+    lines = [hex_record(0x04, 0, b"\x08\x00")]
+    lines += [hex_record(0x00, offset, b"\x11" * 16) for offset in range(0, 512, 16)]
+    lines += [hex_record(0x00, 0x1000, b"\x22" * 4), hex_record(0x00, 0x1010, b"\x33" * 4)]
+    data_file.write_bytes("\n".join(lines).encode("ascii"))
+
+    simulator.flash[0x800:0x804] = b"\x55" * 4
+
+    loader = Stm32Loader()
+    loader.configuration.update(
+        data_file=str(data_file), family="F1", erase=True, write=True, verify=True
+    )
+    loader.stm32 = Stm32Bootloader(SimulatedConnection(simulator), verbosity=0)
+    loader.stm32.device_family = "F1"
+    loader.stm32.device = get_device(0x410)
+    loader.stm32.reset_from_system_memory()
+    loader.stm32.get()
+    loader.perform_commands()
+
+    assert simulator.read(0x08000000, 512) == b"\x11" * 512
+    assert simulator.read(0x08001000, 20) == b"\x22" * 4 + b"\xff" * 12 + b"\x33" * 4
+    # only pages 0 and 4 were erased
+    assert simulator.read(0x08000800, 4) == b"\x55" * 4
+    assert not tmp_path.joinpath("image.hex.journal").exists()
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="the simulator needs Python 3")
+def test_delta_write_with_unknown_page_layout_refuses_to_write(tmp_path):
+    pytest.importorskip("serial")
+    # pylint: disable=import-outside-toplevel
+    from stm32loader.bootloader import Stm32Bootloader
+    from stm32loader.main import Stm32Loader
+    from stm32loader.simulator import BootloaderSimulator, SimulatedConnection
+
+    simulator = BootloaderSimulator(chip_id=0x410, family="F1", flash_size=16 * 1024)
+    data_file = tmp_path.joinpath("image.bin")
+    data_file.write_bytes(b"\x11" * 512)
+
+    loader = Stm32Loader()
+    loader.configuration.update(data_file=str(data_file), family="F1", write=True, delta=True)
+    loader.stm32 = Stm32Bootloader(SimulatedConnection(simulator), verbosity=0)
+    # family F1 without a device descriptor: 1 KiB or 2 KiB pages
+    loader.stm32.device_family = "F1"
+    loader.stm32.reset_from_system_memory()
+    loader.stm32.get()
+    with pytest.raises(SystemExit) as exit_info:
+        loader.perform_commands()
+
+    assert exit_info.value.code == 3
+    assert simulator.read(0x08000000, 512) == b"\xff" * 512
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="the simulator needs Python 3")
+def test_verify_reports_mismatches_of_all_segments(tmp_path, capsys):
+    pytest.importorskip("serial")
+    # pylint: disable=import-outside-toplevel
+    from stm32loader.bootloader import Stm32Bootloader
+    from stm32loader.main import Stm32Loader
+    from stm32loader.simulator import BootloaderSimulator, SimulatedConnection
+
+    simulator = BootloaderSimulator(chip_id=0x410, family="F1", flash_size=16 * 1024)
+    data_file = tmp_path.joinpath("image.hex")
+    lines = [hex_record(0x04, 0, b"\x08\x00")]
+    lines += [hex_record(0x00, 0x0000, b"\xff" * 16), hex_record(0x00, 0x1000, b"\xff" * 16)]
+    data_file.write_bytes("\n".join(lines).encode("ascii"))
+    simulator.flash[0x0004:0x0006] = b"\x00\x00"
+    simulator.flash[0x100F] = 0x00
+
+    loader = Stm32Loader()
+    loader.configuration.update(data_file=str(data_file), verify=True)
+    loader.stm32 = Stm32Bootloader(SimulatedConnection(simulator), verbosity=0)
+    loader.stm32.reset_from_system_memory()
+    loader.stm32.get()
+    with pytest.raises(SystemExit):
+        loader.perform_commands()
+
+    output = capsys.readouterr().out
+    assert "Verification FAILED: 3 bytes differ in 2 ranges" in output
+    assert "0x08000004-0x08000005: 2 of 2 bytes" in output
+    assert "0x0800100F-0x0800100F: 1 of 1 bytes" in output
@@ -0,0 +1,141 @@
+"""Unit tests for the Journal class."""
+
+import os
+import sys
+
+import pytest
+
+from stm32loader.journal import Journal
+
+# pylint: disable=missing-docstring, redefined-outer-name
+
+
+@pytest.fixture
+def journal_path(tmpdir):
+    return os.path.join(str(tmpdir), "dump.bin.progress")
+
+
+def test_load_without_sidecar_file_returns_zero(journal_path):
+    assert Journal(journal_path, {"address": 0}).load() == 0
+
+
+def test_load_returns_saved_offset_for_same_key(journal_path):
+    Journal(journal_path, {"address": 0}).save(4096)
+    assert Journal(journal_path, {"address": 0}).load() == 4096
+
+
+def test_load_with_different_key_returns_zero(journal_path):
+    Journal(journal_path, {"address": 0}).save(4096)
+    assert Journal(journal_path, {"address": 1}).load() == 0
+
+
+def test_load_with_corrupt_sidecar_file_returns_zero(journal_path):
+    with open(journal_path, "w") as journal_file:
+        journal_file.write("{")
+    assert Journal(journal_path, {"address": 0}).load() == 0
+
+
+def test_discard_removes_sidecar_file(journal_path):
+    journal = Journal(journal_path, {"address": 0})
+    journal.save(1)
+    journal.discard()
+    assert not os.path.exists(journal_path)
+    journal.discard()
+
+
+def test_update_saves_only_after_save_interval(journal_path):
+    journal = Journal(journal_path, {"address": 0}, save_interval=1024)
+    journal.update(512)
+    assert Journal(journal_path, {"address": 0}).load() == 0
+    journal.update(1024)
+    assert Journal(journal_path, {"address": 0}).load() == 1024
+
+
+def test_save_without_offset_saves_last_updated_offset(journal_path):
+    journal = Journal(journal_path, {"address": 0}, save_interval=1024)
+    journal.update(256)
+    journal.save()
+    assert Journal(journal_path, {"address": 0}).load() == 256
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="the simulator needs Python 3")
+def test_dump_memory_retries_failed_chunk(tmpdir):
+    pytest.importorskip("serial")
+    # pylint: disable=import-outside-toplevel
+    from stm32loader.bootloader import Stm32Bootloader
+    from stm32loader.main import Stm32Loader
+    from stm32loader.simulator import BootloaderSimulator, SimulatedConnection
+
+    class LossyConnection(SimulatedConnection):
+        """Loses the reply of the first data chunk read."""
+
+        lost = False
+
+        def read(self, size=1):
+            data = SimulatedConnection.read(self, size)
+            if size > 1 and not self.lost:
+                self.lost = True
+                return b""
+            return data
+
+    simulator = BootloaderSimulator(chip_id=0x410, family="F1", flash_size=16 * 1024)
+    simulator.flash[:1000] = bytearray(range(250)) * 4
+    dump_file = os.path.join(str(tmpdir), "dump.bin")
+    loader = Stm32Loader()
+    loader.configuration.update(data_file=dump_file, length=1000, read=True)
+    loader.stm32 = Stm32Bootloader(LossyConnection(simulator), verbosity=0)
+    loader.stm32.chunk_retries = 1
+    loader.stm32.reset_from_system_memory()
+    loader.dump_memory()
+    assert loader.stm32.connection.lost
+
+    with open(dump_file, "rb") as dump:
+        assert dump.read() == bytes(simulator.flash[:1000])
+    assert not os.path.exists(dump_file + ".progress")
+
+
+def interrupted_write_loader(tmpdir, **configuration):
+    # pylint: disable=import-outside-toplevel
+    from stm32loader.bootloader import Stm32Bootloader
+    from stm32loader.main import Stm32Loader
+    from stm32loader.simulator import BootloaderSimulator, SimulatedConnection
+
+    simulator = BootloaderSimulator(chip_id=0x410, family="F1", flash_size=16 * 1024)
+    # the write of the second page fails
+    simulator.write_protected.add(1)
+    data_file = os.path.join(str(tmpdir), "image.bin")
+    with open(data_file, "wb") as image:
+        image.write(b"\x11" * 2048)
+    loader = Stm32Loader()
+    loader.configuration.update(data_file=data_file, write=True, family="F1", **configuration)
+    loader.stm32 = Stm32Bootloader(SimulatedConnection(simulator), verbosity=0)
+    loader.stm32.device_family = "F1"
+    loader.stm32.reset_from_system_memory()
+    loader.stm32.get()
+    return loader
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="the simulator needs Python 3")
+@pytest.mark.parametrize("resume", [False, True])
+def test_write_records_progress_only_with_resume(tmpdir, resume):
+    pytest.importorskip("serial")
+    # pylint: disable=import-outside-toplevel
+    from stm32loader.bootloader import CommandError
+    from stm32loader.devices import get_device
+
+    loader = interrupted_write_loader(tmpdir, resume=resume)
+    loader.stm32.device = get_device(0x410)
+    with pytest.raises(CommandError):
+        loader.perform_commands()
+    assert os.path.exists(loader.configuration["data_file"] + ".journal") == resume
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason="the simulator needs Python 3")
+def test_resume_write_with_unknown_page_layout_refuses_to_write(tmpdir):
+    pytest.importorskip("serial")
+    # family F1 without a device descriptor: 1 KiB or 2 KiB pages
+    loader = interrupted_write_loader(tmpdir, resume=True)
+    with pytest.raises(SystemExit) as exit_info:
+        loader.perform_commands()
+    assert exit_info.value.code == 3
+    assert not os.path.exists(loader.configuration["data_file"] + ".journal")
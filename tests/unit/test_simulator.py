@@ -0,0 +1,193 @@
+"""Unit tests for the bootloader simulator, driven by Stm32Bootloader."""
+
+import os
+import select
+import sys
+
+import pytest
+
+from stm32loader import bootloader as Stm32
+from stm32loader.bootloader import Stm32Bootloader
+from stm32loader.simulator import BootloaderSimulator, PtySimulator, SimulatedConnection
+
+# pylint: disable=missing-docstring, redefined-outer-name
+
+FLASH = Stm32Bootloader.FLASH_START_ADDRESS
+
+
+@pytest.fixture
+def simulator():
+    return BootloaderSimulator(chip_id=0x410, family="F1", flash_size=16 * 1024)
+
+
+@pytest.fixture
+def stm32(simulator):
+    stm32 = Stm32Bootloader(SimulatedConnection(simulator), verbosity=0)
+    stm32.reset_from_system_memory()
+    return stm32
+
+
+def test_get_reports_version_and_commands(stm32):
+    assert stm32.get() == 0x31
+    assert not stm32.extended_erase
+    assert Stm32Bootloader.Command.GET_CHECKSUM not in stm32.available_commands
+
+
+def test_get_id_and_device_registers(stm32):
+    assert stm32.get_id() == 0x410
+    assert stm32.get_flash_size("F1") == 16
+    assert stm32.get_uid("F1") == bytearray(range(1, 13))
+
+
+def test_written_data_reads_back(stm32, simulator):
+    data = bytearray(range(256)) * 3 + bytearray(b"\x01\x02\x03")
+    stm32.erase_memory()
+    stm32.write_memory_data(FLASH + 1024, data)
+    assert stm32.read_memory_data(FLASH + 1024, len(data)) == data
+    assert simulator.read(FLASH + 1024, 4) == b"\x00\x01\x02\x03"
+
+
+def test_write_without_erase_only_clears_bits(stm32, simulator):
+    stm32.write_memory(FLASH, bytearray(b"\x0f\x0f\x0f\x0f"))
+    stm32.write_memory(FLASH, bytearray(b"\xf1\xf1\xf1\xf1"))
+    assert simulator.read(FLASH, 4) == b"\x01\x01\x01\x01"
+
+
+def test_page_erase_erases_only_given_pages(stm32, simulator):
+    stm32.write_memory_data(FLASH, bytearray(2048))
+    stm32.erase_pages([1])
+    assert simulator.read(FLASH, 1) == b"\x00"
+    assert simulator.read(FLASH + 1024, 1) == b"\xff"
+
+
+def test_extended_erase_and_checksum():
+    simulator = BootloaderSimulator(extended_erase=True, get_checksum=True)
+    stm32 = Stm32Bootloader(SimulatedConnection(simulator), verbosity=0)
+    stm32.reset_from_system_memory()
+    stm32.get()
+    stm32.erase_pages([0])
+    stm32.write_memory_data(FLASH, bytearray(b"\x78\x56\x34\x12"))
+    assert stm32.get_checksum(FLASH, 4) == 0xDF8A8A2B
+
+
+def test_read_outside_memory_is_refused(stm32):
+    with pytest.raises(Stm32.CommandError, match="NACK"):
+        stm32.read_memory(0x30000000, 4)
+
+
+def test_write_protected_page_is_refused(stm32):
+    stm32.write_protect([0])
+    stm32.reset_from_system_memory()
+    with pytest.raises(Stm32.CommandError, match="NACK"):
+        stm32.write_memory(FLASH, bytearray(4))
+    stm32.write_memory(FLASH + 1024, bytearray(4))
+
+
+def test_readout_unprotect_erases_flash(stm32, simulator, monkeypatch):
+    monkeypatch.setattr(Stm32.time, "sleep", lambda seconds: None)
+    stm32.write_memory(FLASH, bytearray(4))
+    stm32.readout_protect()
+    stm32.reset_from_system_memory()
+    with pytest.raises(Stm32.CommandError, match="NACK"):
+        stm32.read_memory(FLASH, 4)
+    stm32.readout_unprotect()
+    assert stm32.read_memory(FLASH, 4) == b"\xff\xff\xff\xff"
+
+
+def test_go_starts_application_until_reset(stm32):
+    stm32.go(FLASH)
+    with pytest.raises(Stm32.CommandError):
+        stm32.get()
+    stm32.reset_from_system_memory()
+    stm32.get()
+
+
+def test_synchronization_byte_after_autobaud_waits_for_second_byte(simulator):
+    simulator.reset(boot0=True)
+    simulator.feed(b"\x7f")
+    assert [reply for _, reply in simulator.take_output()] == [b"\x79"]
+    simulator.feed(b"\x7f")
+    assert simulator.take_output() == []
+    simulator.feed(b"\x7f")
+    assert [reply for _, reply in simulator.take_output()] == [b"\x1f"]
+
+
+def test_clock_counts_transfer_time_at_baud_rate(stm32, simulator):
+    data = bytearray(4096)
+    start = simulator.clock
+    stm32.write_memory_data(FLASH, data)
+    fast = simulator.clock - start
+    simulator.baud_rate = 57600
+    start = simulator.clock
+    stm32.write_memory_data(FLASH, data)
+    assert simulator.clock - start > 1.5 * fast
+    # at least the data frames at 115200 baud
+    assert fast > len(data) * 11 / 115200.0
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="needs a Linux pty")
+def test_pty_simulator_answers_synchronization():
+    pty_simulator = PtySimulator(BootloaderSimulator())
+    pty_simulator.start()
+    port = os.open(pty_simulator.port, os.O_RDWR | os.O_NOCTTY)
+    try:
+        os.write(port, b"\x7f")
+        assert select.select([port], [], [], 2)[0]
+        assert os.read(port, 1) == b"\x79"
+    finally:
+        os.close(port)
+        pty_simulator.stop()
+
+
+def test_run_that_stays_in_bootloader_lets_next_run_skip_reset(simulator, monkeypatch, capsys):
+    # pylint: disable=import-outside-toplevel
+    from stm32loader import backends
+    from stm32loader.main import main
+
+    class Connection(SimulatedConnection):
+        def connect(self):
+            pass
+
+    resets = []
+    reset = simulator.reset
+
+    def counting_reset(boot0=None):
+        resets.append(boot0)
+        reset(boot0)
+
+    monkeypatch.setattr(simulator, "reset", counting_reset)
+    monkeypatch.setattr(backends, "create_connection", lambda *_args: Connection(simulator))
+
+    main("-p", "sim", "-f", "F1", "--stay-in-bootloader", avoid_system_exit=True)
+    assert resets == [True]
+    assert simulator.mode == "bootloader"
+
+    main("-p", "sim", "-f", "F1", "-V", avoid_system_exit=True)
+    assert "Bootloader is active, skipping reset." in capsys.readouterr().err
+    # the second run only reset the MCU into the application at exit
+    assert resets == [True, False]
+    assert simulator.mode == "application"
+
+
+class LateReplyConnection(SimulatedConnection):
+    """A SimulatedConnection whose first reads time out, like a slow link."""
+
+    def __init__(self, simulator, late_reads):
+        super().__init__(simulator)
+        self.late_reads = late_reads
+
+    def read(self, size=1):
+        if self.late_reads:
+            self.late_reads -= 1
+            self.simulator.clock += self.timeout
+            return b""
+        return super().read(size)
+
+
+@pytest.mark.parametrize("late_reads", [1, 2, 3])
+def test_command_after_late_synchronization_reply_succeeds(simulator, late_reads):
+    connection = LateReplyConnection(simulator, late_reads)
+    stm32 = Stm32Bootloader(connection, verbosity=0)
+    stm32.reset_from_system_memory()
+    assert stm32.get() == 0x31
+    assert stm32.get_id() == 0x410
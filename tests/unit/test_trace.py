@@ -0,0 +1,102 @@
+"""Unit tests for the command timing trace."""
+
+import csv
+import json
+
+import pytest
+
+from stm32loader.bootloader import Stm32Bootloader
+from stm32loader.trace import CommandTrace
+
+# pylint: disable=missing-docstring, redefined-outer-name
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+@pytest.fixture
+def trace(clock):
+    return CommandTrace(clock)
+
+
+def record_command(trace, clock, name, address, command_ack, final_ack, command=0x31):
+    trace.begin(command, name)
+    trace.annotate(address, 256)
+    start = clock.time
+    clock.time = start + command_ack
+    trace.ack()
+    clock.time = start + final_ack
+    trace.ack()
+
+
+def test_records_command_and_final_ack_times(trace, clock):
+    record_command(trace, clock, "Write memory", 0x08000000, 0.001, 0.006)
+    record = trace.records[0]
+    assert (record.command, record.address, record.size) == (0x31, 0x08000000, 256)
+    assert record.command_ack == pytest.approx(0.001)
+    assert record.final_ack == pytest.approx(0.006)
+
+
+def test_retries_apply_to_next_command_only(trace, clock):
+    trace.retries = 2
+    record_command(trace, clock, "Write memory", 0x08000000, 0.001, 0.006)
+    record_command(trace, clock, "Write memory", 0x08000100, 0.001, 0.006)
+    assert [record.retries for record in trace.records] == [2, 0]
+    assert trace.summary()["Write memory"]["retries"] == 2
+
+
+def test_summary_histogram_and_outliers(trace, clock):
+    for index in range(9):
+        record_command(trace, clock, "Write memory", 0x08000000 + index * 256, 0.001, 0.006)
+    record_command(trace, clock, "Write memory", 0x08000900, 0.001, 0.040)
+    stats = trace.summary()["Write memory"]
+    assert stats["count"] == 10
+    assert stats["median"] == pytest.approx(0.006)
+    assert stats["max"] == pytest.approx(0.040)
+    assert sum(stats["histogram"]) == 10
+    assert stats["histogram"][CommandTrace.HISTOGRAM_BOUNDS.index(0.01)] == 9
+    assert [record.address for record in trace.outliers()] == [0x08000900]
+    assert "Slow Write memory at 0x8000900" in trace.format_summary()
+
+
+def test_save_writes_json_or_csv(trace, clock, tmp_path):
+    record_command(trace, clock, "Read memory", 0x08000000, 0.001, 0.025, command=0x11)
+    json_file = str(tmp_path.joinpath("trace.json"))
+    csv_file = str(tmp_path.joinpath("trace.csv"))
+    trace.save(json_file)
+    trace.save(csv_file)
+    with open(json_file) as trace_file:
+        assert json.load(trace_file)["records"][0]["command"] == 0x11
+    with open(csv_file) as trace_file:
+        rows = list(csv.DictReader(trace_file))
+    assert rows[0]["name"] == "Read memory"
+
+
+def test_bootloader_fills_in_trace(trace):
+    connection_reads = iter([[Stm32Bootloader.Reply.ACK]] * 3)
+
+    class Connection(object):
+        timeout = 5
+
+        def write(self, data):
+            pass
+
+        def read(self, size=1):
+            return next(connection_reads)
+
+    stm32 = Stm32Bootloader(Connection())
+    stm32.trace = trace
+    stm32.write_memory(0x08000400, bytearray(4))
+    record = trace.records[0]
+    assert (record.name, record.address, record.size) == ("Write memory", 0x08000400, 4)
+    assert record.final_ack is not None